@@ -5,6 +5,9 @@ import logging
 log = logging.getLogger(__name__)
 
 from funcs import *
+from packages import *
+from wipe import *
+from journal import *
 
 __VERSION__ = "0.0.1"
 __AUTHOR__ = u"Pekka Järvinen"
@@ -19,8 +22,8 @@ __EXAMPLES__ = [
     u'-' * 60,
 ]
 
-if __name__ == "__main__":
 
+def parse_arguments(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description=__DESCRIPTION__,
         epilog=__EPILOG__,
@@ -36,24 +39,100 @@ if __name__ == "__main__":
     optional.add_argument('--partitions <partitions.json>', '-p', type=argparse.FileType('r+', encoding='utf8'), dest='partitionsfile',
                         help='Partitions JSON file. These are created to target device.', default="partitions.json")
 
+    optional.add_argument('--jobs <count>', '-j', type=int, dest='jobs', default=1,
+                        help='Wipe and format this many partitions concurrently. Default: 1.')
+
+    optional.add_argument('--timeout <seconds>', type=float, dest='timeout', default=PARTITION_TIMEOUT,
+                        help='Wait this long for partitions to appear. Default: {}.'.format(PARTITION_TIMEOUT))
+
+    optional.add_argument('--prefetch', action='store_true', dest='prefetch',
+                        help='Download packages in background while partitioning. Install them with 3install.py --prefetched.')
+
+    optional.add_argument('--packages <packages.txt>', dest='packagesfile', default="packages.txt",
+                        help='Packages to prefetch in addition to base.')
+
+    optional.add_argument('--cache-dir <directory>', action=FullPaths, dest='cachedir', default=PACMAN_CACHE_DIR,
+                        help='Prefetch package cache directory. Default: {}.'.format(PACMAN_CACHE_DIR))
+
+    optional.add_argument('--wipe <method>', dest='wipe', choices=WIPE_METHODS, default=WIPE_AUTO,
+                        help='How device is wiped before partitioning: {}. auto picks the fastest one the device supports. Default: {}.'.format(
+                            ", ".join(WIPE_METHODS), WIPE_AUTO))
+
+    optional.add_argument('--image <root.img>', action=FullPaths, dest='image', default=None,
+                        help='Copy filesystem image made with mkimage.py to root partition instead of formatting it. Install with 3install.py --image.')
+
+    optional.add_argument('--delta', action='store_true', dest='delta',
+                        help='With --image: keep partition table when it matches and write only ranges of root partition which differ from image.')
+
+    optional.add_argument('--reconcile', action='store_true', dest='reconcile',
+                        help='Compare device with partitions file and change only partitions which differ. Changes are shown before confirmation.')
+
+    optional.add_argument('--from-stage <stage>', dest='from_stage', choices=STAGES, default=None,
+                        help='Redo this and later stages even if journal says they are done. Stages: {}.'.format(", ".join(STAGES)))
+
+    optional.add_argument('--yes', '-y', action='store_true', dest='yes',
+                        help='Do not ask for confirmation before deleting contents of target device.')
+
     required.add_argument('--device <block device>', '-d', action=FullPaths, type=is_block_device, dest='device',
                         required=True,
                         help='Target device (for example /dev/sda).')
 
     parser._action_groups.append(optional)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def run(args: argparse.Namespace):
     if int(args.verbose) > 0:
         logging.getLogger().setLevel(logging.DEBUG)
         log.info("Being verbose")
 
-    partitions = read_partitions_file(args.partitionsfile)
+    if args.jobs < 1:
+        log.error("Invalid job count: {}".format(args.jobs))
+        sys.exit(1)
+
+    partitions = load_partitions_file(args.partitionsfile)
+
+    prefetch = None
+
+    if args.prefetch:
+        packages = []
+        if os.path.isfile(args.packagesfile):
+            packages = read_packages_file(open(args.packagesfile, 'r', encoding="utf8"))
+        else:
+            log.info("No packages file {}. Prefetching base only.".format(args.packagesfile))
+
+        prefetch = PackagePrefetch(package_set(packages), args.cachedir)
 
     if len(partitions) < 2:
         log.error("There needs to be at least two (2) partitions. (/ and /boot)")
         sys.exit(1)
 
+    if args.delta and args.image is None:
+        log.error("--delta needs --image")
+        sys.exit(1)
+
+    # Partitions file entries by kernel name of partition
+    entries = {partition_name(args.device, idx): p for idx, p in enumerate(partitions, start=1)}
+    images = {}
+
+    if args.image is not None:
+        if not os.path.isfile(args.image):
+            log.error("Image not found: {}".format(args.image))
+            sys.exit(1)
+
+        try:
+            root_name = partition_name(args.device, root_partition_number(partitions))
+        except IndexError as e:
+            log.error("{}".format(e))
+            sys.exit(1)
+
+        if entries[root_name].get('filesystem', "ext4") != "ext4":
+            log.error("Images are ext4 but root partition is {}".format(entries[root_name]['filesystem']))
+            sys.exit(1)
+
+        images[root_name] = args.image
+
     unmount_all(args.device)
 
     block_device = get_block_device(args.device)
@@ -78,7 +157,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
 
-    if 'children' in block_device:
+    if 'children' in block_device and not args.reconcile:
         keys = ['name', 'fstype', 'mountpoint', 'label', 'partlabel', 'size']
         children = []
         for i in block_device['children']:
@@ -90,70 +169,179 @@ if __name__ == "__main__":
         for i in children:
             log.info("    {}".format(i))
 
-    confirm_delete_disk = input("Delete all contents from {}? y/n: ".format(args.device)).lower()
+    try:
+        layout = plan_partition_layout(block_device, partitions)
+        # Known before sgdisk runs, so the journal does not depend on udev noticing the new table
+        disk_guid = str(uuid.uuid4())
+        sgdisk_plan = plan_partition_table(block_device, partitions, disk_guid)
+    except ValueError as e:
+        log.error("Invalid partition layout: {}".format(e))
+        sys.exit(1)
+
+    log_partition_layout(layout)
+
+    journal = Journal(args.device, block_device.get('ptuuid'))
+
+    if args.from_stage is not None:
+        journal.reset_from(args.from_stage)
+
+    layout_matches = partition_layout_matches(block_device, partitions)
+    partitions_inputs = {"layout": layout, "wipe": args.wipe}
+    filesystems_inputs = {"partitions": partitions, "image": None, "delta": args.delta}
+
+    if args.image is not None:
+        st = os.stat(args.image)
+        filesystems_inputs["image"] = [args.image, st.st_size, st.st_mtime_ns]
+
+    # What each partition is formatted from. Recorded in journal for --reconcile.
+    fingerprints = {}
+    for idx, p in enumerate(partitions, start=1):
+        image = filesystems_inputs["image"] if partition_name(args.device, idx) in images else None
+        fingerprints[str(idx)] = inputs_hash([p.get('filesystem'), p.get('profile'), image])
+
+    partition_names = [partition_name(args.device, n) for n in range(1, len(partitions) + 1)]
+    # What udev must report for a partition before it is prepared
+    expected = {name: {"partlabel": p['name'], "parttype": TYPE_CODE_UUIDS.get(p['type'])}
+                for name, p in zip(partition_names, partitions)}
+    reconcile = None
+
+    if args.reconcile and block_device.get('pttype') == "gpt" and args.from_stage != STAGE_PARTITIONS:
+        reconcile = plan_reconcile(block_device, layout, partitions, fingerprints,
+                                   journal.details(STAGE_FILESYSTEMS).get("partitions"),
+                                   [idx for idx, name in enumerate(partition_names, start=1) if name in images],
+                                   args.from_stage == STAGE_FILESYSTEMS)
+        log_reconcile_plan(reconcile)
+        partitioned = formatted = not reconcile_changes(reconcile)
+    else:
+        if args.reconcile:
+            log.info("No GPT partition table on {}. Creating everything.".format(args.device))
+        partitioned = layout_matches and journal.done(STAGE_PARTITIONS, partitions_inputs)
+        formatted = partitioned and journal.done(STAGE_FILESYSTEMS, filesystems_inputs)
+
+    if formatted:
+        if reconcile is not None:
+            log.info("{} matches partitions file. Nothing to do.".format(args.device))
+            journal.complete(STAGE_PARTITIONS, partitions_inputs)
+            journal.complete(STAGE_FILESYSTEMS, filesystems_inputs, {"partitions": fingerprints})
+        else:
+            log.info("Partitions and filesystems of {} are done according to journal {}. Use --from-stage to redo.".format(
+                args.device, journal.path))
+
+        if prefetch is not None:
+            log.info("Prefetching {} packages to {}".format(len(prefetch.packages), prefetch.cachedir))
+            prefetch.start()
+            prefetch.wait()
+
+        log.info("Done.")
+        sys.exit(0)
+
+    delta = args.delta and layout_matches
+
+    if reconcile is None:
+        if delta:
+            log.info("Partition layout matches. Keeping partition table and writing only changed ranges of root partition.")
+        elif args.delta:
+            log.warning("Partition layout of {} differs from partitions file. Writing whole image.".format(args.device))
+        elif partitioned:
+            log.info("Partition table is done according to journal. Keeping it.")
+
+    if args.yes:
+        confirm_delete_disk = "y"
+    elif reconcile is not None:
+        confirm_delete_disk = input("Apply changes to {}? Created and formatted partitions lose their contents. y/n: ".format(
+            args.device)).lower()
+    else:
+        confirm_delete_disk = input("Delete all contents from {}? y/n: ".format(args.device)).lower()
 
     if confirm_delete_disk != "y":
         log.info("Aborted.")
         sys.exit(1)
 
-    sgdisk(args.device, ['--zap-all'])
-    wipefs(args.device, ['-a'])
-    sgdisk(args.device, ["--clear", "--mbrtogpt"])
-
-    log.info("Generating partitions..")
-    for idx, partition in enumerate(partitions):
-        sgargs = [
-            "--new", "0:0:{}".format(partition['size']),
-            "--typecode", "0:{:04x}".format(partition['type']),
-            "--change-name", "0:{}".format(partition['name']),
-        ]
-        log.info("Generating partition {} {}".format(partition['name'], "{:04x}".format(partition['type'])))
-        sgdisk(args.device, sgargs)
-
-    log.info("Informing OS for partition changes")
-    pb_run = partprobe(args.device)
-    log.info(pb_run.stdout.decode('utf8'))
-
-    block_device = get_block_device(args.device)
-
-    if 'children' not in block_device:
+    if prefetch is not None:
+        log.info("Prefetching {} packages to {} in background".format(len(prefetch.packages), prefetch.cachedir))
+        prefetch.start()
+
+    wiped = None
+    prepare_names = partition_names
+
+    if reconcile is not None:
+        prepare_names = [partition_names[p['number'] - 1] for p in reconcile['partitions'] if p['format']]
+        # Delta writes only make sense on a partition which stays where it was
+        kept = [partition_names[p['number'] - 1] for p in reconcile['partitions'] if p['table'] == "keep"]
+        delta = args.delta
+
+        reconcile_table = plan_reconcile_table(reconcile, layout, block_device)
+        if len(reconcile_table) > 0:
+            with stage("Updating partitions"):
+                log.info("Updating partition table..")
+                sgdisk(args.device, reconcile_table)
+
+        # Swap on kept partitions is not enabled by formatting
+        for p in get_block_device(args.device).get('children', []):
+            if p['parttype'] == UUID_SWAP and p['name'] not in prepare_names and p['mountpoint'] is None:
+                swapon("/dev/{}".format(p['name']))
+    elif not (delta or partitioned):
+        kept = []
+
+        with stage("Wiping device"):
+            wipe_method = args.wipe
+            if wipe_method == WIPE_AUTO:
+                wipe_method = choose_wipe_method(block_device)
+            log.info("Wiping {} ({})..".format(args.device, wipe_method))
+            wiped = wipe_device(args.device, wipe_method)
+
+        with stage("Generating partitions"):
+            wipefs(args.device, ['-a'])
+
+            log.info("Generating partitions..")
+            sgdisk(args.device, sgdisk_plan)
+            journal.ptuuid = disk_guid
+    else:
+        kept = partition_names
+
+    if not partitioned:
+        journal.complete(STAGE_PARTITIONS, partitions_inputs)
+
+    # Listen before partprobe so that no partition is missed
+    with stage("Preparing partitions"), PartitionWatcher() as watcher:
+        log.info("Informing OS for partition changes")
+        pb_run = partprobe(args.device)
+        log.info(pb_run.stdout.decode('utf8'))
+
+        # Each partition is wiped and formatted as soon as it appears
+        log.info("Wiping partitions and generating filesystems..")
+        ready = watcher.wait(prepare_names, args.timeout, expected)
+        appeared = (("/dev/{}".format(name), name) for name in ready)
+        errors = run_parallel(
+            lambda name: prepare_partition(args.device, name, images.get(name), delta and name in kept, wiped,
+                                           entries.get(name)),
+            appeared, args.jobs)
+
+    for name in watcher.pending:
+        errors["/dev/{}".format(name)] = "Did not appear in {} seconds".format(args.timeout)
+
+    log_summary("Preparing partitions", ["/dev/{}".format(name) for name in prepare_names], errors)
+
+    if len(watcher.pending) > 0:
         log.error("Partition generation failed")
         sys.exit(1)
 
-    log.info("Wiping partitions..")
-    for p in block_device['children']:
-        dev = "/dev/{}".format(p['name'])
-        log.info("  Wiping {}".format(dev))
-        sgdisk(dev, ['--zap-all'])
-        wipefs(dev, ['-a'])
-
-    log.info("Informing OS for partition changes")
-    pb_run = partprobe(args.device)
-    log.info(pb_run.stdout.decode('utf8'))
-
-    block_device = get_block_device(args.device)
-
-    log.info("Generating filesystems..")
-    for p in block_device['children']:
-        dev = "/dev/{}".format(p['name'])
-        log.info("  Partition {}".format(dev))
-        # log.debug(p)
-        if p['parttype'] == UUID_SWAP:
-            log.info("  Enabling swap on {}".format(p['name']))
-            enable_swap(dev)
-        elif p['parttype'] == UUID_BIOS:
-            pass
-        elif p['parttype'] == UUID_OTHER:
-            log.info("  Formatting ext4 @ {}".format(p['name']))
-            mkfs_ext4(dev)
-        else:
-            log.error("  Unknown type: {} {} {}. Format this manually.".format(p['name'], p['partlabel'], p['parttype']))
+    if len(errors) > 0:
+        sys.exit(1)
 
-    log.info("Informing OS for partition changes")
-    pb_run = partprobe(args.device)
-    log.info(pb_run.stdout.decode('utf8'))
+    journal.complete(STAGE_FILESYSTEMS, filesystems_inputs, {"partitions": fingerprints})
 
     fdisk_run = fdisk(args.device, ['--list'])
     log.info(fdisk_run.stdout.decode('utf8'))
 
+    if prefetch is not None:
+        work_end = time.monotonic()
+        log.info("Waiting for package prefetch..")
+        if prefetch.wait():
+            prefetch.report(work_end)
+
     log.info("Done.")
+
+
+if __name__ == "__main__":
+    run(parse_arguments())
@@ -19,8 +19,8 @@ __EXAMPLES__ = [
     u'-' * 60,
 ]
 
-if __name__ == "__main__":
 
+def parse_arguments(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description=__DESCRIPTION__,
         epilog=__EPILOG__,
@@ -33,18 +33,31 @@ if __name__ == "__main__":
     optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
                         help="Be verbose. -vvv.. Be more verbose.")
 
+    optional.add_argument('--prefix <directory>', '-P', action=FullPaths, dest='prefix', default=INSTALL_DIR_PREFIX,
+                        help='Installation directory. Default: {}.'.format(INSTALL_DIR_PREFIX))
+
+    optional.add_argument('--partitions <partitions.json>', '-p', type=argparse.FileType('r', encoding='utf8'),
+                        dest='partitionsfile', default=None,
+                        help='Partitions JSON file. Mount options come from filesystem profiles of partitions.')
+
     required.add_argument('--device <block device>', '-d', action=FullPaths, type=is_block_device, dest='device',
                         required=True,
                         help='Target device (for example /dev/sda).')
 
     parser._action_groups.append(optional)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def run(args: argparse.Namespace):
     if int(args.verbose) > 0:
         logging.getLogger().setLevel(logging.DEBUG)
         log.info("Being verbose")
 
+    entries = {}
+    if args.partitionsfile is not None:
+        entries = {p['name']: p for p in load_partitions_file(args.partitionsfile)}
+
     unmount_all(args.device)
 
     block_device = get_block_device(args.device)
@@ -53,40 +66,23 @@ if __name__ == "__main__":
         log.error("No partitions found??")
         sys.exit(1)
 
-    os.makedirs(os.path.join(INSTALL_DIR_PREFIX), exist_ok=True)
+    os.makedirs(os.path.join(args.prefix), exist_ok=True)
 
-    if not os.path.isdir(INSTALL_DIR_PREFIX):
-        log.error("Not a dir: {}".format(INSTALL_DIR_PREFIX))
+    if not os.path.isdir(args.prefix):
+        log.error("Not a dir: {}".format(args.prefix))
         sys.exit(1)
 
     log.info("Mounting partitions..")
 
-    # mount last partition as /
-    # must exist before /boot
-    for p in reversed(block_device['children']):
-        dev = "/dev/{}".format(p['name'])
-
-        if p['parttype'] == UUID_SWAP:
-            continue
-        elif p['parttype'] == UUID_BIOS:
-            continue
-        elif p['parttype'] == UUID_OTHER:
-            mount(dev, INSTALL_DIR_PREFIX)
-            break
-
-    # Mount first as "/boot"
-    for p in block_device['children']:
-        dev = "/dev/{}".format(p['name'])
-
-        if p['parttype'] == UUID_SWAP:
-            continue
-        elif p['parttype'] == UUID_BIOS:
-            continue
-        elif p['parttype'] == UUID_OTHER:
-            BOOTDIR = os.path.join(INSTALL_DIR_PREFIX, "boot")
-            os.makedirs(BOOTDIR, exist_ok=True)
-            mount(dev, BOOTDIR)
-            break
+    with stage("Mounting partitions"):
+        for p, target in plan_mounts(block_device):
+            destination = os.path.join(args.prefix, target.lstrip("/"))
+            os.makedirs(destination, exist_ok=True)
+            mount_partition(p, destination, entries.get(p['partlabel']))
 
     for p in get_block_device(args.device)['children']:
         print(p['mountpoint'])
+
+
+if __name__ == "__main__":
+    run(parse_arguments())
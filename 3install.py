@@ -5,6 +5,13 @@ import logging
 log = logging.getLogger(__name__)
 
 from funcs import *
+from mirrors import *
+from packages import *
+from journal import *
+from fstab import *
+from configure import *
+
+import tempfile
 
 __VERSION__ = "0.0.1"
 __AUTHOR__ = u"Pekka Järvinen"
@@ -19,8 +26,8 @@ __EXAMPLES__ = [
     u'-' * 60,
 ]
 
-if __name__ == "__main__":
 
+def parse_arguments(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description=__DESCRIPTION__,
         epilog=__EPILOG__,
@@ -37,18 +44,96 @@ if __name__ == "__main__":
                           dest='partitionsfile',
                           help='Partitions JSON file.', default="partitions.json")
 
+    optional.add_argument('--prefix <directory>', '-P', action=FullPaths, dest='prefix', default=INSTALL_DIR_PREFIX,
+                          help='Installation directory. Default: {}.'.format(INSTALL_DIR_PREFIX))
+
+    optional.add_argument('--skip-mirrors', action='store_true', dest='skip_mirrors',
+                          help='Do not rank mirrors. Use current pacman mirror list as is.')
+
+    optional.add_argument('--config <file.ini>', '-c', type=argparse.FileType('r', encoding='utf8'), dest='file',
+                          help='Config file. [network] gateway identifies the network in mirror cache, [pacman] sets parallel downloads. [locale], [time] and [network] configure the installed system.',
+                          default=None)
+
+    optional.add_argument('--mirror-proxy <url>', dest='mirror_proxy', default=None,
+                          help='Use proxy.py on another installer (http://host:port) as the only mirror.')
+
+    optional.add_argument('--mirrors <count>', type=int, dest='mirror_count', default=MIRROR_COUNT,
+                          help='Number of fastest mirrors to use. Default: {}.'.format(MIRROR_COUNT))
+
+    optional.add_argument('--mirror-connections <count>', type=int, dest='mirror_connections',
+                          default=MIRROR_CONNECTIONS,
+                          help='Probe this many mirrors concurrently. Default: {}.'.format(MIRROR_CONNECTIONS))
+
+    optional.add_argument('--mirror-timeout <seconds>', type=float, dest='mirror_timeout', default=MIRROR_TIMEOUT,
+                          help='Give up on a mirror after this many seconds. Default: {}.'.format(MIRROR_TIMEOUT))
+
+    optional.add_argument('--mirror-cache <file.json>', action=FullPaths, dest='mirror_cache',
+                          default=MIRROR_CACHE_FILE,
+                          help='Mirror ranking cache file. Default: {}.'.format(MIRROR_CACHE_FILE))
+
+    optional.add_argument('--mirror-cache-ttl <seconds>', type=float, dest='mirror_cache_ttl',
+                          default=MIRROR_CACHE_TTL,
+                          help='Rank mirrors again after this many seconds. 0 disables cache. Default: {}.'.format(
+                              MIRROR_CACHE_TTL))
+
+    optional.add_argument('--packages <packages.txt>', dest='packagesfile', default="packages.txt",
+                          help='Packages installed in addition to base.')
+
+    optional.add_argument('--prefetched', action='store_true', dest='prefetched',
+                          help='Install from host package cache filled by 1part.py --prefetch.')
+
+    optional.add_argument('--cache-dir <directory>', action=FullPaths, dest='cachedir', default=PACMAN_CACHE_DIR,
+                          help='Package cache used with --prefetched. Same as 1part.py --cache-dir. Default: {}.'.format(
+                              PACMAN_CACHE_DIR))
+
+    optional.add_argument('--image', action='store_true', dest='image',
+                          help='Root partition was deployed from image by 1part.py --image. Packages are not installed.')
+
+    optional.add_argument('--genfstab-check', action='store_true', dest='genfstab_check',
+                          help='Compare generated fstab with genfstab output and warn about differences.')
+
+    optional.add_argument('--from-stage <stage>', dest='from_stage', choices=STAGES, default=None,
+                          help='Redo this and later stages even if journal says they are done. Stages: {}.'.format(
+                              ", ".join(STAGES)))
+
     required.add_argument('--device <block device>', '-d', action=FullPaths, type=is_block_device, dest='device',
                           required=True,
                           help='Target device (for example /dev/sda).')
 
     parser._action_groups.append(optional)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def run(args: argparse.Namespace):
     if int(args.verbose) > 0:
         logging.getLogger().setLevel(logging.DEBUG)
         log.info("Being verbose")
 
+    config = None
+    if args.file is not None:
+        config = load_config_file(args.file)
+
+    try:
+        live_parallel_downloads, target_parallel_downloads = parallel_downloads(config)
+    except ValueError as e:
+        log.error("{}".format(e))
+        sys.exit(1)
+
+    packages = []
+    if os.path.isfile(args.packagesfile):
+        packages = read_packages_file(open(args.packagesfile, 'r', encoding="utf8"))
+    else:
+        log.info("No packages file {}. Installing base only.".format(args.packagesfile))
+
+    entries = {p['name']: p for p in load_partitions_file(args.partitionsfile)}
+
+    # Tools for the filesystems of the partitions
+    for partition in entries.values():
+        filesystem, profile = partition_filesystem(TYPE_CODE_UUIDS.get(partition['type']), partition)
+        if filesystem is not None and filesystem.package not in packages:
+            packages.append(filesystem.package)
+
     block_device = get_block_device(args.device)
 
     if 'children' not in block_device:
@@ -67,68 +152,162 @@ if __name__ == "__main__":
         if p['mountpoint'] is not None:
             found.append(p['mountpoint'])
 
-    if not os.path.isdir(INSTALL_DIR_PREFIX):
-        log.error("Not a dir: {}".format(INSTALL_DIR_PREFIX))
+    if not os.path.isdir(args.prefix):
+        log.error("Not a dir: {}".format(args.prefix))
         sys.exit(1)
 
-    # pacman mirror files in boot ISO
-    pacman_mirror_file = os.path.join("/etc", "pacman.d", "mirrorlist")
-    pacman_mirror_file_orig = os.path.join(pacman_mirror_file, ".orig")
-    pacman_mirror_file_backup = os.path.join(pacman_mirror_file, ".backup")
-
-    # copy original file
-    if not os.path.isfile(pacman_mirror_file_orig):
-        shutil.copy(pacman_mirror_file, pacman_mirror_file_orig)
-
-    with open(pacman_mirror_file_backup, 'w+', encoding="utf8") as backup:
-        # Read servers off from mirror original file
-        with open(pacman_mirror_file_orig, 'r', encoding="utf8") as f:
-            for line in f:
-                add = False
-                line = line.strip()
-
-                if line == "":
-                    continue
-
-                if line.lower().find("#Server".lower()) != -1:
-                    line = line.lstrip("#")
-                    add = True
-                if line[0] != "#":
-                    add = True
-
-                if add:
-                    log.debug("Adding: {}".format(line))
-                    backup.write("{}\n".format(line))
-
-    #with open(pacman_mirror_file_backup, 'r', encoding="utf8") as f:
-    #    log.info("{}:".format(f.name))
-    #    for line in f:
-    #        line = line.strip()
-    #        print(line)
-
-    log.info("Ranking mirrors.. Please wait..")
-    rankings = []
-    rank = rankmirrors(pacman_mirror_file_backup)
-    for line in rank.stdout.decode('utf8').split("\n"):
-        line = line.strip()
-        if line.find("#") == 0:
-            continue
-
-        if line.lower().find("Server".lower()) != -1:
-            rankings.append(line)
-
-    # add ranked mirrors to file
-    with open(pacman_mirror_file, 'w', encoding="utf8") as f:
-        for r in rankings:
-            f.write("{}\n".format(r))
+    journal = Journal(args.device, block_device.get('ptuuid'))
 
+    if args.from_stage is not None:
+        journal.reset_from(args.from_stage)
 
-    pacstrap(INSTALL_DIR_PREFIX, ['base'])
-
-    with open(os.path.join(INSTALL_DIR_PREFIX, "etc", "fstab")) as f:
-        fstab = genfstab(INSTALL_DIR_PREFIX)
-        for line in fstab.stdout.decode('utf8').split("\n"):
-            f.write("{}\n".format(line))
+    pacman_mirror_file = os.path.join("/etc", "pacman.d", "mirrorlist")
+    mirrors_inputs = {"proxy": args.mirror_proxy, "count": args.mirror_count}
+
+    with stage("Mirror list"):
+        if args.skip_mirrors or args.image:
+            log.info("Skipping mirror ranking")
+        elif (journal.done(STAGE_MIRRORS, mirrors_inputs) and os.path.isfile(pacman_mirror_file) and
+              journal.details(STAGE_MIRRORS).get("sha256") == file_sha256(pacman_mirror_file)):
+            log.info("Mirror list is done according to journal {}".format(journal.path))
+        elif args.mirror_proxy is not None:
+            log.info("Using package proxy {}".format(args.mirror_proxy))
+            with open(pacman_mirror_file, 'w', encoding="utf8") as f:
+                f.write(format_mirrorlist(["{}/$repo/os/$arch".format(args.mirror_proxy.rstrip("/"))]))
+        else:
+            # pacman mirror files in boot ISO
+            pacman_mirror_file_orig = pacman_mirror_file + ".orig"
+            pacman_mirror_file_backup = pacman_mirror_file + ".backup"
+
+            # copy original file
+            if not os.path.isfile(pacman_mirror_file_orig):
+                shutil.copy(pacman_mirror_file, pacman_mirror_file_orig)
+
+            with open(pacman_mirror_file_backup, 'w+', encoding="utf8") as backup:
+                # Read servers off from mirror original file
+                with open(pacman_mirror_file_orig, 'r', encoding="utf8") as f:
+                    for line in f:
+                        add = False
+                        line = line.strip()
+
+                        if line == "":
+                            continue
+
+                        if line.lower().find("#Server".lower()) != -1:
+                            line = line.lstrip("#")
+                            add = True
+                        if line[0] != "#":
+                            add = True
+
+                        if add:
+                            log.debug("Adding: {}".format(line))
+                            backup.write("{}\n".format(line))
+
+            #with open(pacman_mirror_file_backup, 'r', encoding="utf8") as f:
+            #    log.info("{}:".format(f.name))
+            #    for line in f:
+            #        line = line.strip()
+            #        print(line)
+
+            log.info("Ranking mirrors.. Please wait..")
+            with open(pacman_mirror_file_backup, 'r', encoding="utf8") as f:
+                servers = read_mirrorlist(f)
+
+            if args.mirror_cache_ttl > 0:
+                rankings = cached_rank_mirrors(servers, network_identity(config), args.mirror_count,
+                                               args.mirror_connections, args.mirror_timeout, args.mirror_cache,
+                                               args.mirror_cache_ttl)
+            else:
+                rankings = rank_mirrors(servers, args.mirror_count, args.mirror_connections, args.mirror_timeout)
+
+            if len(rankings) == 0:
+                log.error("No mirror responded")
+                sys.exit(1)
+
+            # add ranked mirrors to file
+            with open(pacman_mirror_file, 'w', encoding="utf8") as f:
+                f.write(format_mirrorlist(rankings))
+
+        if not (args.skip_mirrors or args.image):
+            journal.complete(STAGE_MIRRORS, mirrors_inputs, {"sha256": file_sha256(pacman_mirror_file)})
+
+    pacstrap_parameters = []
+    pacman_parameters = []
+    if args.prefetched:
+        # Use package cache of the running system instead of target's
+        pacstrap_parameters.append("-c")
+        pacman_parameters.append("--cachedir={}".format(args.cachedir))
+
+    if args.image:
+        boot_dir = os.path.join(args.prefix, "boot")
+
+        # /boot of the image is hidden under separately mounted boot partition
+        if os.path.ismount(boot_dir) and os.stat(boot_dir).st_dev != os.stat(args.prefix).st_dev:
+            with stage("Copying /boot from image"):
+                root_device = None
+                for p in block_device['children']:
+                    if p['mountpoint'] == args.prefix:
+                        root_device = "/dev/{}".format(p['name'])
+
+                if root_device is None:
+                    log.error("Nothing mounted at {}".format(args.prefix))
+                    sys.exit(1)
+
+                image_root = tempfile.mkdtemp(prefix="pyarchinstall-image.")
+                try:
+                    mount(root_device, image_root)
+                    try:
+                        log.info("Copying /boot from image to boot partition")
+                        # Boot partition is vfat: copy contents only, no metadata
+                        copy_files(os.path.join(image_root, "boot"), boot_dir)
+                    finally:
+                        unmount(image_root)
+                finally:
+                    os.rmdir(image_root)
+
+        set_parallel_downloads(os.path.join(args.prefix, PACMAN_CONF.lstrip("/")), target_parallel_downloads)
+    else:
+        with stage("Installing packages"):
+            set_parallel_downloads(LIVE_PACMAN_CONF, live_parallel_downloads)
+
+            # Everything in one transaction: one dependency resolution and one download burst
+            install_packages = package_set(packages)
+            packages_inputs = {"packages": install_packages, "parameters": pacstrap_parameters}
+
+            if (journal.done(STAGE_PACKAGES, packages_inputs) and
+                    os.path.isdir(os.path.join(args.prefix, PACMAN_LOCAL_DB.lstrip("/")))):
+                log.info("Packages are installed according to journal {}".format(journal.path))
+            else:
+                log.info("Installing {} packages: {}".format(len(install_packages), " ".join(install_packages)))
+                pacstrap(args.prefix, install_packages, pacstrap_parameters, pacman_parameters)
+                journal.complete(STAGE_PACKAGES, packages_inputs)
+
+            set_parallel_downloads(os.path.join(args.prefix, PACMAN_CONF.lstrip("/")), target_parallel_downloads)
+
+    with stage("Generating fstab"):
+        fstab = fstab_entries(block_device, entries)
+        fstab_file = os.path.join(args.prefix, "etc", "fstab")
+        os.makedirs(os.path.dirname(fstab_file), exist_ok=True)
+        write_file_atomic(fstab_file, format_fstab(fstab))
+        log.info("Wrote {} entries to {}".format(len(fstab), fstab_file))
+
+        if args.genfstab_check:
+            differences = compare_fstab(fstab, parse_fstab(genfstab(args.prefix).stdout.decode('utf8')))
+            for difference in differences:
+                log.warning("fstab differs from genfstab: {}".format(difference))
+            if len(differences) == 0:
+                log.info("fstab matches genfstab")
+
+    if config is None:
+        log.info("No config file. Skipping system configuration.")
+    else:
+        with stage("Configuring system"):
+            results = apply_configuration(configuration_steps(config, args.prefix), args.prefix)
+            log_configuration(results)
+
+        if any(result['error'] is not None for result in results):
+            sys.exit(1)
 
 
-    chroot(INSTALL_DIR_PREFIX)
\ No newline at end of file
+if __name__ == "__main__":
+    run(parse_arguments())
@@ -5,22 +5,24 @@ import logging
 log = logging.getLogger(__name__)
 
 from funcs import *
+from network import get_links, rank_links, log_links, apply_network, ONLINE_TIMEOUT
 
 __VERSION__ = "0.0.1"
 __AUTHOR__ = u"Pekka Järvinen"
 __YEAR__ = 2017
-__DESCRIPTION__ = u"Arch Installer - Partition generator. Version {0}.".format(__VERSION__)
+__DESCRIPTION__ = u"Arch Installer - Network uplink selection. Version {0}.".format(__VERSION__)
 __EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
 
 __EXAMPLES__ = [
     u'',
     u'-' * 60,
     u'%(prog)s',
+    u'%(prog)s --config install.ini',
     u'-' * 60,
 ]
 
-if __name__ == "__main__":
 
+def parse_arguments(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description=__DESCRIPTION__,
         epilog=__EPILOG__,
@@ -33,24 +35,62 @@ if __name__ == "__main__":
     optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
                           help="Be verbose. -vvv.. Be more verbose.")
 
+    optional.add_argument('--config <file.ini>', '-c', type=argparse.FileType('r', encoding="utf8"),
+                          dest='configfile', default=None,
+                          help='Config file. Fastest connected link is configured with its [network] section.')
+
+    optional.add_argument('--timeout <seconds>', type=float, dest='timeout', default=ONLINE_TIMEOUT,
+                          help='Wait this long for the configured link to come online. Default: {}.'.format(
+                              ONLINE_TIMEOUT))
+
+    optional.add_argument('--optional', action='store_true', dest='optional',
+                          help='No connected link is only a warning. For installs which do not download anything.')
+
     parser._action_groups.append(optional)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
 
+
+def run(args: argparse.Namespace):
     if int(args.verbose) > 0:
         logging.getLogger().setLevel(logging.DEBUG)
         log.info("Being verbose")
 
-    adapters = []
-    for dev in pathlib.Path("/sys/class/net/").resolve().iterdir():
-        dev = pathlib.Path(dev).resolve()
-        if os.path.basename(dev) == "lo":
-            continue
+    links = get_links()
+    log.info("Network links:")
+    log_links(links)
+
+    uplinks = rank_links(links)
+
+    if len(uplinks) == 0:
+        if args.optional:
+            log.warning("No connected network adapters found. Continuing without network.")
+            return
+        log.error("No connected network adapters found.")
+        sys.exit(1)
+
+    uplink = uplinks[0]
+    log.info("Using {} as uplink ({})".format(
+        uplink['name'], "{} Mb/s {}".format(uplink['speed'], uplink['duplex'] or "") if uplink['speed'] else
+        "unknown speed"))
+
+    if args.configfile is None:
+        return
+
+    config = load_config_file(args.configfile)
 
-        adapters.append(str(dev))
+    if not config.has_section("network"):
+        log.info("No [network] in config. Not configuring {}.".format(uplink['name']))
+        return
 
-    if len(adapters) == 0:
-        log.error("No network adapters found.")
+    try:
+        apply_network(config, uplink, timeout=args.timeout)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        log.error("Configuring {} failed: {}".format(uplink['name'], e))
         sys.exit(1)
 
-    print (adapters)
+    log.info("Configured {}".format(uplink['name']))
+
+
+if __name__ == "__main__":
+    run(parse_arguments())
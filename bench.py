@@ -0,0 +1,262 @@
+#!/bin/env/python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+from funcs import *
+
+import tempfile
+
+__VERSION__ = "0.0.1"
+__AUTHOR__ = u"Pekka Järvinen"
+__YEAR__ = 2017
+__DESCRIPTION__ = u"Arch Installer - Benchmark partition, mount and install stages. Version {0}.".format(__VERSION__)
+__EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
+
+__EXAMPLES__ = [
+    u'',
+    u'-' * 60,
+    u'%(prog)s',
+    u'%(prog)s --update-baseline',
+    u'%(prog)s --shims my-latencies.json --runs 5',
+    u'-' * 60,
+]
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(SCRIPT_DIR, "bench")
+SHIM = os.path.join(BENCH_DIR, "shim.py")
+SHIM_CONFIG = os.path.join(BENCH_DIR, "shims.json")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+SHIMMED_TOOLS = [
+    "sgdisk", "wipefs", "partprobe", "lsblk", "fdisk", "mkfs.ext4", "mkfs.fat", "mkswap", "swapon", "mount", "umount",
+    "pacman", "pacstrap", "rankmirrors", "genfstab", "arch-chroot", "locale-gen", "timedatectl", "systemctl",
+]
+
+# Regression when slower than baseline by both of these
+TOLERANCE = 0.2
+TOLERANCE_SECONDS = 0.05
+# Stands in for the live system's pacman.conf
+BENCH_PACMAN_CONF = "[options]\n#ParallelDownloads = 5\n"
+
+
+def attach_loop_device(image: str) -> str:
+    run = ["losetup", "--find", "--show", "--partscan", image]
+    log.debug("Running {}".format(" ".join(run)))
+    return subprocess.run(run, check=True, stdout=subprocess.PIPE).stdout.decode('utf8').strip()
+
+
+def detach_loop_device(device: str):
+    run = ["losetup", "--detach", device]
+    log.debug("Running {}".format(" ".join(run)))
+    subprocess.run(run, check=False, stdout=subprocess.PIPE)
+
+
+def make_shims(directory: str):
+    for tool in SHIMMED_TOOLS:
+        os.symlink(SHIM, os.path.join(directory, tool))
+
+
+def run_pipeline(device: str, workdir: str, env: dict, partitionsfile: str) -> dict:
+    """
+    Run 1part.py, 2mount.py and 3install.py against device. Returns {script: exit code}.
+    """
+    prefix = os.path.join(workdir, "root")
+
+    pipeline = [
+        ["1part.py", "--yes", "--partitions", partitionsfile, "--device", device],
+        ["2mount.py", "--prefix", prefix, "--partitions", partitionsfile, "--device", device],
+        ["3install.py", "--skip-mirrors", "--prefix", prefix, "--partitions", partitionsfile, "--packages",
+         os.path.join(SCRIPT_DIR, "packages.txt.dist"), "--config", os.path.join(SCRIPT_DIR, "install.ini.dist"),
+         "--device", device],
+    ]
+
+    results = {}
+
+    with open(os.path.join(workdir, "output.log"), 'a', encoding="utf8") as logfile:
+        for script in pipeline:
+            run = [sys.executable, os.path.join(SCRIPT_DIR, script[0])]
+            run.extend(script[1:])
+            log.info("Running {}".format(script[0]))
+            results[script[0]] = subprocess.run(run, cwd=workdir, env=env, stdin=subprocess.DEVNULL,
+                                                stdout=logfile, stderr=subprocess.STDOUT).returncode
+            if results[script[0]] != 0:
+                log.error("{} failed ({}). See {}".format(script[0], results[script[0]], logfile.name))
+                break
+
+    return results
+
+
+def stage_timings(events: list) -> dict:
+    """
+    Sum durations of trace events into {"<script>": s, "<script>/<stage>": s, "<script>/$ <tool>": s}.
+    """
+    scripts = {}
+    for event in events:
+        if event["type"] == "process":
+            scripts[event["pid"]] = event["name"]
+
+    timings = {}
+    for event in events:
+        script = scripts.get(event["pid"], str(event["pid"]))
+
+        if event["type"] == "process":
+            key = script
+        elif event["type"] == "stage":
+            key = "{}/{}".format(script, event["name"])
+        else:
+            key = "{}/$ {}".format(script, event["name"])
+
+        timings[key] = timings.get(key, 0) + event["duration"]
+
+    return timings
+
+
+def compare(timings: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+
+    for key in sorted(set(timings) | set(baseline)):
+        now = timings.get(key)
+        before = baseline.get(key)
+
+        if now is None:
+            status = "missing"
+        elif before is None:
+            status = "new"
+        elif now > before * (1 + tolerance) and now - before > TOLERANCE_SECONDS:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif now < before * (1 - tolerance) and before - now > TOLERANCE_SECONDS:
+            status = "faster"
+        else:
+            status = "ok"
+
+        log.info("  {:<45} {:>9} {:>9}  {}".format(
+            key, "-" if now is None else "{:.3f}".format(now), "-" if before is None else "{:.3f}".format(before),
+            status))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__DESCRIPTION__,
+        epilog=__EPILOG__,
+        usage=os.linesep.join(__EXAMPLES__),
+    )
+
+    optional = parser._action_groups.pop()
+
+    optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
+                          help="Be verbose. -vvv.. Be more verbose.")
+
+    optional.add_argument('--partitions <partitions.json>', '-p', dest='partitionsfile',
+                          default=os.path.join(SCRIPT_DIR, "partitions.json.dist"),
+                          help='Partitions JSON file. Default: partitions.json.dist.')
+
+    optional.add_argument('--shims <shims.json>', '-s', action=FullPaths, dest='shims', default=SHIM_CONFIG,
+                          help='Tool latencies and behaviour. Default: bench/shims.json.')
+
+    optional.add_argument('--baseline <baseline.json>', '-b', action=FullPaths, dest='baseline', default=BASELINE,
+                          help='Stored timings to compare against. Default: bench/baseline.json.')
+
+    optional.add_argument('--update-baseline', action='store_true', dest='update_baseline',
+                          help='Store timings of this run as the new baseline.')
+
+    optional.add_argument('--tolerance <fraction>', type=float, dest='tolerance', default=TOLERANCE,
+                          help='Allowed slowdown against baseline. Default: {}.'.format(TOLERANCE))
+
+    optional.add_argument('--runs <count>', '-r', type=int, dest='runs', default=1,
+                          help='Run pipeline this many times and use the fastest timing of each stage.')
+
+    optional.add_argument('--disk-size <size>', dest='disksize', default="4G",
+                          help='Size of sparse loop device image. Default: 4G.')
+
+    parser._action_groups.append(optional)
+
+    args = parser.parse_args()
+
+    if int(args.verbose) > 0:
+        logging.getLogger().setLevel(logging.DEBUG)
+        log.info("Being verbose")
+
+    sign, disksize = parse_sgdisk_size(args.disksize, 1)
+    partitionsfile = os.path.abspath(args.partitionsfile)
+
+    timings = {}
+    failed = False
+
+    for i in range(args.runs):
+        workdir = tempfile.mkdtemp(prefix="pyarchinstall-bench.")
+        image = os.path.join(workdir, "disk.img")
+        with open(image, 'wb') as f:
+            f.truncate(disksize)
+
+        try:
+            device = attach_loop_device(image)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.error("Loop devices are not available here ({}). Cannot run benchmark.".format(e))
+            sys.exit(2)
+
+        bindir = os.path.join(workdir, "bin")
+        os.makedirs(bindir)
+        make_shims(bindir)
+
+        env = dict(os.environ)
+        env["PATH"] = bindir + os.pathsep + env.get("PATH", "")
+        env["PYARCHINSTALL_SHIM_CONFIG"] = args.shims
+        env["PYARCHINSTALL_UDEV_DATA"] = os.path.join(workdir, "udev")
+        env["PYARCHINSTALL_TRACE"] = os.path.join(workdir, "trace")
+        env["PYARCHINSTALL_JOURNAL_DIR"] = os.path.join(workdir, "journal")
+        # 3install.py sets ParallelDownloads of the live pacman.conf
+        env["PYARCHINSTALL_PACMAN_CONF"] = os.path.join(workdir, "pacman.conf")
+        with open(env["PYARCHINSTALL_PACMAN_CONF"], 'w') as f:
+            f.write(BENCH_PACMAN_CONF)
+        os.makedirs(env["PYARCHINSTALL_UDEV_DATA"])
+
+        log.info("Run {}/{} on {}".format(i + 1, args.runs, device))
+
+        try:
+            results = run_pipeline(device, workdir, env, partitionsfile)
+        finally:
+            detach_loop_device(device)
+
+        try:
+            events = tracing.read_events(env["PYARCHINSTALL_TRACE"] + ".jsonl")
+        except FileNotFoundError:
+            events = []
+
+        if any(rc != 0 for rc in results.values()):
+            # Keep logs and trace for inspection
+            failed = True
+        else:
+            shutil.rmtree(workdir)
+
+        for key, value in stage_timings(events).items():
+            timings[key] = min(value, timings.get(key, value))
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r', encoding="utf8") as f:
+            baseline = json.load(f)
+
+    log.info("  {:<45} {:>9} {:>9}".format("stage", "seconds", "baseline"))
+    regressions = compare(timings, baseline, args.tolerance)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding="utf8") as f:
+            json.dump({k: round(v, 3) for k, v in sorted(timings.items())}, f, indent=2)
+            f.write("\n")
+        log.info("Baseline written to {}".format(args.baseline))
+
+    if failed:
+        log.error("Pipeline failed")
+        sys.exit(1)
+
+    if len(regressions) > 0 and not args.update_baseline:
+        log.error("{} stages regressed".format(len(regressions)))
+        sys.exit(1)
+
+    log.info("Done.")
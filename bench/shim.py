@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Stand-in for an external tool used by the installer. The tool is chosen by the name this file
+is run as (bench.py symlinks it as sgdisk, mkfs.ext4, ...).
+
+Behaviour comes from the JSON file in PYARCHINSTALL_SHIM_CONFIG:
+
+    {"mkfs.ext4": {"latency": 2.0, "returncode": 0}, "lsblk": {"passthrough": true}, ...}
+
+latency      seconds to sleep before doing anything
+returncode   exit code
+passthrough  run the real tool from PATH after the latency
+blkpg        (sgdisk only) create the requested partitions in the kernel with BLKPG ioctls
+             and write matching udev data to PYARCHINSTALL_UDEV_DATA, so a loop device
+             looks like it was really partitioned
+
+arch-chroot runs its command on the host with paths inside the root mapped to it, so that only
+shimmed tools are run.
+
+mkfs tools, mkswap and wipefs also record the filesystem type and UUID of a partition in the udev data.
+
+Otherwise the recorded output in outputs/<tool>.txt is replayed to stdout.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import fcntl
+import ctypes
+import struct
+import subprocess
+
+SHIM_DIR = os.path.dirname(os.path.realpath(__file__))
+OUTPUTS_DIR = os.path.join(SHIM_DIR, "outputs")
+
+BLKPG = 0x1269
+BLKPG_ADD_PARTITION = 1
+BLKPG_DEL_PARTITION = 2
+BLKGETSIZE64 = 0x80081272
+GPT_MAX_PARTITIONS = 128
+ALIGNMENT = 1024 * 1024
+# Backup GPT at the end of the disk
+GPT_BACKUP_BYTES = 33 * 512
+
+TYPE_GUIDS = {
+    "ef00": "c12a7328-f81f-11d2-ba4b-00a0c93ec93b",
+    "ef02": "21686148-6449-6e6f-744e-656564454649",
+    "8200": "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f",
+    "8300": "0fc63daf-8483-4772-8e79-3d69d8477de4",
+}
+# Filesystem type udev reports after the tool has run
+FSTYPES = {"mkfs.ext4": "ext4", "mkfs.fat": "vfat", "mkfs.xfs": "xfs", "mkfs.btrfs": "btrfs", "mkfs.f2fs": "f2fs",
+           "mkswap": "swap"}
+UNITS = {"": 512, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def blkpg(fd: int, op: int, number: int, start: int = 0, length: int = 0):
+    partition = ctypes.create_string_buffer(struct.pack("qqi64s64s", start, length, number, b"", b""))
+    arg = struct.pack("iiiP", op, 0, ctypes.sizeof(partition) - 1, ctypes.addressof(partition))
+    fcntl.ioctl(fd, BLKPG, arg)
+
+
+def partition_name(disk: str, number: int) -> str:
+    if disk[-1].isdigit():
+        return "{}p{}".format(disk, number)
+    return "{}{}".format(disk, number)
+
+
+def udev_path(udev_data: str, sysfs_name: str) -> str:
+    with open(os.path.join("/sys/class/block", sysfs_name, "dev"), 'r') as f:
+        return os.path.join(udev_data, "b{}".format(f.read().strip()))
+
+
+def udev_encode(value: str) -> str:
+    """
+    Escape value like udev does for ID_PART_ENTRY_NAME: unsafe characters become \\xNN.
+    """
+    encoded = []
+    for char in value:
+        # Valid UTF-8 outside ASCII is kept as is
+        if not char.isascii() or char.isalnum() or char in "#+-.:=@_":
+            encoded.append(char)
+        else:
+            encoded.append("\\x{:02x}".format(ord(char)))
+    return "".join(encoded)
+
+
+def write_udev(udev_data: str, sysfs_name: str, properties: dict, merge: bool = False):
+    """
+    Write udev properties of device. With merge existing properties are kept and None removes one.
+    """
+    path = udev_path(udev_data, sysfs_name)
+    current = {}
+
+    if merge and os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith("E:"):
+                    key, value = line[2:].rstrip("\n").split("=", 1)
+                    current[key] = value
+
+    current.update(properties)
+
+    with open(path, 'w') as f:
+        for key, value in current.items():
+            if value is not None:
+                f.write("E:{}={}\n".format(key, value))
+
+
+def record_fstype(tool: str, args: list):
+    udev_data = os.environ.get("PYARCHINSTALL_UDEV_DATA")
+    if udev_data is None or len(args) == 0:
+        return
+
+    name = os.path.basename(os.path.realpath(args[-1]))
+    if not os.path.exists(os.path.join("/sys/class/block", name, "partition")):
+        return
+
+    os.makedirs(udev_data, exist_ok=True)
+    fs_uuid = str(uuid.uuid4()) if tool in FSTYPES else None
+    write_udev(udev_data, name, {"ID_FS_TYPE": FSTYPES.get(tool), "ID_FS_UUID": fs_uuid}, merge=True)
+
+
+def sgdisk_blkpg(args: list):
+    device = args[-1]
+    disk = os.path.basename(os.path.realpath(device))
+    udev_data = os.environ.get("PYARCHINSTALL_UDEV_DATA")
+
+    if os.path.exists(os.path.join("/sys/class/block", disk, "partition")):
+        # Zapping a partition does not change the partition table
+        return
+
+    new = {}
+    types = {}
+    names = {}
+    delete = []
+    clear = False
+
+    for option, value in zip(args[:-1], args[1:-1]):
+        if option == "--new":
+            number, start, end = value.split(":")
+            new[int(number)] = (start, end)
+        elif option == "--typecode":
+            number, code = value.split(":")
+            types[int(number)] = code.lower()
+        elif option == "--change-name":
+            number, name = value.split(":", 1)
+            names[int(number)] = name
+        elif option == "--delete":
+            delete.append(int(value))
+
+    clear = "--zap-all" in args or "--clear" in args
+
+    # New table gets a random GUID unless one is given
+    disk_guid = str(uuid.uuid4()) if clear else None
+    for arg in args:
+        if arg.startswith("--disk-guid="):
+            disk_guid = arg.split("=", 1)[1]
+
+    # udev data is found by device number which goes away with the partition
+    for number in delete:
+        name = partition_name(disk, number)
+        if udev_data is not None and os.path.exists(os.path.join("/sys/class/block", name)):
+            path = udev_path(udev_data, name)
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    fd = os.open(device, os.O_RDWR)
+    try:
+        for number in delete:
+            blkpg(fd, BLKPG_DEL_PARTITION, number)
+
+        if clear:
+            for number in range(1, GPT_MAX_PARTITIONS + 1):
+                try:
+                    blkpg(fd, BLKPG_DEL_PARTITION, number)
+                except OSError:
+                    pass
+
+        disk_size = struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+        usable_end = (disk_size - GPT_BACKUP_BYTES) // ALIGNMENT * ALIGNMENT
+        offset = ALIGNMENT
+
+        for number in sorted(new):
+            start, end = new[number]
+            if start != "0" and end.isdigit():
+                # Absolute first and last sector
+                offset = int(start) * 512
+                size = (int(end) + 1) * 512 - offset
+            else:
+                m = re.match(r"^\+?(\d+)([KMGT]?)$", end, re.IGNORECASE)
+                size = int(m.group(1)) * UNITS[m.group(2).upper()]
+                if size == 0:
+                    size = usable_end - offset
+            blkpg(fd, BLKPG_ADD_PARTITION, number, offset, size)
+            offset += (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    finally:
+        os.close(fd)
+
+    if udev_data is None:
+        return
+
+    os.makedirs(udev_data, exist_ok=True)
+    table = {"ID_PART_TABLE_TYPE": "gpt"}
+    if disk_guid is not None:
+        table["ID_PART_TABLE_UUID"] = disk_guid
+    write_udev(udev_data, disk, table, merge=True)
+
+    for number in sorted(new):
+        write_udev(udev_data, partition_name(disk, number), {
+            "ID_PART_ENTRY_NUMBER": number,
+            "ID_PART_ENTRY_TYPE": TYPE_GUIDS.get(types.get(number, "8300"), TYPE_GUIDS["8300"]),
+            "ID_PART_ENTRY_NAME": udev_encode(names.get(number, "")),
+        })
+
+    # Changed in place
+    for number in sorted((set(types) | set(names)) - set(new)):
+        properties = {}
+        if number in types:
+            properties["ID_PART_ENTRY_TYPE"] = TYPE_GUIDS.get(types[number], TYPE_GUIDS["8300"])
+        if number in names:
+            properties["ID_PART_ENTRY_NAME"] = udev_encode(names[number])
+        write_udev(udev_data, partition_name(disk, number), properties, merge=True)
+
+
+def pacstrap_root(args: list):
+    """
+    Leave the local package database and pacman.conf (from package pacman) in the root
+    like real pacstrap does.
+    """
+    roots = [arg for arg in args if not arg.startswith("-")]
+    if len(roots) > 0 and os.path.isdir(roots[0]):
+        os.makedirs(os.path.join(roots[0], "var", "lib", "pacman", "local"), exist_ok=True)
+        os.makedirs(os.path.join(roots[0], "etc"), exist_ok=True)
+        with open(os.path.join(roots[0], "etc", "pacman.conf"), 'w') as f:
+            f.write("[options]\nHoldPkg = pacman glibc\n")
+
+
+def arch_chroot(args: list) -> int:
+    root = args[0]
+    run = [args[1]]
+
+    for arg in args[2:]:
+        if arg.startswith("/") and os.path.exists(os.path.join(root, arg.lstrip("/"))):
+            arg = os.path.join(root, arg.lstrip("/"))
+        run.append(arg)
+
+    return subprocess.run(run).returncode
+
+
+def real_tool(tool: str) -> str:
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, tool)
+        if os.path.realpath(path) == os.path.realpath(__file__):
+            continue
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise FileNotFoundError("Real {} not found".format(tool))
+
+
+def main() -> int:
+    tool = os.path.basename(sys.argv[0])
+    config = {}
+
+    path = os.environ.get("PYARCHINSTALL_SHIM_CONFIG")
+    if path is not None:
+        with open(path, 'r') as f:
+            config = json.load(f).get(tool, {})
+
+    time.sleep(config.get("latency", 0))
+
+    if config.get("passthrough", False):
+        real = real_tool(tool)
+        os.execv(real, [real] + sys.argv[1:])
+
+    if tool == "sgdisk" and config.get("blkpg", False) and len(sys.argv) > 1:
+        sgdisk_blkpg(sys.argv[1:])
+
+    if tool in FSTYPES or (tool == "wipefs" and "-a" in sys.argv[1:]):
+        record_fstype(tool, sys.argv[1:])
+
+    if tool == "pacstrap":
+        pacstrap_root(sys.argv[1:])
+
+    if tool == "arch-chroot" and len(sys.argv) > 2:
+        return arch_chroot(sys.argv[1:])
+
+    output = os.path.join(OUTPUTS_DIR, "{}.txt".format(tool))
+    if os.path.isfile(output):
+        with open(output, 'r') as f:
+            sys.stdout.write(f.read())
+
+    return config.get("returncode", 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
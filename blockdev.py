@@ -0,0 +1,376 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import re
+import grp
+import time
+import select
+import socket
+import struct
+
+SYSFS_BLOCK = "/sys/class/block"
+# Overridable so benchmarks can provide udev data for loop devices
+UDEV_DATA = os.environ.get("PYARCHINSTALL_UDEV_DATA", "/run/udev/data")
+MOUNTINFO = "/proc/self/mountinfo"
+PROC_SWAPS = "/proc/swaps"
+
+# lsblk -O -J -b key: udev property
+UDEV_KEYS = {
+    "fstype": "ID_FS_TYPE",
+    "uuid": "ID_FS_UUID",
+    "label": "ID_FS_LABEL_ENC",
+    "parttype": "ID_PART_ENTRY_TYPE",
+    "partuuid": "ID_PART_ENTRY_UUID",
+    "partlabel": "ID_PART_ENTRY_NAME",
+    "pttype": "ID_PART_TABLE_TYPE",
+    "ptuuid": "ID_PART_TABLE_UUID",
+}
+
+# lsblk -O -J -b key: sysfs file relative to device directory
+SYSFS_INT_KEYS = {
+    "log-sec": "queue/logical_block_size",
+    "phy-sec": "queue/physical_block_size",
+    "min-io": "queue/minimum_io_size",
+    "opt-io": "queue/optimal_io_size",
+    "alignment": "alignment_offset",
+    "disc-aln": "discard_alignment",
+    "disc-gran": "queue/discard_granularity",
+    "disc-max": "queue/discard_max_bytes",
+    # Not in lsblk
+    "wzeroes": "queue/write_zeroes_max_bytes",
+    "rota": "queue/rotational",
+    "ro": "ro",
+    "rm": "removable",
+}
+
+SCSI_TYPE_ROM = "5"
+
+# Properties udev stores with unsafe characters (also space) escaped as \xNN
+UDEV_ENCODED = ("ID_PART_ENTRY_NAME", "ID_FS_LABEL_ENC")
+UDEV_ESCAPE_RE = re.compile(rb"\\x([0-9a-fA-F]{2})")
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+# Events re-broadcast by udevd after it has processed them
+UEVENT_GROUP_UDEV = 2
+UDEV_CONTROL = "/run/udev/control"
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+
+
+class SysfsUnavailable(Exception):
+    pass
+
+
+def _read(path: str) -> str:
+    with open(path, 'r', encoding="utf8") as f:
+        return f.read().strip()
+
+
+def _unescape(value: str) -> str:
+    # mountinfo escapes space, tab, newline and backslash as octal
+    for code, char in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")):
+        value = value.replace(code, char)
+    return value
+
+
+def read_mounts(mountinfo: str = MOUNTINFO, swaps: str = PROC_SWAPS) -> dict:
+    """
+    Return {"major:minor": mountpoint} of mounted block devices. Active swap is "[SWAP]" like in lsblk.
+    """
+    mounts = {}
+
+    with open(mountinfo, 'r', encoding="utf8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 5 or fields[2] in mounts:
+                continue
+            mounts[fields[2]] = _unescape(fields[4])
+
+    try:
+        with open(swaps, 'r', encoding="utf8") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                try:
+                    st = os.stat(_unescape(fields[0]))
+                except OSError:
+                    continue
+                mounts["{}:{}".format(os.major(st.st_rdev), os.minor(st.st_rdev))] = "[SWAP]"
+    except (FileNotFoundError, StopIteration):
+        pass
+
+    return mounts
+
+
+def udev_decode(value: str) -> str:
+    """
+    Undo udev's \\xNN escaping: "EFI\\x20System" -> "EFI System".
+    """
+    data = UDEV_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 16)]), value.encode('utf8'))
+    return data.decode('utf8', 'replace')
+
+
+def read_udev(devnum: str, udev_data: str = UDEV_DATA) -> dict:
+    """
+    Properties of device from udev database. Escaped values (UDEV_ENCODED) are decoded.
+    """
+    path = os.path.join(udev_data, "b{}".format(devnum))
+
+    try:
+        with open(path, 'r', encoding="utf8") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        raise SysfsUnavailable("No udev data for {}".format(devnum))
+
+    properties = {}
+    for line in lines:
+        if line.startswith("E:"):
+            key, _, value = line[2:].partition("=")
+            properties[key] = udev_decode(value) if key in UDEV_ENCODED else value
+
+    return properties
+
+
+def _group(name: str) -> str:
+    try:
+        return grp.getgrgid(os.stat(os.path.join("/dev", name)).st_gid).gr_name
+    except (OSError, KeyError):
+        return None
+
+
+def _device(path: str, mounts: dict, udev_data: str) -> dict:
+    name = os.path.basename(path)
+    devnum = _read(os.path.join(path, "dev"))
+    is_partition = os.path.isfile(os.path.join(path, "partition"))
+
+    if is_partition:
+        # Queue limits live in parent disk
+        queue_path = os.path.dirname(os.path.realpath(path))
+        devtype = "part"
+    else:
+        queue_path = path
+        devtype = "disk"
+        if name.startswith("loop"):
+            devtype = "loop"
+        elif name.startswith("sr") or (os.path.isfile(os.path.join(path, "device", "type")) and
+                                       _read(os.path.join(path, "device", "type")) == SCSI_TYPE_ROM):
+            devtype = "rom"
+
+    device = {
+        "name": name,
+        "kname": name,
+        "path": os.path.join("/dev", name),
+        "maj:min": devnum,
+        "type": devtype,
+        "group": _group(name),
+        # Always counted in 512 byte sectors
+        "size": int(_read(os.path.join(path, "size"))) * 512,
+        "mountpoint": mounts.get(devnum),
+    }
+
+    for key, relpath in SYSFS_INT_KEYS.items():
+        base = path if os.path.exists(os.path.join(path, relpath)) else queue_path
+        try:
+            device[key] = int(_read(os.path.join(base, relpath)))
+        except (OSError, ValueError):
+            device[key] = None
+
+    for key in ("rota", "ro", "rm"):
+        if device[key] is not None:
+            device[key] = device[key] == 1
+
+    if is_partition:
+        device["partn"] = int(_read(os.path.join(path, "partition")))
+        device["start"] = int(_read(os.path.join(path, "start")))
+
+    udev = read_udev(devnum, udev_data)
+    for key, prop in UDEV_KEYS.items():
+        device[key] = udev.get(prop)
+
+    if device["parttype"] is not None:
+        device["parttype"] = device["parttype"].lower()
+
+    return device
+
+
+def read_block_device(device: str, sysfs_block: str = SYSFS_BLOCK, udev_data: str = UDEV_DATA,
+                      mountinfo: str = MOUNTINFO, swaps: str = PROC_SWAPS) -> dict:
+    """
+    Read block device and its partitions from sysfs, udev database and mountinfo.
+    Returned dict has the same keys as lsblk -O -J -b for the fields used by the installer.
+    Raises SysfsUnavailable when some information is not available.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    path = os.path.join(sysfs_block, name)
+
+    if not os.path.isdir(path) or not os.path.isdir(udev_data):
+        raise SysfsUnavailable("No sysfs entry for {}".format(device))
+
+    mounts = read_mounts(mountinfo, swaps)
+    data = _device(path, mounts, udev_data)
+
+    children = []
+    for entry in os.listdir(path):
+        if os.path.isfile(os.path.join(path, entry, "partition")):
+            children.append(_device(os.path.join(path, entry), mounts, udev_data))
+
+    if len(children) > 0:
+        children.sort(key=lambda c: c["partn"])
+        data["children"] = children
+
+    return data
+
+
+def partition_name(disk: str, number: int) -> str:
+    """
+    Kernel name of partition 'number' of disk: sda -> sda1, nvme0n1 -> nvme0n1p1.
+    """
+    disk = os.path.basename(os.path.realpath(disk))
+
+    if disk[-1].isdigit():
+        return "{}p{}".format(disk, number)
+
+    return "{}{}".format(disk, number)
+
+
+def parse_uevent(data: bytes) -> dict:
+    """
+    Parse kernel ("add@/devices/...") or udevd ("libudev") uevent message into properties.
+    """
+    if data.startswith(b"libudev\0"):
+        magic, = struct.unpack_from(">I", data, 8)
+        if magic != UDEV_MONITOR_MAGIC:
+            return {}
+        _, properties_off, properties_len = struct.unpack_from("=III", data, 12)
+        data = data[properties_off:properties_off + properties_len]
+    elif b"@" in data.split(b"\0", 1)[0]:
+        data = data.split(b"\0", 1)[1] if b"\0" in data else b""
+    else:
+        return {}
+
+    properties = {}
+    for item in data.split(b"\0"):
+        key, sep, value = item.decode("utf8", "replace").partition("=")
+        if sep != "":
+            properties[key] = value
+
+    return properties
+
+
+class PartitionWatcher:
+    """
+    Wait for partition device nodes using uevents from netlink instead of polling.
+    Open before the command that creates partitions (partprobe) so no event is missed:
+
+        with PartitionWatcher() as watcher:
+            partprobe(device)
+            for name in watcher.wait(names, timeout, expected):
+                ...
+
+    When udevd is running, udev's re-broadcast events are used and a partition is
+    ready only after its udev data describes the new partition table.
+    """
+
+    def __init__(self, sysfs_block: str = SYSFS_BLOCK, udev_data: str = UDEV_DATA, dev: str = "/dev"):
+        self.sysfs_block = sysfs_block
+        self.udev_data = udev_data
+        self.dev = dev
+        self.use_udev = os.path.exists(UDEV_CONTROL)
+        self.sock = None
+        self.pending = []
+        self.expected = {}
+
+    def __enter__(self):
+        group = UEVENT_GROUP_UDEV if self.use_udev else UEVENT_GROUP_KERNEL
+
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, group))
+        except OSError as e:
+            log.warning("Cannot listen uevents ({}). Checking partitions every second.".format(e))
+            self.close()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def ready(self, name: str) -> bool:
+        try:
+            devnum = _read(os.path.join(self.sysfs_block, name, "dev"))
+        except OSError:
+            return False
+
+        if not os.path.exists(os.path.join(self.dev, name)):
+            return False
+
+        if not self.use_udev:
+            return True
+
+        try:
+            properties = read_udev(devnum, self.udev_data)
+        except SysfsUnavailable:
+            return False
+
+        # udev data of the previous partition table stays until udev has processed the new one
+        for key, value in self.expected.get(name, {}).items():
+            if value is None:
+                continue
+            current = properties.get(UDEV_KEYS[key], "")
+            # Type GUIDs are compared case-insensitively like _device() lowercases them
+            if key == "parttype":
+                current, value = current.lower(), value.lower()
+            if current != value:
+                return False
+
+        return True
+
+    def wait(self, names: list, timeout: float, expected: dict = None):
+        """
+        Yield each partition in names as soon as it is ready, until all are ready or
+        timeout seconds have passed. Partitions which did not become ready are left in self.pending.
+        expected is {name: {"partlabel": str, "parttype": str}} of the new partition table; udev
+        data must match it before a partition is ready.
+        """
+        deadline = time.monotonic() + timeout
+        self.pending = list(names)
+        self.expected = expected or {}
+
+        while True:
+            for name in list(self.pending):
+                if self.ready(name):
+                    self.pending.remove(name)
+                    log.debug("Partition {} is ready".format(name))
+                    yield name
+
+            remaining = deadline - time.monotonic()
+
+            if len(self.pending) == 0 or remaining <= 0:
+                return
+
+            if self.sock is None:
+                time.sleep(min(1.0, remaining))
+                continue
+
+            readable, _, _ = select.select([self.sock], [], [], remaining)
+
+            # Drain every queued event; readiness is checked from sysfs afterwards
+            while readable:
+                try:
+                    event = parse_uevent(self.sock.recv(65536))
+                except OSError as e:
+                    # Receive buffer overflowed (ENOBUFS). Lost events do not matter.
+                    log.debug("uevent: {}".format(e))
+                    event = {}
+                if event.get("SUBSYSTEM") == "block":
+                    log.debug("uevent {} {}".format(event.get("ACTION"), event.get("DEVNAME")))
+                readable, _, _ = select.select([self.sock], [], [], 0)
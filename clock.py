@@ -0,0 +1,183 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import time
+import errno
+import ctypes
+import struct
+import asyncio
+
+from runner import stream_run
+
+TIMESYNCD_CONF_DIR = "/etc/systemd/timesyncd.conf.d"
+TIMESYNCD_CONF_FILE = "pyarchinstall.conf"
+# systemd-timesyncd touches 'synchronized' here whenever it has synchronized the clock
+TIMESYNC_DIR = "/run/systemd/timesync"
+CLOCK_SYNC_TIMEOUT = 120
+# adjtimex() is a cheap syscall. Re-check now and then in case the kernel state changed
+# without the clock being stepped or timesyncd being involved (e.g. ntpd or chronyd).
+CLOCK_RECHECK_INTERVAL = 5.0
+
+# <sys/timex.h>
+TIME_ERROR = 5
+# Large enough for struct timex on every architecture
+TIMEX_SIZE = 512
+
+# <sys/timerfd.h>, <sys/inotify.h>
+CLOCK_REALTIME = 0
+TFD_NONBLOCK = os.O_NONBLOCK
+TFD_CLOEXEC = os.O_CLOEXEC
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def clock_synchronized() -> bool:
+    """
+    Ask kernel if system clock is synchronized (adjtimex() does not return TIME_ERROR).
+    """
+    timex = ctypes.create_string_buffer(TIMEX_SIZE)
+    state = _libc.adjtimex(timex)
+
+    if state == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    return state != TIME_ERROR
+
+
+def _clock_set_fd() -> int:
+    """
+    timerfd which becomes readable when CLOCK_REALTIME is set (stepped).
+    """
+    fd = _libc.timerfd_create(CLOCK_REALTIME, TFD_NONBLOCK | TFD_CLOEXEC)
+
+    if fd == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    try:
+        _arm_clock_set_fd(fd)
+    except OSError:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def _arm_clock_set_fd(fd: int):
+    # Expire at the end of time; only cancellation by a clock change wakes us up
+    spec = struct.pack("qqqq", 0, 0, 2 ** 62, 0)
+
+    if _libc.timerfd_settime(fd, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET, spec, None) == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def _timesync_fd() -> int:
+    """
+    inotify fd which becomes readable when systemd-timesyncd reports synchronization.
+    """
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+    if fd == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    wd = _libc.inotify_add_watch(fd, TIMESYNC_DIR.encode(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB)
+
+    if wd == -1:
+        e = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(e, os.strerror(e))
+
+    return fd
+
+
+def configure_ntp(server: str, conf_dir: str = TIMESYNCD_CONF_DIR):
+    """
+    Point systemd-timesyncd at server and restart it.
+    """
+    os.makedirs(conf_dir, exist_ok=True)
+
+    with open(os.path.join(conf_dir, TIMESYNCD_CONF_FILE), 'w', encoding="utf8") as f:
+        f.write("[Time]\nNTP={}\n".format(server))
+
+    run = ["systemctl", "restart", "systemd-timesyncd"]
+    log.debug("Running {}".format(" ".join(run)))
+    stream_run(run, timeout=30, check=True)
+
+
+def enable_ntp():
+    run = ["timedatectl", "set-ntp", "true"]
+    log.debug("Running {}".format(" ".join(run)))
+    stream_run(run, timeout=10, check=True)
+
+
+async def wait_clock_sync(timeout: float = CLOCK_SYNC_TIMEOUT) -> bool:
+    """
+    Wait until system clock is synchronized or timeout seconds have passed.
+    Wakes up when the clock is stepped (timerfd) or timesyncd reports synchronization (inotify)
+    instead of spawning timedatectl in a loop. Returns True if clock was synchronized.
+    """
+    if clock_synchronized():
+        return True
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    wakeup = asyncio.Event()
+    fds = []
+
+    def clock_set(fd):
+        try:
+            os.read(fd, 8)
+        except OSError as e:
+            if e.errno == errno.ECANCELED:
+                _arm_clock_set_fd(fd)
+            elif e.errno != errno.EAGAIN:
+                raise
+        wakeup.set()
+
+    def timesync(fd):
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            pass
+        wakeup.set()
+
+    for create, callback in ((_clock_set_fd, clock_set), (_timesync_fd, timesync)):
+        try:
+            fd = create()
+        except OSError as e:
+            log.debug("{}: {}".format(create.__name__, e))
+            continue
+        fds.append(fd)
+        loop.add_reader(fd, callback, fd)
+
+    try:
+        while not clock_synchronized():
+            remaining = deadline - loop.time()
+
+            if remaining <= 0:
+                return False
+
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), min(remaining, CLOCK_RECHECK_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for fd in fds:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+    return True
@@ -0,0 +1,276 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import re
+import time
+import shlex
+import configparser
+
+from funcs import write_file_atomic, arch_chroot
+from clock import TIMESYNCD_CONF_DIR, TIMESYNCD_CONF_FILE
+
+# Written to the installation and run with one arch-chroot
+CONFIGURE_SCRIPT = "/root/pyarchinstall-configure.sh"
+# Lines the script prints around every step: "@@pyarchinstall-step begin|end <step> <epoch> [<exit code>]"
+STEP_MARKER = "@@pyarchinstall-step"
+STEP_MARKER_RE = re.compile(r"^" + re.escape(STEP_MARKER) + r" (begin|end) (\S+) (\S+)(?: (\d+))?$")
+# Output lines shown for a failed step
+STEP_ERROR_LINES = 10
+
+NETWORK_UNIT = "/etc/systemd/network/20-pyarchinstall.network"
+
+
+def _set_locale_gen(text: str, locale: str) -> str:
+    """
+    locale.gen with locale enabled.
+    """
+    charset = locale.split(".", 1)[1] if "." in locale else "UTF-8"
+    entry = "{} {}".format(locale, charset)
+    lines = text.split("\n")
+
+    for idx, line in enumerate(lines):
+        if line.lstrip("#").strip() == entry:
+            lines[idx] = entry
+            return "\n".join(lines)
+
+    if text.strip() == "":
+        return entry + "\n"
+
+    return text.rstrip("\n") + "\n{}\n".format(entry)
+
+
+def network_unit(config: configparser.ConfigParser, interface: str = None, route_metric: int = None) -> str:
+    """
+    systemd-networkd unit of install.ini [network]: dhcp (on/off), ipv4 (address/prefix),
+    gateway and dns. Matches every Ethernet link, or only interface when it is given.
+    """
+    network = config["network"]
+    lines = ["[Match]", "Type=ether" if interface is None else "Name={}".format(interface), "", "[Network]"]
+
+    dhcp = network.getboolean("dhcp", fallback=True)
+    if dhcp:
+        lines.append("DHCP=yes")
+
+    if network.get("ipv4", "").strip() != "":
+        lines.append("Address={}".format(network["ipv4"].strip()))
+
+    gateway = network.get("gateway", "").strip()
+    # Gateway with a metric needs its own [Route] section
+    if gateway != "" and route_metric is None:
+        lines.append("Gateway={}".format(gateway))
+
+    for dns in network.get("dns", "").split():
+        lines.append("DNS={}".format(dns))
+
+    if route_metric is not None:
+        if dhcp:
+            lines.extend(["", "[DHCPv4]", "RouteMetric={}".format(route_metric)])
+        if gateway != "":
+            lines.extend(["", "[Route]", "Gateway={}".format(gateway), "Metric={}".format(route_metric)])
+
+    return "\n".join(lines) + "\n"
+
+
+def configuration_steps(config: configparser.ConfigParser, prefix: str) -> list:
+    """
+    Post-install steps of install.ini. A step is
+    {"name": str, "files": {path: contents}, "links": {path: target}, "commands": [[argv]]}:
+    files and links are written directly into prefix, commands run inside it.
+    """
+    steps = []
+
+    if config.has_section("locale"):
+        locale = config.get("locale", "locale", fallback="").strip()
+        if locale != "":
+            locale_gen = ""
+            if os.path.isfile(os.path.join(prefix, "etc", "locale.gen")):
+                with open(os.path.join(prefix, "etc", "locale.gen"), 'r', encoding="utf8") as f:
+                    locale_gen = f.read()
+
+            steps.append({
+                "name": "locale",
+                "files": {
+                    "/etc/locale.conf": "LANG={}\n".format(locale),
+                    "/etc/locale.gen": _set_locale_gen(locale_gen, locale),
+                },
+                "links": {},
+                "commands": [["locale-gen"]],
+            })
+
+        keyboard = config.get("locale", "keyboard", fallback="").strip()
+        if keyboard != "":
+            steps.append({
+                "name": "keyboard",
+                "files": {"/etc/vconsole.conf": "KEYMAP={}\n".format(keyboard)},
+                "links": {},
+                "commands": [],
+            })
+
+    if config.has_section("time"):
+        files = {}
+        links = {}
+
+        ntp = config.get("time", "ntp", fallback="").strip()
+        if ntp != "":
+            files[os.path.join(TIMESYNCD_CONF_DIR, TIMESYNCD_CONF_FILE)] = "[Time]\nNTP={}\n".format(ntp)
+
+        timezone = config.get("time", "timezone", fallback="").strip()
+        if timezone != "":
+            links["/etc/localtime"] = os.path.join("/usr/share/zoneinfo", timezone)
+
+        steps.append({
+            "name": "time",
+            "files": files,
+            "links": links,
+            "commands": [["systemctl", "enable", "systemd-timesyncd.service"]],
+        })
+
+    if config.has_section("network"):
+        steps.append({
+            "name": "network",
+            "files": {NETWORK_UNIT: network_unit(config)},
+            "links": {},
+            "commands": [["systemctl", "enable", "systemd-networkd.service", "systemd-resolved.service"]],
+        })
+
+    return steps
+
+
+def render_script(steps: list) -> str:
+    """
+    Shell script running commands of steps. Every step runs in its own subshell which stops
+    at the first failing command; the next step runs anyway.
+    """
+    lines = [
+        "#!/bin/bash",
+        "# Generated by pyarchinstall",
+        "# Step timestamps with a decimal point",
+        "LC_NUMERIC=C",
+        "failed=0",
+    ]
+
+    for step in steps:
+        if len(step['commands']) == 0:
+            continue
+
+        lines.append("")
+        lines.append("printf '{} begin %s %s\\n' {} \"$EPOCHREALTIME\"".format(STEP_MARKER, shlex.quote(step['name'])))
+        lines.append("(")
+        lines.append("set -e")
+        for command in step['commands']:
+            lines.append(" ".join(shlex.quote(arg) for arg in command))
+        lines.append(") 2>&1")
+        lines.append("rc=$?")
+        lines.append("printf '{} end %s %s %s\\n' {} \"$EPOCHREALTIME\" \"$rc\"".format(
+            STEP_MARKER, shlex.quote(step['name'])))
+        lines.append("[ $rc -eq 0 ] || failed=1")
+
+    lines.append("")
+    lines.append("exit $failed")
+
+    return "\n".join(lines) + "\n"
+
+
+def parse_script_output(output: str) -> dict:
+    """
+    {step: {"seconds": float, "returncode": int, "output": [lines]}} from output of render_script().
+    """
+    results = {}
+    current = None
+    begin = None
+
+    for line in output.split("\n"):
+        m = STEP_MARKER_RE.match(line)
+
+        if m is None:
+            if current is not None:
+                results[current]["output"].append(line)
+            continue
+
+        kind, name, epoch, returncode = m.groups()
+
+        if kind == "begin":
+            current = name
+            begin = float(epoch)
+            results[name] = {"seconds": None, "returncode": None, "output": []}
+        elif name == current:
+            results[name]["seconds"] = float(epoch) - begin
+            results[name]["returncode"] = int(returncode)
+            current = None
+
+    return results
+
+
+def _write_step_files(step: dict, prefix: str):
+    for path, contents in step['files'].items():
+        target = os.path.join(prefix, path.lstrip("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        write_file_atomic(target, contents)
+
+    for path, destination in step['links'].items():
+        target = os.path.join(prefix, path.lstrip("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.unlink(target)
+        os.symlink(destination, target)
+
+
+def apply_configuration(steps: list, prefix: str) -> list:
+    """
+    Write files of every step into prefix, then run commands of all steps with one arch-chroot.
+    Returns [{"name": step, "seconds": float, "error": None or str}] in step order.
+    A step whose files could not be written does not run its commands.
+    """
+    results = {}
+
+    for step in steps:
+        start = time.monotonic()
+        error = None
+        try:
+            _write_step_files(step, prefix)
+        except OSError as e:
+            error = "Writing files failed: {}".format(e)
+        results[step['name']] = {"name": step['name'], "seconds": time.monotonic() - start, "error": error}
+
+    chrooted = [step for step in steps if len(step['commands']) > 0 and results[step['name']]['error'] is None]
+
+    if len(chrooted) > 0:
+        script = os.path.join(prefix, CONFIGURE_SCRIPT.lstrip("/"))
+        os.makedirs(os.path.dirname(script), exist_ok=True)
+        write_file_atomic(script, render_script(chrooted), 0o700)
+
+        try:
+            chroot_run = arch_chroot(prefix, ["/bin/bash", CONFIGURE_SCRIPT])
+        finally:
+            os.unlink(script)
+
+        outputs = parse_script_output(chroot_run.stdout.decode('utf8', 'replace'))
+
+        for step in chrooted:
+            result = results[step['name']]
+            output = outputs.get(step['name'])
+
+            if output is None or output['returncode'] is None:
+                result['error'] = "Did not run (arch-chroot exit code {})".format(chroot_run.returncode)
+                continue
+
+            result['seconds'] += output['seconds']
+
+            if output['returncode'] != 0:
+                tail = [line for line in output['output'] if line.strip() != ""][-STEP_ERROR_LINES:]
+                result['error'] = "Exit code {}: {}".format(output['returncode'], " / ".join(tail))
+
+    return [results[step['name']] for step in steps]
+
+
+def log_configuration(results: list):
+    failed = [result for result in results if result['error'] is not None]
+    log.info("Configuring system: {} ok, {} failed".format(len(results) - len(failed), len(failed)))
+
+    for result in results:
+        if result['error'] is None:
+            log.info("    {:<12} {:>8.3f}s".format(result['name'], result['seconds']))
+        else:
+            log.error("    {:<12} {:>8.3f}s {}".format(result['name'], result['seconds'], result['error']))
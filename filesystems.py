@@ -0,0 +1,182 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+from wipe import WIPE_ZEROOUT, WIPE_DISCARD, WIPE_SECDISCARD, mkfs_ext4_options
+
+# ext4 and xfs block size used for stride and stripe width
+FS_BLOCK_SIZE = 4096
+
+DEFAULT_PROFILE = "default"
+
+
+def raid_geometry(topology: dict) -> tuple:
+    """
+    (chunk, stripe) in bytes from device minimum and optimal I/O sizes, or None when
+    the device does not look like a striped array.
+    """
+    min_io = int(topology.get('min-io') or 0)
+    opt_io = int(topology.get('opt-io') or 0)
+
+    if min_io <= FS_BLOCK_SIZE:
+        return None
+
+    if opt_io < min_io or opt_io % min_io != 0:
+        opt_io = min_io
+
+    return min_io, opt_io
+
+
+class Filesystem:
+    """
+    mkfs command and mount options of a filesystem. profiles are
+    {name: {"mkfs": [parameters], "mount": [options]}} and partitions.json selects one with
+    "profile" (default: "default").
+    """
+
+    name = None
+    mkfs = None
+    # Tools the installed system needs for fsck
+    package = None
+    # False when fsck of the filesystem does nothing at boot (fstab pass 0)
+    fsck = True
+    profiles = {}
+
+    def profile(self, name: str) -> dict:
+        if name not in self.profiles:
+            raise ValueError("Unknown {} profile '{}'. Profiles: {}".format(
+                self.name, name, ", ".join(sorted(self.profiles))))
+        return self.profiles[name]
+
+    def mkfs_command(self, device: str, profile: str = DEFAULT_PROFILE, wiped: str = None,
+                     topology: dict = None) -> list:
+        """
+        wiped is the wipe method used on the device, topology the partition from device model.
+        """
+        run = [self.mkfs]
+        run.extend(self.profile(profile).get("mkfs", []))
+        run.extend(self.wipe_parameters(wiped))
+        run.extend(self.topology_parameters(topology or {}))
+        run.append(device)
+        return run
+
+    def mount_options(self, profile: str = DEFAULT_PROFILE) -> list:
+        return list(self.profile(profile).get("mount", []))
+
+    def wipe_parameters(self, wiped: str) -> list:
+        return []
+
+    def topology_parameters(self, topology: dict) -> list:
+        return []
+
+
+class Vfat(Filesystem):
+    name = "vfat"
+    mkfs = "mkfs.fat"
+    package = "dosfstools"
+    profiles = {
+        # EFI system partition
+        "default": {"mkfs": ["-F", "32"], "mount": ["fmask=0077", "dmask=0077"]},
+    }
+
+
+class Ext4(Filesystem):
+    name = "ext4"
+    mkfs = "mkfs.ext4"
+    package = "e2fsprogs"
+    profiles = {
+        "default": {"mkfs": [], "extended": [], "mount": []},
+        # Inode tables and journal initialized lazily by kernel, fast commits, fewer journal commits
+        "fast": {"mkfs": ["-O", "fast_commit"], "extended": ["lazy_itable_init=1", "lazy_journal_init=1"],
+                 "mount": ["noatime", "commit=30"]},
+    }
+
+    def mkfs_command(self, device: str, profile: str = DEFAULT_PROFILE, wiped: str = None,
+                     topology: dict = None) -> list:
+        # mke2fs uses only the last -E so every extended option goes to one
+        extended = list(self.profile(profile).get("extended", []))
+        extended.extend(mkfs_ext4_options(wiped))
+
+        geometry = raid_geometry(topology or {})
+        if geometry is not None:
+            extended.append("stride={}".format(geometry[0] // FS_BLOCK_SIZE))
+            extended.append("stripe_width={}".format(geometry[1] // FS_BLOCK_SIZE))
+
+        run = [self.mkfs]
+        run.extend(self.profile(profile).get("mkfs", []))
+        if len(extended) > 0:
+            run.extend(["-E", ",".join(extended)])
+        run.append(device)
+        return run
+
+
+class Xfs(Filesystem):
+    name = "xfs"
+    mkfs = "mkfs.xfs"
+    package = "xfsprogs"
+    fsck = False
+    profiles = {
+        "default": {"mkfs": ["-f"], "mount": []},
+        "fast": {"mkfs": ["-f"], "mount": ["noatime", "logbufs=8", "logbsize=256k"]},
+    }
+
+    def wipe_parameters(self, wiped: str) -> list:
+        if wiped in (WIPE_ZEROOUT, WIPE_DISCARD, WIPE_SECDISCARD):
+            return ["-K"]
+        return []
+
+    def topology_parameters(self, topology: dict) -> list:
+        geometry = raid_geometry(topology)
+        if geometry is None:
+            return []
+        return ["-d", "su={}k,sw={}".format(geometry[0] // 1024, geometry[1] // geometry[0])]
+
+
+class Btrfs(Filesystem):
+    name = "btrfs"
+    mkfs = "mkfs.btrfs"
+    package = "btrfs-progs"
+    fsck = False
+    profiles = {
+        "default": {"mkfs": ["-f"], "mount": []},
+        "compress": {"mkfs": ["-f"], "mount": ["noatime", "compress=zstd:3"]},
+        "ssd": {"mkfs": ["-f"], "mount": ["noatime", "compress=zstd:1", "ssd", "discard=async"]},
+    }
+
+    def wipe_parameters(self, wiped: str) -> list:
+        if wiped in (WIPE_ZEROOUT, WIPE_DISCARD, WIPE_SECDISCARD):
+            return ["-K"]
+        return []
+
+
+class F2fs(Filesystem):
+    name = "f2fs"
+    mkfs = "mkfs.f2fs"
+    package = "f2fs-tools"
+    profiles = {
+        "default": {"mkfs": ["-f"], "mount": []},
+        "flash": {"mkfs": ["-f", "-O", "extra_attr,inode_checksum,sb_checksum,compression"],
+                  "mount": ["noatime", "lazytime", "compress_algorithm=zstd", "compress_chksum", "atgc", "gc_merge"]},
+    }
+
+    def wipe_parameters(self, wiped: str) -> list:
+        if wiped in (WIPE_ZEROOUT, WIPE_DISCARD, WIPE_SECDISCARD):
+            return ["-t", "0"]
+        return []
+
+
+FILESYSTEMS = {}
+
+
+def register_filesystem(filesystem: Filesystem):
+    FILESYSTEMS[filesystem.name] = filesystem
+
+
+def get_filesystem(name: str) -> Filesystem:
+    if name not in FILESYSTEMS:
+        raise ValueError("Unknown filesystem '{}'. Filesystems: {}".format(name, ", ".join(sorted(FILESYSTEMS))))
+    return FILESYSTEMS[name]
+
+
+for _filesystem in (Vfat(), Ext4(), Xfs(), Btrfs(), F2fs()):
+    register_filesystem(_filesystem)
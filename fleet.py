@@ -0,0 +1,195 @@
+#!/bin/env/python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+from funcs import *
+
+import glob
+import concurrent.futures
+
+__VERSION__ = "0.0.1"
+__AUTHOR__ = u"Pekka Järvinen"
+__YEAR__ = 2017
+__DESCRIPTION__ = u"Arch Installer - Install many devices concurrently. Version {0}.".format(__VERSION__)
+__EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
+
+__EXAMPLES__ = [
+    u'',
+    u'-' * 60,
+    u'%(prog)s -d /dev/sdb /dev/sdc',
+    u"%(prog)s -d '/dev/sd[b-q]'",
+    u'-' * 60,
+]
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def expand_devices(patterns: list) -> list:
+    devices = []
+
+    for pattern in patterns:
+        pattern = os.path.abspath(os.path.expanduser(pattern))
+
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise ValueError("No devices match '{}'".format(pattern))
+        else:
+            matches = [pattern]
+
+        for dev in matches:
+            is_block_device(dev)
+            if dev not in devices:
+                devices.append(dev)
+
+    return devices
+
+
+def install_device(device: str, partitionsfile: str, logdir: str, jobs: int, image: str = None) -> float:
+    """
+    Run partition, mount and install scripts for one device. Root partition is deployed
+    from image instead of installing packages when image is given.
+    Output of every script is written to <logdir>/<device name>.log.
+    Returns elapsed seconds.
+    """
+    name = os.path.basename(device)
+    prefix = "{}-{}".format(INSTALL_DIR_PREFIX, name)
+
+    pipeline = [
+        ["1part.py", "--yes", "--jobs", str(jobs), "--partitions", partitionsfile, "--device", device],
+        ["2mount.py", "--prefix", prefix, "--partitions", partitionsfile, "--device", device],
+        # Mirror list of the live system is shared by every device
+        ["3install.py", "--skip-mirrors", "--prefix", prefix, "--partitions", partitionsfile, "--device", device],
+    ]
+
+    if image is not None:
+        pipeline[0][1:1] = ["--image", image]
+        pipeline[2][1:1] = ["--image"]
+
+    start = time.monotonic()
+
+    with open(os.path.join(logdir, "{}.log".format(name)), 'w', encoding="utf8") as logfile:
+        for script in pipeline:
+            run = [sys.executable, os.path.join(SCRIPT_DIR, script[0])]
+            run.extend(script[1:])
+            logfile.write("Running {}\n".format(" ".join(run)))
+            logfile.flush()
+            traced_run(run, check=True, cwd=SCRIPT_DIR, stdin=subprocess.DEVNULL, stdout=logfile,
+                       stderr=subprocess.STDOUT)
+
+    return time.monotonic() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__DESCRIPTION__,
+        epilog=__EPILOG__,
+        usage=os.linesep.join(__EXAMPLES__),
+    )
+
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+
+    optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
+                          help="Be verbose. -vvv.. Be more verbose.")
+
+    optional.add_argument('--trace <prefix>', dest='trace', default=None,
+                          help='Write timeline of every stage and command to <prefix>.jsonl and <prefix>.trace.json.')
+
+    optional.add_argument('--partitions <partitions.json>', '-p', dest='partitionsfile',
+                          help='Partitions JSON file. These are created to every target device.',
+                          default="partitions.json")
+
+    optional.add_argument('--workers <count>', '-w', type=int, dest='workers', default=0,
+                          help='Install this many devices concurrently. Default: all devices.')
+
+    optional.add_argument('--jobs <count>', '-j', type=int, dest='jobs', default=1,
+                          help='Partition jobs per device. See 1part.py --jobs.')
+
+    optional.add_argument('--image <root.img>', action=FullPaths, dest='image', default=None,
+                          help='Deploy root filesystem image made with mkimage.py instead of installing packages.')
+
+    optional.add_argument('--log-dir <directory>', '-l', action=FullPaths, dest='logdir', default="logs",
+                          help='Directory for per-device logs.')
+
+    required.add_argument('--devices <block device or glob>', '-d', nargs='+', dest='devices', required=True,
+                          help='Target devices (for example /dev/sdb /dev/sdc or "/dev/sd[b-q]").')
+
+    parser._action_groups.append(optional)
+
+    args = parser.parse_args()
+
+    if int(args.verbose) > 0:
+        logging.getLogger().setLevel(logging.DEBUG)
+        log.info("Being verbose")
+
+    if args.trace is not None:
+        tracing.enable(args.trace)
+
+    try:
+        devices = expand_devices(args.devices)
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        log.error("{}".format(e))
+        sys.exit(1)
+
+    if not os.path.isfile(args.partitionsfile):
+        log.error("Partitions file not found: {}".format(args.partitionsfile))
+        sys.exit(1)
+
+    partitionsfile = os.path.abspath(args.partitionsfile)
+
+    workers = args.workers
+    if workers <= 0:
+        workers = len(devices)
+
+    os.makedirs(args.logdir, exist_ok=True)
+
+    log.info("Target devices:")
+    for dev in devices:
+        log.info("    {}".format(dev))
+
+    if args.image is not None:
+        if not os.path.isfile(args.image):
+            log.error("Image not found: {}".format(args.image))
+            sys.exit(1)
+        log.info("Deploying image {}".format(args.image))
+    else:
+        log.info("Mirror list is not ranked per device. Rank /etc/pacman.d/mirrorlist before running.")
+
+    confirm_delete_disk = input("Delete all contents from {} devices? y/n: ".format(len(devices))).lower()
+
+    if confirm_delete_disk != "y":
+        log.info("Aborted.")
+        sys.exit(1)
+
+    start = time.monotonic()
+    errors = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(install_device, dev, partitionsfile, args.logdir, args.jobs, args.image): dev for dev in devices
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            dev = futures[future]
+            try:
+                log.info("{} installed in {:.1f}s".format(dev, future.result()))
+            except Exception as e:
+                log.error("{} failed: {}. See {}".format(
+                    dev, e, os.path.join(args.logdir, "{}.log".format(os.path.basename(dev)))))
+                errors[dev] = e
+
+    elapsed = time.monotonic() - start
+    installed = len(devices) - len(errors)
+
+    log_summary("Installing devices", devices, errors)
+    log.info("{} devices installed in {:.1f}s ({:.1f} disks/hour)".format(
+        installed, elapsed, installed * 3600 / elapsed if elapsed > 0 else 0))
+
+    if len(errors) > 0:
+        sys.exit(1)
+
+    log.info("Done.")
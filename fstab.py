@@ -0,0 +1,120 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+FSTAB_HEADER = "# Static information about the filesystems.\n# See fstab(5) for details.\n\n" \
+               "# <file system> <dir> <type> <options> <dump> <pass>\n"
+
+# Fields compared with genfstab output. Options differ: genfstab writes the options the kernel reports.
+COMPARED_FIELDS = ("source", "fstype")
+
+
+def fstab_source(partition: dict) -> str:
+    """
+    Filesystem of partition (device model from get_block_device()) as stable as it can be named.
+    """
+    if partition.get('uuid'):
+        return "UUID={}".format(partition['uuid'])
+
+    if partition.get('partuuid'):
+        log.warning("No filesystem UUID for {}. Using PARTUUID.".format(partition['name']))
+        return "PARTUUID={}".format(partition['partuuid'])
+
+    log.warning("No UUID for {}. Using device name which may change.".format(partition['name']))
+    return "/dev/{}".format(partition['name'])
+
+
+def fstab_entry(partition: dict, target: str, fstype: str, options: list = None, fsck: bool = True) -> dict:
+    """
+    fstab line of partition mounted at target ("/", "/boot", "none" for swap) as dict.
+    """
+    if target == "none":
+        fsck_pass = 0
+    elif not fsck:
+        fsck_pass = 0
+    elif target == "/":
+        fsck_pass = 1
+    else:
+        fsck_pass = 2
+
+    return {
+        "comment": "/dev/{}{}".format(partition['name'],
+                                      " LABEL={}".format(partition['label']) if partition.get('label') else ""),
+        "source": fstab_source(partition),
+        "target": target,
+        "fstype": fstype,
+        "options": ",".join(options) if options else "defaults",
+        "dump": 0,
+        "pass": fsck_pass,
+    }
+
+
+def format_fstab(entries: list) -> str:
+    lines = [FSTAB_HEADER]
+
+    for entry in entries:
+        lines.append("# {}\n".format(entry['comment']))
+        lines.append("{}\t{}\t{}\t{}\t{} {}\n\n".format(
+            entry['source'], entry['target'], entry['fstype'], entry['options'], entry['dump'], entry['pass']))
+
+    return "".join(lines)
+
+
+def parse_fstab(text: str) -> list:
+    entries = []
+
+    for line in text.split("\n"):
+        line = line.strip()
+
+        if line == "" or line.startswith("#"):
+            continue
+
+        fields = line.split()
+        if len(fields) < 4:
+            raise ValueError("Invalid fstab line: {}".format(line))
+
+        # dump and pass are optional
+        while len(fields) < 6:
+            fields.append("0")
+
+        entries.append({
+            "source": fields[0],
+            "target": fields[1],
+            "fstype": fields[2],
+            "options": fields[3],
+            "dump": int(fields[4]),
+            "pass": int(fields[5]),
+        })
+
+    return entries
+
+
+def _key(entry: dict) -> str:
+    # Every swap is mounted at "none"
+    if entry['target'] == "none":
+        return "swap {}".format(entry['source'])
+    return entry['target']
+
+
+def compare_fstab(entries: list, other: list) -> list:
+    """
+    Differences of entries and other (parsed genfstab output) by mount point as log lines.
+    Empty when they agree.
+    """
+    ours = {_key(entry): entry for entry in entries}
+    theirs = {_key(entry): entry for entry in other}
+    differences = []
+
+    for target in sorted(set(ours) | set(theirs)):
+        if target not in theirs:
+            differences.append("{}: missing from genfstab".format(target))
+        elif target not in ours:
+            differences.append("{}: only in genfstab ({} {})".format(
+                target, theirs[target]['source'], theirs[target]['fstype']))
+        else:
+            for field in COMPARED_FIELDS:
+                if ours[target][field] != theirs[target][field]:
+                    differences.append("{}: {} {} != genfstab {}".format(
+                        target, field, ours[target][field], theirs[target][field]))
+
+    return differences
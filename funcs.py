@@ -11,23 +11,61 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 import os
+import re
 import subprocess
 
 import pathlib
 import json
 import time
 import shutil
+import tempfile
 import io
+import math
+import configparser
+import concurrent.futures
 
 import argparse
 
+import tracing
+from tracing import stage, traced_run
+from runner import stream_run
+from blockdev import read_block_device, partition_name, PartitionWatcher, SysfsUnavailable
+from images import deploy_image, delta_deploy_image, grow_filesystem
+from wipe import WIPE_ZEROOUT
+from filesystems import get_filesystem, DEFAULT_PROFILE
+from fstab import fstab_entry
+
+tracing.enable_from_environment()
+
 # https://www.freedesktop.org/wiki/Specifications/DiscoverablePartitionsSpec/
 UUID_SWAP = "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f"
 UUID_BIOS = "21686148-6449-6e6f-744e-656564454649"
 UUID_OTHER = "0fc63daf-8483-4772-8e79-3d69d8477de4"
+UUID_EFI = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+
+# sgdisk type code: partition type GUID
+TYPE_CODE_UUIDS = {0xef02: UUID_BIOS, 0xef00: UUID_EFI, 0x8200: UUID_SWAP, 0x8300: UUID_OTHER}
+
+# Filesystem of partition type when partitions file does not name one
+DEFAULT_FILESYSTEMS = {UUID_EFI: "vfat", UUID_OTHER: "ext4"}
 
 INSTALL_DIR_PREFIX = "/mnt/installer"
 
+# Seconds to wait for partition device nodes after partprobe
+PARTITION_TIMEOUT = 30
+
+# GPT can hold 128 partition entries and 36 UTF-16 characters per name
+GPT_MAX_PARTITIONS = 128
+GPT_MAX_NAME_LENGTH = 36
+# 128 entries of 128 bytes after each GPT header
+GPT_TABLE_BYTES = 128 * 128
+# Partitions start and end on multiples of this and of device I/O sizes
+PARTITION_ALIGNMENT = 1024 * 1024
+
+# sgdisk --new size: [+|-]<number>[K|M|G|T|P], no suffix means sectors
+SGDISK_SIZE_RE = re.compile(r"^([+-]?)(\d+)([KMGTP]?)$", re.IGNORECASE)
+SGDISK_SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+
 class FullPaths(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, os.path.abspath(os.path.expanduser(values)))
@@ -43,10 +81,18 @@ def is_block_device(dirname: str) -> str:
         return dirname
 
 
-def get_block_device(device: str) -> dict:
-    run = ["lsblk", "-O", "-J", device]
+# Block device models by device path. Cleared by every command which changes devices.
+_block_devices = {}
+
+
+def invalidate_block_devices():
+    _block_devices.clear()
+
+
+def lsblk_block_device(device: str) -> dict:
+    run = ["lsblk", "-O", "-J", "-b", device]
     log.info("Running {}".format(" ".join(run)))
-    lsblk_run = subprocess.run(run, timeout=30, check=True, stdout=subprocess.PIPE)
+    lsblk_run = stream_run(run, timeout=30, check=True, keep_lines=None)
 
     data = json.loads(lsblk_run.stdout)
 
@@ -64,6 +110,24 @@ def get_block_device(device: str) -> dict:
     return data[0]
 
 
+def get_block_device(device: str) -> dict:
+    """
+    Block device and its partitions. Read from sysfs when possible, lsblk otherwise.
+    Result is cached until a command changes block devices.
+    """
+    if device in _block_devices:
+        return _block_devices[device]
+
+    try:
+        data = read_block_device(device)
+    except (SysfsUnavailable, OSError) as e:
+        log.debug("Using lsblk: {}".format(e))
+        data = lsblk_block_device(device)
+
+    _block_devices[device] = data
+    return data
+
+
 def sgdisk(device, parameters: list):
     if not isinstance(parameters, list):
         raise TypeError("Wrong type: {}".format(type(parameters)))
@@ -76,7 +140,10 @@ def sgdisk(device, parameters: list):
     run.append(device)
 
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 
 def partprobe(device):
@@ -84,7 +151,10 @@ def partprobe(device):
     run.append(device)
 
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 
 def fdisk(device, parameters: list):
@@ -99,7 +169,7 @@ def fdisk(device, parameters: list):
     run.append(device)
 
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    return stream_run(run, check=True, keep_lines=None)
 
 
 def wipefs(device, parameters: list):
@@ -114,19 +184,28 @@ def wipefs(device, parameters: list):
     run.append(device)
 
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 
 def mkswap(device):
     run = ["mkswap", device]
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 
 def swapon(device):
     run = ["swapon", device]
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 
 def enable_swap(device):
@@ -134,42 +213,201 @@ def enable_swap(device):
     swapon(device)
 
 
-def mount(device, destination):
-    run = ["mount", device, destination]
+def mount(device, destination, parameters: list = None):
+    run = ["mount"]
+    if parameters is not None:
+        run.extend(parameters)
+    run.extend([device, destination])
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 def unmount(device):
     run = ["umount", device]
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
+
+def mkfs_ext4(device, parameters: list = None):
+    run = ["mkfs.ext4"]
+    if parameters is not None:
+        run.extend(parameters)
+    run.append(device)
+    log.debug("Running {}".format(" ".join(run)))
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
-def mkfs_ext4(device):
-    run = ["mkfs.ext4", device]
+def make_filesystem(device, filesystem, profile: str = DEFAULT_PROFILE, wiped: str = None, topology: dict = None):
+    run = filesystem.mkfs_command(device, profile, wiped, topology)
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    try:
+        return stream_run(run, check=True)
+    finally:
+        invalidate_block_devices()
 
 def rankmirrors(file, count=5):
     run = ["rankmirrors", "-n", str(count), file]
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    return stream_run(run, check=True, keep_lines=None)
 
-def pacstrap(install_dir, files:list):
+def pacstrap(install_dir, files:list, parameters: list = None, pacman_parameters: list = None):
     run = ["pacstrap"]
+    if parameters is not None:
+        run.extend(parameters)
     run.append(install_dir)
+    # pacstrap passes everything after the root to pacman
+    if pacman_parameters is not None:
+        run.extend(pacman_parameters)
     run.extend(files)
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    return stream_run(run, check=True)
 
 def genfstab(install_dir):
     run = ["genfstab", "-U", install_dir]
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    return stream_run(run, check=True, keep_lines=None)
 
-def chroot(install_dir):
+def arch_chroot(install_dir, command: list):
+    """
+    Run command inside install_dir. Exit code is left for the caller to check.
+    """
     run = ["arch-chroot", install_dir]
+    run.extend(command)
     log.debug("Running {}".format(" ".join(run)))
-    return subprocess.run(run, check=True, stdout=subprocess.PIPE)
+    return stream_run(run, keep_lines=None)
+
+def root_partition_number(partitions: list) -> int:
+    """
+    Number of partition mounted as / by 2mount.py: the last Linux partition.
+    """
+    for idx in range(len(partitions), 0, -1):
+        if partitions[idx - 1]['type'] == 0x8300:
+            return idx
+
+    raise IndexError("No Linux (8300) partition in partitions file")
+
+
+def mount_partition(partition: dict, destination: str, entry: dict = None):
+    """
+    Mount partition with mount options of its filesystem profile.
+    """
+    filesystem, profile = partition_filesystem(partition['parttype'], entry)
+
+    parameters = None
+    if filesystem is not None and len(filesystem.mount_options(profile)) > 0:
+        parameters = ["-o", ",".join(filesystem.mount_options(profile))]
+
+    return mount("/dev/{}".format(partition['name']), destination, parameters)
+
+
+def plan_mounts(block_device: dict) -> list:
+    """
+    (partition, mount point in installation) pairs in mount order: last Linux partition
+    as "/" and EFI system partition or the first other Linux partition as "/boot".
+    """
+    children = block_device.get('children', [])
+    mounts = []
+
+    # mount last partition as /
+    # must exist before /boot
+    root = None
+    for p in reversed(children):
+        if p['parttype'] == UUID_OTHER:
+            root = p
+            mounts.append((p, "/"))
+            break
+
+    # Mount EFI system partition or first other partition as "/boot"
+    boot = None
+
+    for p in children:
+        if p['parttype'] == UUID_EFI:
+            boot = p
+            break
+
+    if boot is None:
+        for p in children:
+            if p['parttype'] == UUID_OTHER and p is not root:
+                boot = p
+                break
+
+    if boot is not None:
+        mounts.append((boot, "/boot"))
+
+    return mounts
+
+
+def fstab_entries(block_device: dict, entries: dict = None) -> list:
+    """
+    fstab entries of partitions mounted by 2mount.py and swap partitions of block device.
+    entries are partitions file entries by partition name; mount options come from their
+    filesystem profiles.
+    """
+    entries = entries or {}
+    lines = []
+
+    for p, target in plan_mounts(block_device):
+        filesystem, profile = partition_filesystem(p['parttype'], entries.get(p['partlabel']))
+        if filesystem is None:
+            raise ValueError("No filesystem for {} at {}".format(p['name'], target))
+        lines.append(fstab_entry(p, target, p.get('fstype') or filesystem.name, filesystem.mount_options(profile),
+                                 filesystem.fsck))
+
+    for p in block_device.get('children', []):
+        if p['parttype'] == UUID_SWAP:
+            lines.append(fstab_entry(p, "none", "swap"))
+
+    return lines
+
+
+def write_file_atomic(path: str, data: str, mode: int = 0o644):
+    """
+    Replace file with data so that readers and crashes see either the old or the new file.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".{}.".format(os.path.basename(path)))
+
+    try:
+        with os.fdopen(fd, 'w', encoding="utf8") as f:
+            f.write(data)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    dirfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def copy_files(source: str, destination: str):
+    """
+    Copy contents of directory source into destination without owner, mode or timestamps,
+    which filesystems like vfat cannot store. Symbolic links are skipped.
+    """
+    for directory, dirnames, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(directory, source))
+        os.makedirs(target, exist_ok=True)
+
+        for name in dirnames + filenames:
+            path = os.path.join(directory, name)
+
+            if os.path.islink(path):
+                log.warning("Not copying symbolic link {}".format(path))
+            elif name in filenames:
+                shutil.copyfile(path, os.path.join(target, name))
+
 
 def unmount_all(device):
     block_device = get_block_device(device)
@@ -186,6 +424,124 @@ def unmount_all(device):
         log.info("Unmounting {}".format(block_device['mountpoint']))
         unmount(p['mountpoint'])
 
+def wipe_partition(device):
+    log.info("  Wiping {}".format(device))
+    sgdisk(device, ['--zap-all'])
+    wipefs(device, ['-a'])
+
+
+def partition_filesystem(parttype: str, entry: dict = None) -> tuple:
+    """
+    (filesystem backend, profile name) of partition. entry is the partition in partitions
+    file and may name "filesystem" and "profile". (None, None) for partitions without filesystem.
+    """
+    entry = entry or {}
+    name = entry.get('filesystem') or DEFAULT_FILESYSTEMS.get(parttype)
+
+    if name is None:
+        if 'profile' in entry:
+            raise ValueError("Partition '{}' has a profile but no filesystem".format(entry.get('name')))
+        return None, None
+
+    filesystem = get_filesystem(name)
+    profile = entry.get('profile', DEFAULT_PROFILE)
+    # Raises ValueError for unknown profile
+    filesystem.profile(profile)
+
+    return filesystem, profile
+
+
+def format_partition(partition: dict, image: str = None, delta: bool = False, wiped: str = None,
+                     entry: dict = None):
+    """
+    Create filesystem or swap on partition by its type and entry in partitions file.
+    Linux partition gets a copy of ext4 filesystem image instead of an empty filesystem when
+    image is given. With delta only the ranges which differ from image are written. wiped is
+    the wipe method (wipe.py) used on the whole device; mkfs skips work it has already done.
+    """
+    dev = "/dev/{}".format(partition['name'])
+
+    if partition['parttype'] == UUID_SWAP:
+        log.info("  Enabling swap on {}".format(partition['name']))
+        enable_swap(dev)
+        return
+
+    if partition['parttype'] == UUID_BIOS:
+        return
+
+    filesystem, profile = partition_filesystem(partition['parttype'], entry)
+
+    if filesystem is None:
+        log.error("  Unknown type: {} {} {}. Format this manually.".format(
+            partition['name'], partition['partlabel'], partition['parttype']))
+    elif image is not None:
+        log.info("  Deploying image {} @ {}".format(image, partition['name']))
+        try:
+            if delta:
+                delta_deploy_image(image, dev)
+            else:
+                deploy_image(image, dev, wiped == WIPE_ZEROOUT)
+            grow_filesystem(dev)
+        finally:
+            invalidate_block_devices()
+    else:
+        log.info("  Formatting {} ({}) @ {}".format(filesystem.name, profile, partition['name']))
+        make_filesystem(dev, filesystem, profile, wiped, partition)
+
+
+def prepare_partition(device, name: str, image: str = None, delta: bool = False, wiped: str = None,
+                      entry: dict = None):
+    """
+    Wipe and format partition 'name' of device. See format_partition() for image, delta, wiped and entry.
+    Partition which is delta deployed or on a zeroed device is not wiped.
+    """
+    for partition in get_block_device(device).get('children', []):
+        if partition['name'] == name:
+            break
+    else:
+        raise IndexError("Partition {} not found from {}".format(name, device))
+
+    if not (delta and image is not None) and wiped != WIPE_ZEROOUT:
+        wipe_partition("/dev/{}".format(name))
+
+    format_partition(partition, image, delta, wiped, entry)
+
+
+def run_parallel(func, items, jobs: int = 1) -> dict:
+    """
+    Run func(item) for every item in a thread pool of at most 'jobs' workers.
+    items is {key: item} or an iterable of (key, item) pairs. Items of an iterable
+    are started as soon as it yields them. Returns {key: exception} for failed items.
+    """
+    if jobs < 1:
+        raise ValueError("Invalid job count: {}".format(jobs))
+
+    if isinstance(items, dict):
+        items = items.items()
+
+    errors = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(func, item): key for key, item in items}
+
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error("  {} failed: {}".format(key, e))
+                errors[key] = e
+
+    return errors
+
+
+def log_summary(stage: str, keys: list, errors: dict):
+    log.info("{}: {} ok, {} failed".format(stage, len(keys) - len(errors), len(errors)))
+    for key in keys:
+        if key in errors:
+            log.error("    {}: {}".format(key, errors[key]))
+
+
 def efi_enabled() -> bool:
     return os.path.isdir("/sys/firmware/efi/efivars")
 
@@ -222,7 +578,419 @@ def read_partitions_file(wrapper:io.TextIOBase) -> list:
     for i in partitions:
         i['type'] = int(i['type'], 16)
 
+    # Validate filesystem and profile names
+    for i in partitions:
+        partition_filesystem(TYPE_CODE_UUIDS.get(i['type']), i)
+
     return partitions
 
+def parse_sgdisk_size(size: str, sector_size: int = 512) -> tuple:
+    """
+    Parse sgdisk --new end value. Returns (sign, bytes).
+    sign is '+' for relative size, '-' for offset from end of disk and '' for absolute sector or default (0).
+    """
+    m = SGDISK_SIZE_RE.match(str(size).strip())
+
+    if m is None:
+        raise ValueError("Invalid partition size: '{}'".format(size))
+
+    sign, number, unit = m.groups()
+
+    if unit == "":
+        return sign, int(number) * sector_size
+
+    return sign, int(number) * SGDISK_SIZE_UNITS[unit.upper()]
+
+
+def partition_grain(block_device: dict) -> int:
+    """
+    Alignment in bytes for partitions of block device: least common multiple of 1 MiB,
+    physical sector size, minimum I/O size and optimal I/O size (RAID chunk and stripe).
+    """
+    grain = PARTITION_ALIGNMENT
+
+    for key in ('log-sec', 'phy-sec', 'min-io', 'opt-io'):
+        value = int(block_device.get(key) or 0)
+        if value > 0:
+            grain = grain * value // math.gcd(grain, value)
+
+    return grain
+
+
+def plan_partition_layout(block_device: dict, partitions: list) -> dict:
+    """
+    Validate partitions against block device model and compute aligned start and end sector
+    of every partition. Starts are aligned to partition_grain() (shifted by the device
+    alignment offset), fixed size partitions keep their exact size and the partition
+    filling the rest of the disk ends on an aligned boundary.
+    """
+    if len(partitions) > GPT_MAX_PARTITIONS:
+        raise ValueError("Too many partitions: {} (max {})".format(len(partitions), GPT_MAX_PARTITIONS))
+
+    sector_size = int(block_device.get('log-sec') or 512)
+    physical_size = max(int(block_device.get('phy-sec') or sector_size), sector_size)
+    alignment_offset = int(block_device.get('alignment') or 0)
+    grain = partition_grain(block_device)
+    device_sectors = int(block_device['size']) // sector_size
+
+    # Protective MBR + header + table at start, table + header at end
+    first_usable = 2 + GPT_TABLE_BYTES // sector_size
+    last_usable = device_sectors - 2 - GPT_TABLE_BYTES // sector_size
+
+    def align_up(byte: int) -> int:
+        return ((byte - alignment_offset + grain - 1) // grain) * grain + alignment_offset
+
+    def align_down(byte: int) -> int:
+        return ((byte - alignment_offset) // grain) * grain + alignment_offset
+
+    names = []
+    layout = []
+    fill_partition = None
+    start_byte = align_up(max(first_usable * sector_size, grain))
+
+    for idx, partition in enumerate(partitions, start=1):
+        if fill_partition is not None:
+            raise ValueError("Partition '{}' is after partition '{}' which fills the rest of the disk".format(
+                partition['name'], fill_partition))
+
+        if len(partition['name']) > GPT_MAX_NAME_LENGTH:
+            raise ValueError("Partition name '{}' is too long (max {})".format(partition['name'], GPT_MAX_NAME_LENGTH))
+
+        if partition['name'] in names:
+            raise ValueError("Duplicate partition name '{}'".format(partition['name']))
+
+        names.append(partition['name'])
+
+        if not 0 < partition['type'] <= 0xffff:
+            raise ValueError("Invalid type code {:04x} for partition '{}'".format(partition['type'], partition['name']))
+
+        sign, size = parse_sgdisk_size(partition['size'], sector_size)
+
+        if sign == "+":
+            if size == 0:
+                raise ValueError("Partition '{}' has zero size".format(partition['name']))
+            # Whole physical sectors
+            size = (size + physical_size - 1) // physical_size * physical_size
+            end_byte = start_byte + size
+        elif sign == "-" or size == 0:
+            # Rest of the disk (optionally minus given size)
+            fill_partition = partition['name']
+            end_byte = align_down((last_usable + 1) * sector_size - size)
+        else:
+            raise ValueError("Absolute end sector '{}' is not supported for partition '{}'".format(
+                partition['size'], partition['name']))
+
+        if end_byte > (last_usable + 1) * sector_size or end_byte <= start_byte:
+            raise ValueError("Partition '{}' does not fit to {} ({} bytes)".format(
+                partition['name'], block_device['name'], block_device['size']))
+
+        layout.append({
+            "number": idx,
+            "name": partition['name'],
+            "type": partition['type'],
+            "start": start_byte // sector_size,
+            "end": end_byte // sector_size - 1,
+            "size": end_byte - start_byte,
+        })
+
+        start_byte = align_up(end_byte)
+
+    # sgdisk moves starts which are not multiples of --set-alignment. Starts shifted by an
+    # offset which is not a multiple of the grain are only multiples of their gcd.
+    alignment = math.gcd(grain, alignment_offset) // sector_size or 1
+
+    for partition in layout:
+        if partition['start'] % alignment != 0:
+            raise ValueError("Start sector {} of partition '{}' is not a multiple of alignment {}".format(
+                partition['start'], partition['name'], alignment))
+
+    return {
+        "device": block_device['name'],
+        "sector_size": sector_size,
+        "physical_sector_size": physical_size,
+        "min_io": int(block_device.get('min-io') or 0),
+        "optimal_io": int(block_device.get('opt-io') or 0),
+        "alignment_offset": alignment_offset,
+        "grain": grain,
+        "sgdisk_alignment": alignment,
+        "partitions": layout,
+    }
+
+
+def plan_partition_table(block_device: dict, partitions: list, disk_guid: str = None) -> list:
+    """
+    sgdisk parameters which zap, clear and create the whole partition table
+    of plan_partition_layout() in one run. New table gets disk_guid, or a random GUID.
+    """
+    layout = plan_partition_layout(block_device, partitions)
+
+    parameters = ["--zap-all", "--clear", "--mbrtogpt",
+                  "--set-alignment={}".format(layout['sgdisk_alignment'])]
+
+    if disk_guid is not None:
+        parameters.append("--disk-guid={}".format(disk_guid))
+
+    for partition in layout['partitions']:
+        parameters.extend([
+            "--new", "{}:{}:{}".format(partition['number'], partition['start'], partition['end']),
+            "--typecode", "{}:{:04x}".format(partition['number'], partition['type']),
+            "--change-name", "{}:{}".format(partition['number'], partition['name']),
+        ])
+
+    return parameters
+
+
+def log_partition_layout(layout: dict):
+    log.info("Layout of {}: {} byte sectors ({} physical), min I/O {}, optimal I/O {}, alignment offset {}".format(
+        layout['device'], layout['sector_size'], layout['physical_sector_size'], layout['min_io'],
+        layout['optimal_io'], layout['alignment_offset']))
+    log.info("Partitions aligned to {} KiB".format(layout['grain'] // 1024))
+    log.info("    {:>2} {:<20} {:>4} {:>12} {:>12} {:>14}".format("#", "name", "type", "start", "end", "size"))
+
+    for partition in layout['partitions']:
+        log.info("    {:>2} {:<20} {:04x} {:>12} {:>12} {:>14}".format(
+            partition['number'], partition['name'], partition['type'], partition['start'], partition['end'],
+            partition['size']))
+
+
+def partition_layout_matches(block_device: dict, partitions: list) -> bool:
+    """
+    True when partitions of block device model are the ones partitions file would create:
+    same count, order, names, known types and sizes. Partition filling the rest of the disk
+    may differ in size.
+    """
+    children = block_device.get('children', [])
+
+    if len(children) != len(partitions):
+        return False
+
+    sector_size = int(block_device.get('log-sec') or 512)
+
+    for child, partition in zip(children, partitions):
+        if child.get('partlabel') != partition['name']:
+            return False
+
+        expected_type = TYPE_CODE_UUIDS.get(partition['type'])
+        if expected_type is not None and child.get('parttype') != expected_type:
+            return False
+
+        sign, size = parse_sgdisk_size(partition['size'], sector_size)
+        if sign == "+" and int(child['size']) != size:
+            return False
+
+    return True
+
+
+def expected_fstype(partition: dict) -> str:
+    """
+    Filesystem type udev reports for partition of partitions file once it is formatted.
+    None for partitions without filesystem.
+    """
+    parttype = TYPE_CODE_UUIDS.get(partition['type'])
+
+    if parttype == UUID_SWAP:
+        return "swap"
+
+    filesystem, profile = partition_filesystem(parttype, partition)
+    if filesystem is None:
+        return None
+
+    return filesystem.name
+
+
+def plan_reconcile(block_device: dict, layout: dict, partitions: list, fingerprints: dict = None,
+                   recorded: dict = None, images: list = None, reformat: bool = False) -> dict:
+    """
+    Changes which turn partitions of block device model into plan_partition_layout() layout.
+
+    Every partition gets "table": "keep" (same start and size), "modify" (type or name
+    changed in place) or "create" (missing or moved; old one is deleted), and "format": True
+    when its filesystem must be created again. Partitions past the layout are listed in
+    "delete". fingerprints are {number: hash} of partitions file entries and images, recorded
+    the ones of the last run; a partition whose fingerprint changed is formatted again.
+    Partitions numbered in images are kept only when their image is recorded as deployed.
+    reformat formats every partition with a filesystem.
+    """
+    fingerprints = fingerprints or {}
+    recorded = recorded or {}
+    images = images or []
+    sector_size = layout['sector_size']
+    children = {int(c['partn']): c for c in block_device.get('children', []) if c.get('partn') is not None}
+
+    planned = []
+
+    for partition, entry in zip(layout['partitions'], partitions):
+        number = partition['number']
+        child = children.get(number)
+        key = str(number)
+        reasons = []
+        retyped = False
+
+        if child is None:
+            table = "create"
+            reasons.append("missing")
+        elif (child.get('start') is None or int(child['start']) * 512 != partition['start'] * sector_size or
+              int(child['size']) != partition['size']):
+            table = "create"
+            reasons.append("moved or resized")
+        else:
+            table = "keep"
+
+            parttype = TYPE_CODE_UUIDS.get(partition['type'])
+            if parttype is not None and child.get('parttype') != parttype:
+                table = "modify"
+                retyped = True
+                reasons.append("type {} -> {:04x}".format(child.get('parttype'), partition['type']))
+
+            if child.get('partlabel') != partition['name']:
+                table = "modify"
+                reasons.append("name {} -> {}".format(child.get('partlabel'), partition['name']))
+
+        fstype = expected_fstype(entry)
+        needs_format = table == "create" or retyped
+
+        if not needs_format and fstype is not None:
+            if child.get('fstype') != fstype:
+                needs_format = True
+                reasons.append("filesystem {} -> {}".format(child.get('fstype'), fstype))
+            elif key in recorded and recorded[key] != fingerprints.get(key):
+                needs_format = True
+                reasons.append("partitions file entry or image changed")
+            elif key not in recorded and number in images:
+                needs_format = True
+                reasons.append("image not deployed")
+            elif reformat:
+                needs_format = True
+                reasons.append("redoing filesystems")
+
+        planned.append({
+            "number": number,
+            "name": partition['name'],
+            "table": table,
+            "format": needs_format,
+            "reasons": reasons,
+        })
+
+    delete = sorted(n for n in children if n > len(layout['partitions']))
+
+    return {
+        "device": layout['device'],
+        "partitions": planned,
+        "delete": delete,
+    }
+
+
+def reconcile_changes(plan: dict) -> bool:
+    return len(plan['delete']) > 0 or any(p['table'] != "keep" or p['format'] for p in plan['partitions'])
+
+
+def plan_reconcile_table(plan: dict, layout: dict, block_device: dict) -> list:
+    """
+    sgdisk parameters which apply partition table changes of plan_reconcile() and leave
+    kept partitions untouched. Empty when the table does not change.
+    """
+    existing = set(int(c['partn']) for c in block_device.get('children', []) if c.get('partn') is not None)
+    by_number = {p['number']: p for p in layout['partitions']}
+
+    parameters = []
+
+    for number in plan['delete']:
+        parameters.extend(["--delete", str(number)])
+
+    for partition in plan['partitions']:
+        if partition['table'] == "create" and partition['number'] in existing:
+            parameters.extend(["--delete", str(partition['number'])])
+
+    for partition in plan['partitions']:
+        if partition['table'] == "keep":
+            continue
+
+        planned = by_number[partition['number']]
+
+        if partition['table'] == "create":
+            parameters.extend(["--new", "{}:{}:{}".format(planned['number'], planned['start'], planned['end'])])
+
+        parameters.extend([
+            "--typecode", "{}:{:04x}".format(planned['number'], planned['type']),
+            "--change-name", "{}:{}".format(planned['number'], planned['name']),
+        ])
+
+    if len(parameters) > 0:
+        parameters.insert(0, "--set-alignment={}".format(layout['sgdisk_alignment']))
+
+    return parameters
+
+
+def log_reconcile_plan(plan: dict):
+    log.info("Changes to {}:".format(plan['device']))
+
+    for number in plan['delete']:
+        log.info("    - {:>2} delete".format(number))
+
+    for partition in plan['partitions']:
+        if partition['table'] == "create":
+            mark = "+"
+        elif partition['table'] == "modify" or partition['format']:
+            mark = "~"
+        else:
+            mark = "="
+
+        actions = []
+        if partition['table'] != "keep":
+            actions.append(partition['table'])
+        if partition['format']:
+            actions.append("format")
+        if len(actions) == 0:
+            actions.append("keep")
+
+        reasons = ""
+        if len(partition['reasons']) > 0:
+            reasons = " ({})".format(", ".join(partition['reasons']))
+
+        log.info("    {} {:>2} {:<20} {}{}".format(mark, partition['number'], partition['name'], " + ".join(actions),
+                                                 reasons))
+
+
+def read_config_file(wrapper: io.TextIOBase) -> configparser.ConfigParser:
+
+    if not isinstance(wrapper, io.TextIOBase):
+        raise TypeError("Wrong type: {}".format(type(wrapper)))
+
+    config = configparser.ConfigParser()
+
+    with wrapper as f:
+        config.read_file(f)
+
+    return config
+
+# Parsed partitions and config files by path. Stages run in one process (pyarchinstall.py all) share them.
+_files = {}
+
+
+def _load_file(wrapper: io.TextIOBase, reader):
+    key = (reader.__name__, os.path.abspath(wrapper.name))
+
+    if key in _files:
+        wrapper.close()
+    else:
+        _files[key] = reader(wrapper)
+
+    return _files[key]
+
+
+def load_partitions_file(wrapper: io.TextIOBase) -> list:
+    """
+    read_partitions_file() which parses a file only once per process.
+    """
+    return _load_file(wrapper, read_partitions_file)
+
+
+def load_config_file(wrapper: io.TextIOBase) -> configparser.ConfigParser:
+    """
+    read_config_file() which parses a file only once per process.
+    """
+    return _load_file(wrapper, read_config_file)
+
+
 def get_datefmt() -> str:
     return '%H:%M:%S'
\ No newline at end of file
@@ -0,0 +1,410 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import json
+import mmap
+import time
+import errno
+import fcntl
+import stat
+import struct
+import hashlib
+import subprocess
+import concurrent.futures
+
+from runner import stream_run
+
+# Size of sparse file the reference system is installed into. Shrunk to minimum afterwards.
+IMAGE_BUILD_SIZE = "8G"
+
+# <linux/fs.h>
+BLKGETSIZE64 = 0x80081272
+BLKZEROOUT = 0x127f
+
+# ext4 superblock at 1024 bytes
+EXT4_SUPERBLOCK_OFFSET = 1024
+EXT4_SUPER_MAGIC = 0xef53
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+
+# Largest single copy_file_range()/sendfile() request
+COPY_CHUNK = 64 * 1024 * 1024
+
+# Delta deployment compares and writes ranges of this size
+BLOCK_INDEX_SIZE = 4 * 1024 * 1024
+BLOCK_INDEX_SUFFIX = ".index"
+BLOCK_HASH_SIZE = 16
+
+
+def ext4_size(path: str) -> int:
+    """
+    Size of ext4 filesystem in path (image file or device) in bytes, read from its superblock.
+    """
+    with open(path, 'rb') as f:
+        f.seek(EXT4_SUPERBLOCK_OFFSET)
+        sb = f.read(1024)
+
+    blocks_lo, = struct.unpack_from("<I", sb, 0x4)
+    log_block_size, = struct.unpack_from("<I", sb, 0x18)
+    magic, = struct.unpack_from("<H", sb, 0x38)
+    incompat, = struct.unpack_from("<I", sb, 0x60)
+    blocks_hi, = struct.unpack_from("<I", sb, 0x150)
+
+    if magic != EXT4_SUPER_MAGIC:
+        raise ValueError("No ext4 filesystem in {}".format(path))
+
+    blocks = blocks_lo
+    if incompat & EXT4_FEATURE_INCOMPAT_64BIT:
+        blocks |= blocks_hi << 32
+
+    return blocks * (1024 << log_block_size)
+
+
+def _size(fd: int) -> int:
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+    return os.fstat(fd).st_size
+
+
+def data_extents(fd: int, start: int, end: int):
+    """
+    Yield (start, end) of data between start and end of sparse file. Holes are skipped with
+    SEEK_DATA/SEEK_HOLE. Filesystems without hole support report the whole file as data.
+    """
+    offset = start
+
+    while offset < end:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole left
+                return
+            raise
+
+        if data_start >= end:
+            return
+
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+        yield data_start, data_end
+        offset = data_end
+
+
+def _zeroout(fd: int, start: int, length: int):
+    if length <= 0:
+        return
+
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        # Kernel zeroes with WRITE ZEROES/UNMAP when device supports it; no data is copied from here
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", start, length))
+        return
+
+    zeroes = bytes(min(COPY_CHUNK, length))
+    end = start + length
+    while start < end:
+        start += os.pwrite(fd, zeroes[:end - start], start)
+
+
+class _Copier:
+    """
+    Copy byte ranges between file descriptors with the fastest call the kernel accepts:
+    copy_file_range(), then sendfile(), then read()/write().
+    """
+
+    def __init__(self, src: int, dst: int):
+        self.src = src
+        self.dst = dst
+        self.method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+
+    def copy(self, offset: int, length: int):
+        end = offset + length
+
+        while offset < end:
+            count = min(COPY_CHUNK, end - offset)
+
+            try:
+                copied = self._copy(offset, count)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                fallback = {"copy_file_range": "sendfile", "sendfile": "read/write"}.get(self.method)
+                if fallback is None:
+                    raise
+                log.debug("{} not supported ({}). Using {}".format(self.method, e, fallback))
+                self.method = fallback
+                continue
+
+            if copied == 0:
+                raise IOError("Unexpected end of image at {}".format(offset))
+
+            offset += copied
+
+    def _copy(self, offset: int, count: int) -> int:
+        if self.method == "copy_file_range":
+            return os.copy_file_range(self.src, self.dst, count, offset, offset)
+
+        if self.method == "sendfile":
+            os.lseek(self.dst, offset, os.SEEK_SET)
+            return os.sendfile(self.dst, self.src, offset, count)
+
+        data = os.pread(self.src, count, offset)
+        return os.pwrite(self.dst, data, offset) if len(data) > 0 else 0
+
+
+def _write_range(copier: _Copier, start: int, end: int, zero_holes: bool) -> int:
+    """
+    Copy data extents of image between start and end and zero the holes between them on target.
+    Returns number of bytes copied.
+    """
+    copied = 0
+    position = start
+
+    for data_start, data_end in data_extents(copier.src, start, end):
+        if zero_holes:
+            _zeroout(copier.dst, position, data_start - position)
+        copier.copy(data_start, data_end - data_start)
+        copied += data_end - data_start
+        position = data_end
+
+    if zero_holes:
+        _zeroout(copier.dst, position, end - position)
+
+    return copied
+
+
+def deploy_image(image: str, target: str, zeroed: bool = False) -> dict:
+    """
+    Write filesystem image to target partition. Only data extents of the sparse image are
+    copied; holes are zeroed on target with BLKZEROOUT unless target is known to be zeroed
+    already (or left as holes when target is a file).
+    Returns {"size", "copied", "skipped", "seconds", "method"}.
+    """
+    start = time.monotonic()
+
+    src = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst = os.open(target, os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            size = os.fstat(src).st_size
+            target_size = _size(dst)
+            is_block = stat.S_ISBLK(os.fstat(dst).st_mode)
+
+            if size > target_size:
+                raise ValueError("Image {} ({} bytes) does not fit to {} ({} bytes)".format(
+                    image, size, target, target_size))
+
+            if not is_block:
+                # Fresh holes read as zeroes
+                os.ftruncate(dst, 0)
+                os.ftruncate(dst, size)
+
+            copier = _Copier(src, dst)
+            copied = _write_range(copier, 0, size, is_block and not zeroed)
+
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+    result = {
+        "size": size,
+        "copied": copied,
+        "skipped": size - copied,
+        "seconds": time.monotonic() - start,
+        "method": copier.method,
+    }
+
+    log.info("  Deployed {} to {}: {} MiB copied, {} MiB of holes skipped in {:.1f}s ({})".format(
+        os.path.basename(image), target, copied // 1024 ** 2, result["skipped"] // 1024 ** 2, result["seconds"],
+        result["method"]))
+
+    return result
+
+
+def hash_ranges(path: str, size: int, block_size: int = BLOCK_INDEX_SIZE, jobs: int = None) -> list:
+    """
+    Hash the first size bytes of file or device in block_size ranges with jobs threads.
+    Data is read through mmap; hashlib releases GIL so threads hash in parallel.
+    """
+    if size == 0:
+        return []
+
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+    finally:
+        os.close(fd)
+
+    view = memoryview(mm)
+
+    def digest(offset: int) -> str:
+        return hashlib.blake2b(view[offset:offset + block_size], digest_size=BLOCK_HASH_SIZE).hexdigest()
+
+    try:
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            return list(executor.map(digest, range(0, size, block_size)))
+    finally:
+        view.release()
+        mm.close()
+
+
+def block_index_path(image: str) -> str:
+    return image + BLOCK_INDEX_SUFFIX
+
+
+def write_block_index(image: str, block_size: int = BLOCK_INDEX_SIZE, jobs: int = None) -> dict:
+    """
+    Hash image for delta deployment and store the hashes next to it in <image>.index.
+    """
+    st = os.stat(image)
+    index = {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "block_size": block_size,
+        "hashes": hash_ranges(image, st.st_size, block_size, jobs),
+    }
+
+    tmp = block_index_path(image) + ".tmp"
+    with open(tmp, 'w', encoding="utf8") as f:
+        json.dump(index, f)
+    os.replace(tmp, block_index_path(image))
+
+    log.info("Block index {}: {} ranges of {} KiB".format(
+        block_index_path(image), len(index["hashes"]), block_size // 1024))
+
+    return index
+
+
+def read_block_index(image: str) -> dict:
+    """
+    Block index of image or None if it is missing or older than the image.
+    """
+    try:
+        with open(block_index_path(image), 'r', encoding="utf8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    st = os.stat(image)
+    if index.get("size") != st.st_size or index.get("mtime_ns") != st.st_mtime_ns:
+        return None
+
+    return index
+
+
+def delta_deploy_image(image: str, target: str, jobs: int = None) -> dict:
+    """
+    Write only the ranges of target which differ from image. Target is hashed range by
+    range and compared against the block index of image (built when missing).
+    Returns {"size", "written", "skipped", "seconds", "method"}.
+    """
+    start = time.monotonic()
+
+    index = read_block_index(image)
+    if index is None:
+        log.warning("  No up to date block index for {}. Hashing image.".format(image))
+        index = write_block_index(image, jobs=jobs)
+
+    size = index["size"]
+    block_size = index["block_size"]
+
+    src = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst = os.open(target, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            target_size = _size(dst)
+
+            if size > target_size:
+                raise ValueError("Image {} ({} bytes) does not fit to {} ({} bytes)".format(
+                    image, size, target, target_size))
+
+            hashes = hash_ranges(target, size, block_size, jobs)
+            copier = _Copier(src, dst)
+            written = 0
+
+            for idx, (expected, actual) in enumerate(zip(index["hashes"], hashes)):
+                if expected == actual:
+                    continue
+                range_start = idx * block_size
+                range_end = min(range_start + block_size, size)
+                _write_range(copier, range_start, range_end, True)
+                written += range_end - range_start
+
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+    result = {
+        "size": size,
+        "written": written,
+        "skipped": size - written,
+        "seconds": time.monotonic() - start,
+        "method": copier.method,
+    }
+
+    log.info("  Delta deployed {} to {}: {} MiB written, {} MiB unchanged in {:.1f}s ({})".format(
+        os.path.basename(image), target, written // 1024 ** 2, result["skipped"] // 1024 ** 2, result["seconds"],
+        result["method"]))
+
+    return result
+
+
+def e2fsck(device: str, parameters: list):
+    run = ["e2fsck"]
+    run.extend(parameters)
+    run.append(device)
+    log.debug("Running {}".format(" ".join(run)))
+    e2fsck_run = stream_run(run, check=False)
+
+    # 1: errors were corrected
+    if e2fsck_run.returncode > 1:
+        raise subprocess.CalledProcessError(e2fsck_run.returncode, run, e2fsck_run.stdout)
+
+    return e2fsck_run
+
+
+def grow_filesystem(device: str):
+    """
+    Grow deployed ext4 filesystem to fill its partition and give it an UUID of its own.
+    """
+    e2fsck(device, ["-f", "-p"])
+
+    for run in (["resize2fs", device], ["tune2fs", "-U", "random", device]):
+        log.debug("Running {}".format(" ".join(run)))
+        stream_run(run, check=True)
+
+
+def create_image(image: str, size: int):
+    """
+    Create sparse image file of size bytes with an empty ext4 filesystem.
+    metadata_csum_seed lets tune2fs change UUID of every deployed copy without rewriting metadata.
+    """
+    with open(image, 'wb') as f:
+        f.truncate(size)
+
+    run = ["mkfs.ext4", "-q", "-F", "-O", "metadata_csum_seed", image]
+    log.debug("Running {}".format(" ".join(run)))
+    stream_run(run, check=True)
+
+
+def shrink_image(image: str):
+    """
+    Finish image of a filesystem which has been installed and unmounted: check it,
+    punch holes to free blocks, shrink it to minimum size and truncate the file to match.
+    """
+    e2fsck(image, ["-f", "-y", "-E", "discard"])
+
+    run = ["resize2fs", "-M", image]
+    log.debug("Running {}".format(" ".join(run)))
+    stream_run(run, check=True)
+
+    size = ext4_size(image)
+    os.truncate(image, size)
+
+    allocated = os.stat(image).st_blocks * 512
+    log.info("Image {}: {} MiB, {} MiB allocated".format(image, size // 1024 ** 2, allocated // 1024 ** 2))
@@ -0,0 +1,163 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import contextlib
+
+from funcs import write_file_atomic
+
+# Live system keeps journals between reruns of the scripts
+JOURNAL_DIR = os.environ.get("PYARCHINSTALL_JOURNAL_DIR", "/var/lib/pyarchinstall")
+
+# Stages in installation order. --from-stage <stage> redoes the stage and every stage after it.
+STAGE_PARTITIONS = "partitions"
+STAGE_FILESYSTEMS = "filesystems"
+STAGE_MIRRORS = "mirrors"
+STAGE_PACKAGES = "packages"
+STAGES = [STAGE_PARTITIONS, STAGE_FILESYSTEMS, STAGE_MIRRORS, STAGE_PACKAGES]
+
+# Stage is stale when a stage it depends on has been redone since
+STAGE_DEPENDS = {
+    STAGE_FILESYSTEMS: [STAGE_PARTITIONS],
+    STAGE_PACKAGES: [STAGE_FILESYSTEMS],
+}
+
+
+def inputs_hash(inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """
+    sha256 of file contents, None when file does not exist.
+    """
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+class Journal:
+    """
+    Completed installation stages of one device and the inputs they were completed with:
+
+        journal = Journal("/dev/sda", block_device['ptuuid'])
+        if not journal.done("packages", packages):
+            pacstrap(...)
+            journal.complete("packages", packages)
+
+    Every completion gets a new id which is part of the inputs of the stages depending on it,
+    so redoing a stage makes later stages stale. Journal file is replaced atomically.
+
+    Device names are reused by other disks, so the partition table GUID (ptuuid) is recorded
+    with the partitions stage. No stage is done unless the disk still has that partition table.
+    """
+
+    def __init__(self, device: str, ptuuid: str = None, directory: str = JOURNAL_DIR):
+        self.device = device
+        self.ptuuid = ptuuid.lower() if ptuuid else None
+        self.path = os.path.join(directory, "{}.journal.json".format(os.path.basename(os.path.realpath(device))))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding="utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning("Ignoring broken journal {}: {}".format(self.path, e))
+            return {}
+
+        if data.get("device") != self.device:
+            return {}
+
+        return data.get("stages", {})
+
+    def _stages(self) -> dict:
+        """
+        Stages of the journal if they were completed on this disk, otherwise nothing.
+        """
+        stages = self._read()
+        recorded = stages.get(STAGE_PARTITIONS, {}).get("details", {}).get("ptuuid")
+
+        if self.ptuuid is None or recorded != self.ptuuid:
+            if len(stages) > 0:
+                log.debug("Journal {} is of partition table {}, not {}".format(self.path, recorded, self.ptuuid))
+            return {}
+
+        return stages
+
+    def _write(self, stages: dict):
+        write_file_atomic(self.path, json.dumps({"device": self.device, "stages": stages}, indent=2, sort_keys=True),
+                          0o600)
+
+    def _hash(self, stages: dict, stage: str, inputs) -> str:
+        upstream = [stages.get(dep, {}).get("id") for dep in STAGE_DEPENDS.get(stage, [])]
+        return inputs_hash([inputs, upstream])
+
+    def done(self, stage: str, inputs) -> bool:
+        """
+        True when stage has been completed with the same inputs after the stages it depends on.
+        """
+        stages = self._stages()
+
+        if stage not in stages:
+            return False
+
+        return stages[stage]["inputs"] == self._hash(stages, stage, inputs)
+
+    def details(self, stage: str) -> dict:
+        return self._stages().get(stage, {}).get("details", {})
+
+    def complete(self, stage: str, inputs, details: dict = None):
+        details = dict(details or {})
+        if stage == STAGE_PARTITIONS:
+            details["ptuuid"] = self.ptuuid
+
+        with self._locked():
+            # Stages of another disk are dropped
+            stages = self._stages()
+            stages[stage] = {
+                "inputs": self._hash(stages, stage, inputs),
+                "id": uuid.uuid4().hex,
+                "completed": time.time(),
+                "details": details,
+            }
+            self._write(stages)
+
+        log.debug("Journal: {} completed".format(stage))
+
+    def reset_from(self, stage: str):
+        """
+        Forget stage and every stage after it.
+        """
+        if stage not in STAGES:
+            raise ValueError("Unknown stage '{}'. Stages: {}".format(stage, ", ".join(STAGES)))
+
+        with self._locked():
+            stages = self._read()
+            for name in STAGES[STAGES.index(stage):]:
+                stages.pop(name, None)
+            self._write(stages)
+
+        log.info("Journal: redoing stages from {}".format(stage))
@@ -5,6 +5,9 @@ import logging
 log = logging.getLogger(__name__)
 
 from funcs import *
+from clock import *
+
+import asyncio
 
 __VERSION__ = "0.0.1"
 __AUTHOR__ = u"Pekka Järvinen"
@@ -19,7 +22,30 @@ __EXAMPLES__ = [
     u'-' * 60,
 ]
 
-UUID_SWAP = "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f"
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+async def prepare(device: str, partitionsfile: str, timeout: float) -> bool:
+    """
+    Wait for clock synchronization while partitioning the device.
+    Returns True if both succeeded.
+    """
+    run = [sys.executable, os.path.join(SCRIPT_DIR, "1part.py"), "--partitions", partitionsfile, "--device", device]
+    log.debug("Running {}".format(" ".join(run)))
+    partitioning = await asyncio.create_subprocess_exec(*run)
+
+    synchronized, returncode = await asyncio.gather(wait_clock_sync(timeout), partitioning.wait())
+
+    if synchronized:
+        log.info("System clock synchronized")
+    else:
+        log.error("System clock was not synchronized in {} seconds".format(timeout))
+
+    if returncode != 0:
+        log.error("Partitioning failed ({})".format(returncode))
+
+    return synchronized and returncode == 0
+
 
 if __name__ == "__main__":
 
@@ -35,12 +61,18 @@ if __name__ == "__main__":
     optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
                         help="Be verbose. -vvv.. Be more verbose.")
 
+    optional.add_argument('--trace <prefix>', dest='trace', default=None,
+                        help='Write timeline of every stage and command to <prefix>.jsonl and <prefix>.trace.json.')
+
     optional.add_argument('--config <file.ini>', '-c', type=argparse.FileType('r+', encoding='utf8'), dest='file',
                         help='Config file.', default="install.ini")
 
     optional.add_argument('--partitions <partitions>', '-p', type=argparse.FileType('r+', encoding='utf8'), dest='partitionsfile',
                         help='Partitions JSON file.', default="partitions.json")
 
+    optional.add_argument('--clock-timeout <seconds>', type=float, dest='clock_timeout', default=CLOCK_SYNC_TIMEOUT,
+                        help='Wait this long for clock synchronization. Default: {}.'.format(CLOCK_SYNC_TIMEOUT))
+
     required.add_argument('--device <block device>', '-d', action=FullPaths, type=is_block_device, dest='device',
                         required=True,
                         help='Target device (for example /dev/sda).')
@@ -53,36 +85,23 @@ if __name__ == "__main__":
         logging.getLogger().setLevel(logging.DEBUG)
         log.info("Being verbose")
 
-    ntp_is_in_sync = False
-
-    run_timedatectl_status = ["timedatectl", "status"]
-    log.info("Running {}".format(run_timedatectl_status))
-
-    timedatectl_status = subprocess.run(run_timedatectl_status, timeout=10, shell=True, check=True, stdout=subprocess.PIPE)
-
-    for i in timedatectl_status.stdout.decode('utf8').split("\n"):
-        i = i.strip()
-        if i.lower() == "System clock synchronized: yes".lower():
-            ntp_is_in_sync = True
-
-    if not ntp_is_in_sync:
-        run = ["timedatectl", "set-ntp", "true"]
-        log.debug("Running {}".format(" ".join(run)))
-        timedatectl_run = subprocess.run(run, timeout=10, check=True, stdout=subprocess.PIPE)
+    if args.trace is not None:
+        tracing.enable(args.trace)
 
-    while not ntp_is_in_sync:
-        log.info("Running {}".format(run_timedatectl_status))
-        timedatectl_status = subprocess.run(run_timedatectl_status, timeout=10, shell=True, check=True, stdout=subprocess.PIPE)
+    config = read_config_file(args.file)
+    ntp_server = config.get("time", "ntp", fallback="").strip()
 
-        for i in timedatectl_status.stdout.decode('utf8').split("\n"):
-            i = i.strip()
+    partitionsfile = os.path.abspath(args.partitionsfile.name)
+    args.partitionsfile.close()
 
-            if i.lower() == "System clock synchronized: yes".lower():
-                ntp_is_in_sync = True
+    if not clock_synchronized():
+        if ntp_server != "":
+            log.info("Using NTP server {}".format(ntp_server))
+            configure_ntp(ntp_server)
 
-        if not ntp_is_in_sync:
-            log.info("Waiting clock sync..")
-            time.sleep(1)
+        enable_ntp()
 
+    if not asyncio.run(prepare(args.device, partitionsfile, args.clock_timeout)):
+        sys.exit(1)
 
     log.info("Done.")
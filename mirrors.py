@@ -0,0 +1,299 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import ssl
+import time
+import json
+import socket
+import struct
+import hashlib
+import asyncio
+import tempfile
+import urllib.parse
+
+# rankmirrors also times download of the core repository database
+PROBE_REPO = "core"
+PROBE_ARCH = os.uname().machine
+PROBE_FILE = "{repo}.db"
+# Stop reading after this many bytes. Enough for a stable rate.
+PROBE_MAX_BYTES = 1024 * 1024
+
+MIRROR_CONNECTIONS = 16
+MIRROR_TIMEOUT = 5.0
+MIRROR_COUNT = 5
+
+MIRROR_CACHE_FILE = "/var/cache/pyarchinstall/mirrors.json"
+MIRROR_CACHE_TTL = 6 * 60 * 60
+# Cached top mirror must answer this fast or mirrors are ranked again
+MIRROR_HEALTH_TIMEOUT = 2.0
+
+
+def read_mirrorlist(lines) -> list:
+    """
+    Return server URLs from mirrorlist lines. Commented out servers are included.
+    """
+    servers = []
+
+    for line in lines:
+        line = line.strip().lstrip("#").strip()
+
+        if not line.lower().startswith("server"):
+            continue
+
+        key, sep, value = line.partition("=")
+
+        if sep == "" or key.strip().lower() != "server":
+            continue
+
+        value = value.strip()
+
+        if value != "" and value not in servers:
+            servers.append(value)
+
+    return servers
+
+
+def format_mirrorlist(servers: list) -> str:
+    return "".join(["Server = {}\n".format(s) for s in servers])
+
+
+def probe_url(server: str, repo: str = PROBE_REPO, arch: str = PROBE_ARCH) -> str:
+    base = server.replace("$repo", repo).replace("$arch", arch).rstrip("/")
+    return "{}/{}".format(base, PROBE_FILE.format(repo=repo))
+
+
+async def _http_get(url: str, max_bytes: int) -> tuple:
+    """
+    Minimal HTTP/1.1 GET. Returns (seconds to first byte, body bytes read, seconds reading body).
+    """
+    u = urllib.parse.urlsplit(url)
+
+    if u.scheme not in ("http", "https"):
+        raise ValueError("Unsupported scheme: {}".format(u.scheme))
+
+    port = u.port or (443 if u.scheme == "https" else 80)
+    path = u.path or "/"
+    if u.query:
+        path = "{}?{}".format(path, u.query)
+
+    start = time.monotonic()
+    reader, writer = await asyncio.open_connection(
+        u.hostname, port, ssl=ssl.create_default_context() if u.scheme == "https" else None)
+
+    try:
+        writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: pyarchinstall\r\nConnection: close\r\n\r\n".format(
+            path, u.netloc).encode("ascii"))
+        await writer.drain()
+
+        status = await reader.readline()
+        latency = time.monotonic() - start
+
+        parts = status.decode("latin-1").split()
+        if len(parts) < 2 or parts[1] != "200":
+            raise IOError("HTTP status: {}".format(status.decode("latin-1").strip()))
+
+        length = None
+        chunked = False
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = header.decode("latin-1").partition(":")
+            key = key.strip().lower()
+            if key == "content-length":
+                length = int(value.strip())
+            elif key == "transfer-encoding" and "chunked" in value.lower():
+                chunked = True
+
+        if length is not None:
+            max_bytes = min(max_bytes, length)
+
+        body_start = time.monotonic()
+        received = 0
+        # Rate is measured on raw bytes; chunk framing overhead is negligible
+        while received < max_bytes:
+            data = await reader.read(min(65536, max_bytes - received))
+            if data == b"":
+                break
+            received += len(data)
+
+        if received == 0 and not chunked and length != 0:
+            raise IOError("No data received")
+
+        return latency, received, time.monotonic() - body_start
+    finally:
+        writer.close()
+
+
+async def probe_mirror(server: str, semaphore: asyncio.Semaphore, timeout: float = MIRROR_TIMEOUT) -> dict:
+    """
+    Time download of a small file from server.
+    Returns dict with server, latency (s), rate (bytes/s), total (s) and error.
+    """
+    result = {"server": server, "latency": None, "rate": None, "total": None, "error": None}
+    url = probe_url(server)
+
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            latency, received, duration = await asyncio.wait_for(_http_get(url, PROBE_MAX_BYTES), timeout)
+        except Exception as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+            log.debug("Mirror {} failed: {}".format(server, result["error"]))
+            return result
+
+        result["latency"] = latency
+        result["rate"] = received / duration if duration > 0 else float(received)
+        result["total"] = time.monotonic() - start
+        log.debug("Mirror {} latency {:.3f}s rate {:.0f} B/s".format(server, latency, result["rate"]))
+
+    return result
+
+
+async def rank_mirrors_async(servers: list, connections: int = MIRROR_CONNECTIONS,
+                             timeout: float = MIRROR_TIMEOUT) -> list:
+    if connections < 1:
+        raise ValueError("Invalid connection count: {}".format(connections))
+
+    semaphore = asyncio.Semaphore(connections)
+    results = await asyncio.gather(*[probe_mirror(s, semaphore, timeout) for s in servers])
+
+    ok = [r for r in results if r["error"] is None]
+    # Fastest complete download first, lower latency breaks ties
+    ok.sort(key=lambda r: (r["total"], r["latency"]))
+    return ok
+
+
+def rank_mirrors(servers: list, count: int = MIRROR_COUNT, connections: int = MIRROR_CONNECTIONS,
+                 timeout: float = MIRROR_TIMEOUT) -> list:
+    """
+    Probe servers concurrently and return 'count' fastest server URLs.
+    """
+    results = asyncio.run(rank_mirrors_async(servers, connections, timeout))
+    log.info("{} of {} mirrors responded".format(len(results), len(servers)))
+
+    for r in results[:count]:
+        log.info("    {:.3f}s {:8.0f} KiB/s {}".format(r["latency"], r["rate"] / 1024, r["server"]))
+
+    return [r["server"] for r in results[:count]]
+
+
+def default_gateway(route_file: str = "/proc/net/route") -> str:
+    """
+    Return IPv4 default gateway of the running system or empty string.
+    """
+    try:
+        with open(route_file, 'r', encoding="utf8") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4 or fields[1] != "00000000" or not int(fields[3], 16) & 0x2:
+                    continue
+                return socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+    except (OSError, StopIteration, ValueError):
+        pass
+
+    return ""
+
+
+def network_identity(config=None) -> str:
+    """
+    Identify the network mirrors were ranked from.
+    Gateway from install.ini [network] section is preferred over the running system's default route.
+    """
+    if config is not None and config.has_option("network", "gateway"):
+        gateway = config.get("network", "gateway").strip()
+        if gateway != "":
+            return gateway
+
+    return default_gateway()
+
+
+def mirror_cache_key(servers: list, network: str) -> str:
+    h = hashlib.sha256()
+    h.update(format_mirrorlist(servers).encode("utf8"))
+    h.update(b"\0")
+    h.update(network.encode("utf8"))
+    return h.hexdigest()
+
+
+def read_mirror_cache(path: str, ttl: float, now: float = None) -> dict:
+    """
+    Read cache file. Entries older than ttl seconds are evicted.
+    """
+    if now is None:
+        now = time.time()
+
+    try:
+        with open(path, 'r', encoding="utf8") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.warning("Ignoring unreadable mirror cache {}: {}".format(path, e))
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+
+    return {k: v for k, v in cache.items() if now - v.get("time", 0) < ttl and len(v.get("servers", [])) > 0}
+
+
+def write_mirror_cache(path: str, cache: dict):
+    """
+    Replace cache file atomically so concurrent installs never see a partial file.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".mirrors.")
+    try:
+        with os.fdopen(fd, 'w', encoding="utf8") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def cached_rank_mirrors(servers: list, network: str, count: int = MIRROR_COUNT,
+                        connections: int = MIRROR_CONNECTIONS, timeout: float = MIRROR_TIMEOUT,
+                        cache_file: str = MIRROR_CACHE_FILE, ttl: float = MIRROR_CACHE_TTL) -> list:
+    """
+    rank_mirrors() with results cached per mirror list and network.
+    Cached ranking is used while it is younger than ttl, was ranked for at least count mirrors
+    and its top mirror passes a health probe.
+    """
+    key = mirror_cache_key(servers, network)
+    cache = read_mirror_cache(cache_file, ttl)
+
+    # Fewer mirrors than were asked for may have responded, so compare with the requested count
+    if key in cache and cache[key].get("count", len(cache[key]["servers"])) < count:
+        log.info("Cached mirror ranking has fewer than {} mirrors. Ranking again.".format(count))
+        del cache[key]
+
+    if key in cache:
+        cached = cache[key]["servers"]
+        health = asyncio.run(probe_mirror(cached[0], asyncio.Semaphore(1), min(timeout, MIRROR_HEALTH_TIMEOUT)))
+
+        if health["error"] is None:
+            log.info("Using cached mirror ranking from {}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cache[key]["time"]))))
+            return cached[:count]
+
+        log.info("Cached top mirror {} failed: {}. Ranking again.".format(cached[0], health["error"]))
+        del cache[key]
+
+    rankings = rank_mirrors(servers, count, connections, timeout)
+
+    if len(rankings) > 0:
+        cache[key] = {"time": time.time(), "network": network, "count": count, "servers": rankings}
+
+    try:
+        write_mirror_cache(cache_file, cache)
+    except OSError as e:
+        log.warning("Could not write mirror cache {}: {}".format(cache_file, e))
+
+    return rankings
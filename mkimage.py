@@ -0,0 +1,104 @@
+#!/bin/env/python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+from funcs import *
+from packages import *
+from images import *
+
+import tempfile
+
+__VERSION__ = "0.0.1"
+__AUTHOR__ = u"Pekka Järvinen"
+__YEAR__ = 2017
+__DESCRIPTION__ = u"Arch Installer - Build root filesystem image for 1part.py --image. Version {0}.".format(__VERSION__)
+__EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
+
+__EXAMPLES__ = [
+    u'',
+    u'-' * 60,
+    u'%(prog)s --image root.img',
+    u'%(prog)s --image root.img --packages packages.txt --size 16G',
+    u'-' * 60,
+]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__DESCRIPTION__,
+        epilog=__EPILOG__,
+        usage=os.linesep.join(__EXAMPLES__),
+    )
+
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+
+    optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
+                          help="Be verbose. -vvv.. Be more verbose.")
+
+    optional.add_argument('--packages <packages.txt>', dest='packagesfile', default="packages.txt",
+                          help='Packages installed in addition to base.')
+
+    optional.add_argument('--size <size>', dest='size', default=IMAGE_BUILD_SIZE,
+                          help='Room for installation while building. Image is shrunk afterwards. Default: {}.'.format(
+                              IMAGE_BUILD_SIZE))
+
+    optional.add_argument('--prefetched', action='store_true', dest='prefetched',
+                          help='Install from host package cache.')
+
+    required.add_argument('--image <root.img>', action=FullPaths, dest='image', required=True,
+                          help='Image file to create.')
+
+    parser._action_groups.append(optional)
+
+    args = parser.parse_args()
+
+    if int(args.verbose) > 0:
+        logging.getLogger().setLevel(logging.DEBUG)
+        log.info("Being verbose")
+
+    try:
+        sign, size = parse_sgdisk_size(args.size, 1)
+    except ValueError as e:
+        log.error("{}".format(e))
+        sys.exit(1)
+
+    packages = []
+    if os.path.isfile(args.packagesfile):
+        packages = read_packages_file(open(args.packagesfile, 'r', encoding="utf8"))
+    else:
+        log.info("No packages file {}. Installing base only.".format(args.packagesfile))
+
+    pacstrap_parameters = []
+    if args.prefetched:
+        pacstrap_parameters.append("-c")
+
+    with stage("Creating image"):
+        log.info("Creating {} ({} bytes sparse)".format(args.image, size))
+        create_image(args.image, size)
+
+    mountpoint = tempfile.mkdtemp(prefix="pyarchinstall-image.")
+
+    try:
+        mount(args.image, mountpoint, ["-o", "loop"])
+
+        try:
+            with stage("Installing packages"):
+                install_packages = package_set(packages)
+                log.info("Installing {} packages: {}".format(len(install_packages), " ".join(install_packages)))
+                pacstrap(mountpoint, install_packages, pacstrap_parameters)
+        finally:
+            unmount(mountpoint)
+    finally:
+        os.rmdir(mountpoint)
+
+    with stage("Shrinking image"):
+        shrink_image(args.image)
+
+    with stage("Indexing image"):
+        write_block_index(args.image)
+
+    log.info("Done. Deploy with: 1part.py --image {0} ... && 2mount.py ... && 3install.py --image ...".format(
+        args.image))
@@ -0,0 +1,317 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import json
+import socket
+import struct
+
+from runner import stream_run
+from funcs import write_file_atomic
+from configure import network_unit
+
+# Overridable so that links can be tested without real NICs (see bench/network)
+SYSFS_NET = os.environ.get("PYARCHINSTALL_SYSFS_NET", "/sys/class/net")
+# JSON list of links replayed as rtnetlink messages instead of asking the kernel
+NETLINK_FIXTURE = os.environ.get("PYARCHINSTALL_NETLINK_FIXTURE")
+
+# Runtime unit of the live system. Sorts before the ones the ISO ships.
+LIVE_NETWORK_UNIT = os.environ.get("PYARCHINSTALL_NETWORK_UNIT", "/run/systemd/network/10-pyarchinstall.network")
+# DHCP route metric of the chosen link. Other wired links of the ISO get 100 or more.
+UPLINK_ROUTE_METRIC = 10
+# Seconds to wait for the configured link to get its addresses and routes
+ONLINE_TIMEOUT = 60
+
+# <linux/netlink.h>, <linux/rtnetlink.h>, <linux/if_link.h>, <linux/if_addr.h>
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_OPERSTATE = 16
+IFLA_CARRIER = 33
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_LOWER_UP = 0x10000
+ARPHRD_ETHER = 1
+OPERSTATES = ["unknown", "notpresent", "down", "lowerlayerdown", "testing", "dormant", "up"]
+
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBi")
+RTATTR = struct.Struct("=HH")
+RECV_SIZE = 64 * 1024
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def parse_attributes(data: bytes) -> dict:
+    """
+    {type: payload} of rtattrs in data.
+    """
+    attributes = {}
+    offset = 0
+
+    while offset + RTATTR.size <= len(data):
+        length, kind = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[kind] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+
+    return attributes
+
+
+def parse_messages(data: bytes):
+    """
+    Yield (type, flags, payload) of netlink messages in data.
+    """
+    offset = 0
+
+    while offset + NLMSGHDR.size <= len(data):
+        length, kind, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield kind, flags, data[offset + NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+
+def netlink_dump(sock: socket.socket, kind: int, request: bytes, seq: int) -> list:
+    """
+    Payloads of every message answering dump request kind.
+    """
+    sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(request), kind, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + request)
+
+    payloads = []
+
+    while True:
+        for message, flags, payload in parse_messages(sock.recv(RECV_SIZE)):
+            if message == NLMSG_DONE:
+                return payloads
+            if message == NLMSG_ERROR:
+                error, = struct.unpack_from("=i", payload)
+                if error != 0:
+                    raise OSError(-error, os.strerror(-error))
+                return payloads
+            payloads.append(payload)
+
+
+def rtnetlink_links() -> tuple:
+    """
+    (link payloads, address payloads) from the kernel over one rtnetlink socket.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        links = netlink_dump(sock, RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0), 1)
+        addresses = netlink_dump(sock, RTM_GETADDR, IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0), 2)
+    finally:
+        sock.close()
+
+    return links, addresses
+
+
+def parse_link(payload: bytes) -> dict:
+    family, kind, index, flags, change = IFINFOMSG.unpack_from(payload)
+    attributes = parse_attributes(payload[IFINFOMSG.size:])
+
+    operstate = None
+    if IFLA_OPERSTATE in attributes:
+        state = attributes[IFLA_OPERSTATE][0]
+        operstate = OPERSTATES[state] if state < len(OPERSTATES) else str(state)
+
+    carrier = None
+    if IFLA_CARRIER in attributes:
+        carrier = attributes[IFLA_CARRIER][0] == 1
+    elif flags & IFF_UP:
+        carrier = flags & IFF_LOWER_UP != 0
+
+    return {
+        "index": index,
+        "name": attributes.get(IFLA_IFNAME, b"").rstrip(b"\0").decode('utf8', 'replace'),
+        "type": kind,
+        "up": flags & IFF_UP != 0,
+        "loopback": flags & IFF_LOOPBACK != 0,
+        "mac": ":".join("{:02x}".format(b) for b in attributes.get(IFLA_ADDRESS, b"")) or None,
+        "mtu": struct.unpack("=I", attributes[IFLA_MTU])[0] if IFLA_MTU in attributes else None,
+        "operstate": operstate,
+        "carrier": carrier,
+        "addresses": [],
+    }
+
+
+def parse_address(payload: bytes) -> tuple:
+    """
+    (link index, "address/prefix") of an IPv4 address message.
+    """
+    family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(payload)
+    attributes = parse_attributes(payload[IFADDRMSG.size:])
+    address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+
+    if address is None:
+        return index, None
+
+    return index, "{}/{}".format(socket.inet_ntop(family, address), prefixlen)
+
+
+def _attribute(kind: int, value: bytes) -> bytes:
+    data = RTATTR.pack(RTATTR.size + len(value), kind) + value
+    return data + b"\0" * (_align(len(data)) - len(data))
+
+
+def encode_link(link: dict) -> bytes:
+    """
+    RTM_NEWLINK payload of link in the format of parse_link(). Used for fixtures.
+    """
+    flags = (IFF_UP if link.get('up') else 0) | (IFF_LOOPBACK if link.get('loopback') else 0)
+    if link.get('carrier'):
+        flags |= IFF_LOWER_UP
+
+    payload = IFINFOMSG.pack(socket.AF_UNSPEC, link.get('type', ARPHRD_ETHER), link['index'], flags, 0)
+    payload += _attribute(IFLA_IFNAME, link['name'].encode('utf8') + b"\0")
+    if link.get('mac'):
+        payload += _attribute(IFLA_ADDRESS, bytes(int(b, 16) for b in link['mac'].split(":")))
+    if link.get('mtu'):
+        payload += _attribute(IFLA_MTU, struct.pack("=I", link['mtu']))
+    if link.get('operstate') in OPERSTATES:
+        payload += _attribute(IFLA_OPERSTATE, bytes([OPERSTATES.index(link['operstate'])]))
+    payload += _attribute(IFLA_CARRIER, bytes([1 if link.get('carrier') else 0]))
+
+    return payload
+
+
+def encode_address(index: int, address: str) -> bytes:
+    ip, prefixlen = address.split("/")
+    payload = IFADDRMSG.pack(socket.AF_INET, int(prefixlen), 0, 0, index)
+    return payload + _attribute(IFA_LOCAL, socket.inet_pton(socket.AF_INET, ip))
+
+
+def fixture_links(path: str) -> tuple:
+    """
+    (link payloads, address payloads) of links in JSON file, like rtnetlink_links() returns them.
+    """
+    with open(path, 'r', encoding="utf8") as f:
+        links = json.load(f)
+
+    return ([encode_link(link) for link in links],
+            [encode_address(link['index'], address) for link in links for address in link.get('addresses', [])])
+
+
+def read_sysfs_link(name: str, sysfs_net: str = SYSFS_NET) -> dict:
+    """
+    Speed (Mb/s), duplex and kind of link from sysfs. Unknown values are None.
+    """
+    path = os.path.join(sysfs_net, name)
+
+    def read(key: str) -> str:
+        try:
+            with open(os.path.join(path, key), 'r') as f:
+                return f.read().strip()
+        except OSError:
+            # Reading speed of a link without carrier fails with EINVAL
+            return None
+
+    speed = read("speed")
+    try:
+        speed = int(speed)
+    except (TypeError, ValueError):
+        speed = None
+    if speed is not None and speed <= 0:
+        speed = None
+
+    duplex = read("duplex")
+    if duplex not in ("full", "half"):
+        duplex = None
+
+    return {
+        "speed": speed,
+        "duplex": duplex,
+        # Virtual links (bridges, veth, tun) have no device
+        "physical": os.path.exists(os.path.join(path, "device")),
+        "wireless": os.path.exists(os.path.join(path, "wireless")),
+    }
+
+
+def get_links(sysfs_net: str = SYSFS_NET, fixture: str = NETLINK_FIXTURE) -> list:
+    """
+    Network links with state from rtnetlink and speed and duplex from sysfs, sorted by index.
+    """
+    if fixture is not None:
+        link_payloads, address_payloads = fixture_links(fixture)
+    else:
+        link_payloads, address_payloads = rtnetlink_links()
+
+    links = {}
+    for payload in link_payloads:
+        link = parse_link(payload)
+        link.update(read_sysfs_link(link['name'], sysfs_net))
+        links[link['index']] = link
+
+    for payload in address_payloads:
+        index, address = parse_address(payload)
+        if index in links and address is not None:
+            links[index]['addresses'].append(address)
+
+    return [links[index] for index in sorted(links)]
+
+
+def rank_links(links: list) -> list:
+    """
+    Physical Ethernet and wireless links with carrier, fastest first. Full duplex wins at the same
+    speed, wired wins over wireless and links of unknown speed come last.
+    """
+    uplinks = [link for link in links if link['type'] == ARPHRD_ETHER and not link['loopback'] and
+               link['physical'] and link['carrier']]
+
+    return sorted(uplinks, key=lambda link: (-(link['speed'] or 0), link['duplex'] != "full", link['wireless'],
+                                             link['index']))
+
+
+def log_links(links: list):
+    log.info("    {:<16} {:<10} {:<8} {:>10} {:<6} {:<17} {}".format(
+        "name", "state", "carrier", "speed", "duplex", "mac", "addresses"))
+
+    for link in links:
+        log.info("    {:<16} {:<10} {:<8} {:>10} {:<6} {:<17} {}".format(
+            link['name'], link['operstate'] or "-", "yes" if link['carrier'] else "no",
+            "{} Mb/s".format(link['speed']) if link['speed'] else "-", link['duplex'] or "-", link['mac'] or "-",
+            " ".join(link['addresses']) or "-"))
+
+
+def networkctl(parameters: list):
+    run = ["networkctl"]
+    run.extend(parameters)
+    log.debug("Running {}".format(" ".join(run)))
+    return stream_run(run, timeout=30, check=True)
+
+
+def wait_online(interface: str, timeout: float = ONLINE_TIMEOUT):
+    run = ["systemd-networkd-wait-online", "--interface={}".format(interface), "--timeout={}".format(int(timeout))]
+    log.debug("Running {}".format(" ".join(run)))
+    return stream_run(run, timeout=timeout + 10, check=True)
+
+
+def apply_network(config, link: dict, unit: str = LIVE_NETWORK_UNIT, timeout: float = ONLINE_TIMEOUT):
+    """
+    Configure link of the live system with install.ini [network] and make it the default route.
+    Returns once the link is configured, so downloads after it go over the link.
+    """
+    os.makedirs(os.path.dirname(unit), exist_ok=True)
+    write_file_atomic(unit, network_unit(config, link['name'], UPLINK_ROUTE_METRIC))
+    log.debug("Wrote {}".format(unit))
+
+    networkctl(["reload"])
+    networkctl(["reconfigure", link['name']])
+    wait_online(link['name'], timeout)
@@ -0,0 +1,189 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import io
+import os
+import re
+import time
+import stat
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import tracing
+from funcs import write_file_atomic
+
+PACMAN_CACHE_DIR = "/var/cache/pacman/pkg"
+BASE_PACKAGES = ["base"]
+PACMAN_CONF = "/etc/pacman.conf"
+# pacman.conf of the running system. Overridable so that benchmarks do not change the host's.
+LIVE_PACMAN_CONF = os.environ.get("PYARCHINSTALL_PACMAN_CONF", PACMAN_CONF)
+# Installed packages of a root
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+PARALLEL_DOWNLOADS = 5
+
+PARALLEL_DOWNLOADS_RE = re.compile(r"^\s*#?\s*ParallelDownloads\s*=.*$")
+
+
+def read_packages_file(wrapper: io.TextIOBase) -> list:
+    """
+    Read package names, one per line. Blank lines and # comments are skipped and duplicates removed.
+    """
+    if not isinstance(wrapper, io.TextIOBase):
+        raise TypeError("Wrong type: {}".format(type(wrapper)))
+
+    packages = []
+
+    with wrapper as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+
+            if line == "":
+                continue
+
+            for package in line.split():
+                if package not in packages:
+                    packages.append(package)
+
+    return packages
+
+
+def package_set(packages: list) -> list:
+    """
+    Return base packages followed by given packages without duplicates.
+    """
+    result = []
+
+    for package in BASE_PACKAGES + packages:
+        if package not in result:
+            result.append(package)
+
+    return result
+
+
+def parallel_downloads(config=None) -> tuple:
+    """
+    Return (live system, target) ParallelDownloads values from install.ini [pacman] section.
+    """
+    live = PARALLEL_DOWNLOADS
+    if config is not None:
+        live = config.getint("pacman", "parallel_downloads", fallback=PARALLEL_DOWNLOADS)
+
+    target = live
+    if config is not None:
+        target = config.getint("pacman", "target_parallel_downloads", fallback=live)
+
+    for value in (live, target):
+        if value < 1:
+            raise ValueError("Invalid ParallelDownloads value: {}".format(value))
+
+    return live, target
+
+
+def set_parallel_downloads(pacman_conf: str, count: int):
+    """
+    Set ParallelDownloads in [options] section of pacman.conf.
+    Existing (also commented out) setting is replaced, otherwise it is added to the section.
+    """
+    with open(pacman_conf, 'r', encoding="utf8") as f:
+        lines = f.read().split("\n")
+
+    setting = "ParallelDownloads = {}".format(count)
+    section = None
+    options_line = None
+    replaced = False
+
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped[1:-1]
+            if section == "options":
+                options_line = idx
+            continue
+
+        if section == "options" and not replaced and PARALLEL_DOWNLOADS_RE.match(line):
+            lines[idx] = setting
+            replaced = True
+
+    if not replaced:
+        if options_line is None:
+            lines[0:0] = ["[options]", setting, ""]
+        else:
+            lines.insert(options_line + 1, setting)
+
+    # Several installers may rewrite the live pacman.conf at the same time
+    write_file_atomic(pacman_conf, "\n".join(lines), stat.S_IMODE(os.stat(pacman_conf).st_mode))
+
+    log.info("{}: {}".format(pacman_conf, setting))
+
+
+class PackagePrefetch:
+    """
+    Download packages and all of their dependencies into a pacman cache directory in background.
+    An empty temporary pacman database is used so that packages already installed on
+    the running system are downloaded too.
+    """
+
+    def __init__(self, packages: list, cachedir: str = PACMAN_CACHE_DIR):
+        self.packages = packages
+        self.cachedir = cachedir
+        self.start_time = None
+        self.end_time = None
+        self.returncode = None
+        self.stderr = b""
+        self._thread = None
+
+    def start(self):
+        dbpath = tempfile.mkdtemp(prefix="pyarchinstall-db.")
+
+        run = ["pacman", "-Syw", "--noconfirm", "--dbpath", dbpath, "--cachedir", self.cachedir]
+        run.extend(self.packages)
+        log.debug("Running {}".format(" ".join(run)))
+
+        self.start_time = time.monotonic()
+        start = time.time()
+        process = subprocess.Popen(run, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+
+        def wait():
+            try:
+                _, self.stderr = process.communicate()
+                self.returncode = process.returncode
+                self.end_time = time.monotonic()
+                tracing.record_command(run, start, self.end_time - self.start_time, self.returncode, 0)
+            finally:
+                shutil.rmtree(dbpath, ignore_errors=True)
+
+        self._thread = threading.Thread(target=wait, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def wait(self) -> bool:
+        if self._thread is None:
+            raise RuntimeError("Prefetch was not started")
+
+        self._thread.join()
+
+        if self.returncode != 0:
+            log.error("Package prefetch failed ({}): {}".format(
+                self.returncode, self.stderr.decode('utf8', 'replace').strip()))
+            return False
+
+        return True
+
+    @property
+    def duration(self) -> float:
+        return self.end_time - self.start_time
+
+    def report(self, work_end: float):
+        """
+        Log how much wall-clock time running download alongside work (which ended at work_end) saved.
+        """
+        work = work_end - self.start_time
+        elapsed = max(work_end, self.end_time) - self.start_time
+        saved = work + self.duration - elapsed
+
+        log.info("Package download took {:.1f}s, other work {:.1f}s, overlap saved {:.1f}s".format(
+            self.duration, work, saved))
@@ -0,0 +1,329 @@
+#!/bin/env/python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+from funcs import *
+from mirrors import read_mirrorlist
+
+import shutil
+import tempfile
+import threading
+import collections
+import http.server
+import urllib.error
+import urllib.parse
+import urllib.request
+
+__VERSION__ = "0.0.1"
+__AUTHOR__ = u"Pekka Järvinen"
+__YEAR__ = 2017
+__DESCRIPTION__ = u"Arch Installer - Caching package proxy for LAN installs. Version {0}.".format(__VERSION__)
+__EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
+
+__EXAMPLES__ = [
+    u'',
+    u'-' * 60,
+    u'%(prog)s',
+    u'%(prog)s -u https://mirror.example/archlinux -s 20G',
+    u'-' * 60,
+    u'Other installers: 3install.py --mirror-proxy http://<this host>:8080',
+]
+
+PROXY_PORT = 8080
+PROXY_CACHE_DIR = "/var/cache/pyarchinstall/proxy"
+PROXY_CACHE_SIZE = "10G"
+PROXY_TIMEOUT = 60
+MIRROR_PATH_SUFFIX = "/$repo/os/$arch"
+
+# Package files never change once published. Databases do and are always fetched from upstream.
+CACHEABLE_SUFFIXES = (".pkg.tar.zst", ".pkg.tar.xz", ".pkg.tar.gz", ".pkg.tar", ".sig")
+# Signatures of databases change with their database
+PASS_THROUGH_SUFFIXES = (".db.sig", ".files.sig")
+
+
+def cacheable(relpath: str) -> bool:
+    return relpath.endswith(CACHEABLE_SUFFIXES) and not relpath.endswith(PASS_THROUGH_SUFFIXES)
+
+
+def upstream_base(server: str) -> str:
+    """
+    Turn mirrorlist server (https://host/archlinux/$repo/os/$arch) into base URL (https://host/archlinux).
+    """
+    if server.endswith(MIRROR_PATH_SUFFIX):
+        server = server[:-len(MIRROR_PATH_SUFFIX)]
+
+    if "$" in server:
+        raise ValueError("Unsupported mirror URL: {}".format(server))
+
+    return server.rstrip("/")
+
+
+class PackageCache:
+    """
+    Package files on disk with least recently used eviction once total size exceeds max_size.
+    Concurrent requests for the same missing file share one upstream download.
+    """
+
+    def __init__(self, directory: str, max_size: int, upstream: str, timeout: float = PROXY_TIMEOUT):
+        self.directory = directory
+        self.max_size = max_size
+        self.upstream = upstream.rstrip("/")
+        self.timeout = timeout
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # relative path -> size, least recently used first
+        self._files = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith("."):
+                    # Leftover partial download
+                    os.unlink(path)
+                    continue
+                st = os.stat(path)
+                found.append((st.st_mtime, os.path.relpath(path, self.directory), st.st_size))
+
+        for _, relpath, size in sorted(found):
+            self._files[relpath] = size
+            self.size += size
+
+        self._evict()
+        log.info("Cache {} has {} files, {} bytes".format(self.directory, len(self._files), self.size))
+
+    def _evict(self):
+        # Caller holds the lock or is the constructor
+        while self.size > self.max_size and len(self._files) > 0:
+            relpath, size = self._files.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.directory, relpath))
+            except FileNotFoundError:
+                pass
+            log.debug("Evicted {}".format(relpath))
+
+    def path(self, relpath: str) -> str:
+        return os.path.join(self.directory, relpath)
+
+    def _open_hit(self, relpath: str):
+        # Caller holds the lock. The open file stays readable if it is evicted afterwards.
+        f = open(self.path(relpath), 'rb')
+        self._files.move_to_end(relpath)
+        self.hits += 1
+        return f
+
+    def open(self, relpath: str):
+        """
+        Return cached file of relpath opened for reading, downloading it from upstream first if needed.
+        """
+        with self._lock:
+            if relpath in self._files:
+                return self._open_hit(relpath)
+
+            event = self._inflight.get(relpath)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self._inflight[relpath] = event
+                self.misses += 1
+
+        if not owner:
+            event.wait()
+            with self._lock:
+                if relpath not in self._files:
+                    raise IOError("Upstream download of {} failed".format(relpath))
+                return self._open_hit(relpath)
+
+        try:
+            size = self._download(relpath)
+            with self._lock:
+                self._files[relpath] = size
+                self.size += size
+                self._evict()
+                if relpath not in self._files:
+                    raise IOError("{} ({} bytes) does not fit in cache".format(relpath, size))
+                return open(self.path(relpath), 'rb')
+        finally:
+            with self._lock:
+                del self._inflight[relpath]
+            event.set()
+
+    def _download(self, relpath: str) -> int:
+        url = "{}/{}".format(self.upstream, relpath)
+        destination = self.path(relpath)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        log.info("Fetching {}".format(url))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destination), prefix=".")
+        try:
+            with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(url, timeout=self.timeout) as r:
+                shutil.copyfileobj(r, f, 1024 * 1024)
+                size = f.tell()
+            os.replace(tmp, destination)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        return size
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "pyarchinstall-proxy/{}".format(__VERSION__)
+    protocol_version = "HTTP/1.1"
+
+    def relpath(self):
+        path = urllib.parse.unquote(self.path.split("?", 1)[0]).lstrip("/")
+        parts = path.split("/")
+        if path == "" or ".." in parts or "" in parts:
+            return None
+        return path
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def handle_request(self, send_body: bool):
+        cache = self.server.cache
+        relpath = self.relpath()
+
+        if relpath is None:
+            self.send_error(404)
+            return
+
+        try:
+            if cacheable(relpath):
+                with cache.open(relpath) as f:
+                    self.send_file(f, send_body)
+            else:
+                self.pass_through(relpath, send_body)
+        except urllib.error.HTTPError as e:
+            self.send_error(e.code)
+        except (OSError, urllib.error.URLError) as e:
+            log.error("{}: {}".format(relpath, e))
+            self.send_error(502)
+
+    def send_file(self, f, send_body: bool):
+        size = os.fstat(f.fileno()).st_size
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if send_body:
+            self.wfile.flush()
+            # Package files go straight from page cache to socket
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+    def pass_through(self, relpath: str, send_body: bool):
+        url = "{}/{}".format(self.server.cache.upstream, relpath)
+        request = urllib.request.Request(url, method="GET" if send_body else "HEAD")
+
+        with urllib.request.urlopen(request, timeout=self.server.cache.timeout) as r:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            length = r.headers.get("Content-Length")
+            if length is not None:
+                self.send_header("Content-Length", length)
+            else:
+                self.close_connection = True
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(r, self.wfile, 1024 * 1024)
+
+    def log_message(self, format, *args):
+        log.debug("{} {}".format(self.address_string(), format % args))
+
+
+class ProxyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache: PackageCache):
+        super().__init__(address, ProxyHandler)
+        self.cache = cache
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__DESCRIPTION__,
+        epilog=__EPILOG__,
+        usage=os.linesep.join(__EXAMPLES__),
+    )
+
+    optional = parser._action_groups.pop()
+
+    optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
+                          help="Be verbose. -vvv.. Be more verbose.")
+
+    optional.add_argument('--upstream <url>', '-u', dest='upstream', default=None,
+                          help='Upstream mirror. Default: first server in /etc/pacman.d/mirrorlist.')
+
+    optional.add_argument('--listen <address>', '-l', dest='address', default="0.0.0.0",
+                          help='Listen address. Default: 0.0.0.0.')
+
+    optional.add_argument('--port <port>', '-P', type=int, dest='port', default=PROXY_PORT,
+                          help='Listen port. Default: {}.'.format(PROXY_PORT))
+
+    optional.add_argument('--cache-dir <directory>', action=FullPaths, dest='cachedir', default=PROXY_CACHE_DIR,
+                          help='Package cache directory. Default: {}.'.format(PROXY_CACHE_DIR))
+
+    optional.add_argument('--cache-size <size>', '-s', dest='cachesize', default=PROXY_CACHE_SIZE,
+                          help='Maximum cache size (for example 500M, 20G). Default: {}.'.format(PROXY_CACHE_SIZE))
+
+    parser._action_groups.append(optional)
+
+    args = parser.parse_args()
+
+    if int(args.verbose) > 0:
+        logging.getLogger().setLevel(logging.DEBUG)
+        log.info("Being verbose")
+
+    upstream = args.upstream
+    if upstream is None:
+        with open(os.path.join("/etc", "pacman.d", "mirrorlist"), 'r', encoding="utf8") as f:
+            servers = read_mirrorlist(l for l in f if not l.lstrip().startswith("#"))
+        if len(servers) == 0:
+            log.error("No servers in /etc/pacman.d/mirrorlist")
+            sys.exit(1)
+        upstream = servers[0]
+
+    try:
+        upstream = upstream_base(upstream)
+        sign, cachesize = parse_sgdisk_size(args.cachesize, 1)
+        if sign != "" or cachesize == 0:
+            raise ValueError("Invalid cache size: {}".format(args.cachesize))
+    except ValueError as e:
+        log.error("{}".format(e))
+        sys.exit(1)
+
+    cache = PackageCache(args.cachedir, cachesize, upstream)
+    server = ProxyServer((args.address, args.port), cache)
+
+    log.info("Serving {} on {}:{}".format(upstream, args.address, args.port))
+    log.info("Mirror list line: Server = http://<this host>:{}{}".format(args.port, MIRROR_PATH_SUFFIX))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    log.info("Cache hits {}, misses {}".format(cache.hits, cache.misses))
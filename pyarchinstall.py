@@ -0,0 +1,254 @@
+#!/bin/env/python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import sys
+import argparse
+import importlib
+import threading
+
+__VERSION__ = "0.0.1"
+__AUTHOR__ = u"Pekka Järvinen"
+__YEAR__ = 2017
+__DESCRIPTION__ = u"Arch Installer - All stages in one process. Version {0}.".format(__VERSION__)
+__EPILOG__ = u"%(prog)s v{0} (c) {1} {2}-".format(__VERSION__, __AUTHOR__, __YEAR__)
+
+__EXAMPLES__ = [
+    u'',
+    u'-' * 60,
+    u'%(prog)s all --device /dev/sda',
+    u'%(prog)s all --reconcile --yes --image root.img --device /dev/sda',
+    u'%(prog)s part --partitions partitions.json --device /dev/sda',
+    u'%(prog)s mount --device /dev/sda',
+    u'%(prog)s <command> --help',
+    u'-' * 60,
+]
+
+# Command: script module. Modules are imported only when their command runs so that
+# startup does not pay for the ones which are not used.
+COMMANDS = {
+    "part": "1part",
+    "mount": "2mount",
+    "install": "3install",
+    "network": "5network",
+}
+
+# Commands run by 'all' in this order. Network is first so that downloads use the fastest uplink.
+PIPELINE = ["network", "part", "mount", "install"]
+
+
+def run_command(command: str, argv: list) -> int:
+    """
+    Run script of command in this process with argv. Returns exit code.
+    """
+    module = importlib.import_module(COMMANDS[command])
+
+    try:
+        module.run(module.parse_arguments(argv))
+    except SystemExit as e:
+        # Scripts stop early with sys.exit(); 0 is a finished stage
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        return 1
+
+    return 0
+
+
+def parse_all_arguments(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="{} all".format(os.path.basename(sys.argv[0])),
+        description=u"Select network uplink, partition, mount and install in one process.",
+        epilog=__EPILOG__,
+    )
+
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+
+    optional.add_argument('--verbose', '-v', action='count', required=False, default=0, dest='verbose',
+                          help="Be verbose. -vvv.. Be more verbose.")
+
+    optional.add_argument('--trace <prefix>', dest='trace', default=None,
+                          help='Write timeline of every stage and command to <prefix>.jsonl and <prefix>.trace.json.')
+
+    optional.add_argument('--config <file.ini>', '-c', dest='configfile', default="install.ini",
+                          help='Config file. Used when it exists. Default: install.ini.')
+
+    optional.add_argument('--partitions <partitions.json>', '-p', dest='partitionsfile', default="partitions.json",
+                          help='Partitions JSON file. Default: partitions.json.')
+
+    optional.add_argument('--packages <packages.txt>', dest='packagesfile', default="packages.txt",
+                          help='Packages installed in addition to base.')
+
+    optional.add_argument('--prefix <directory>', '-P', dest='prefix', default=None,
+                          help='Installation directory.')
+
+    optional.add_argument('--jobs <count>', '-j', dest='jobs', default=None,
+                          help='Wipe and format this many partitions concurrently.')
+
+    optional.add_argument('--wipe <method>', dest='wipe', default=None,
+                          help='How device is wiped before partitioning. See: part --help.')
+
+    optional.add_argument('--image <root.img>', dest='image', default=None,
+                          help='Copy filesystem image made with mkimage.py to root partition instead of installing packages.')
+
+    optional.add_argument('--reconcile', action='store_true', dest='reconcile',
+                          help='Change only partitions which differ from partitions file.')
+
+    optional.add_argument('--prefetch', action='store_true', dest='prefetch',
+                          help='Download packages in background while partitioning.')
+
+    optional.add_argument('--cache-dir <directory>', dest='cachedir', default=None,
+                          help='Package cache of --prefetch.')
+
+    optional.add_argument('--skip-mirrors', action='store_true', dest='skip_mirrors',
+                          help='Do not rank mirrors. Use current pacman mirror list as is.')
+
+    optional.add_argument('--clock-timeout <seconds>', type=float, dest='clock_timeout', default=None,
+                          help='Wait this long for clock synchronization.')
+
+    optional.add_argument('--yes', '-y', action='store_true', dest='yes',
+                          help='Do not ask for confirmation before changing target device.')
+
+    required.add_argument('--device <block device>', '-d', dest='device', required=True,
+                          help='Target device (for example /dev/sda).')
+
+    parser._action_groups.append(optional)
+
+    return parser.parse_args(argv)
+
+
+def pipeline_arguments(args: argparse.Namespace) -> dict:
+    """
+    Arguments of every command of the pipeline from arguments of 'all'.
+    """
+    common = ["-v"] * args.verbose
+    device = ["--device", args.device]
+    partitions = ["--partitions", args.partitionsfile]
+    prefix = [] if args.prefix is None else ["--prefix", args.prefix]
+
+    part = common + partitions
+    if args.jobs is not None:
+        part.extend(["--jobs", args.jobs])
+    if args.wipe is not None:
+        part.extend(["--wipe", args.wipe])
+    if args.image is not None:
+        part.extend(["--image", args.image])
+    if args.reconcile:
+        part.append("--reconcile")
+    cachedir = [] if args.cachedir is None else ["--cache-dir", args.cachedir]
+
+    if args.prefetch:
+        part.extend(["--prefetch", "--packages", args.packagesfile] + cachedir)
+    if args.yes:
+        part.append("--yes")
+
+    config = ["--config", args.configfile] if os.path.isfile(args.configfile) else []
+
+    install = common + partitions + prefix + ["--packages", args.packagesfile] + config
+    if args.image is not None:
+        install.append("--image")
+    if args.prefetch:
+        install.extend(["--prefetched"] + cachedir)
+    if args.skip_mirrors:
+        install.append("--skip-mirrors")
+
+    return {
+        "part": part + device,
+        "mount": common + partitions + prefix + device,
+        "install": install + device,
+        # Image deploys download nothing and work offline
+        "network": common + config + (["--optional"] if args.image is not None else []),
+    }
+
+
+def run_all(argv: list) -> int:
+    args = parse_all_arguments(argv)
+
+    # Loaded here to keep 'pyarchinstall.py <command> --help' fast
+    import asyncio
+    import tracing
+    from funcs import load_config_file
+    from clock import CLOCK_SYNC_TIMEOUT, clock_synchronized, configure_ntp, enable_ntp, wait_clock_sync
+
+    if int(args.verbose) > 0:
+        logging.getLogger().setLevel(logging.DEBUG)
+        log.info("Being verbose")
+
+    if args.trace is not None:
+        tracing.enable(args.trace)
+
+    # Same parsed config is used by every stage
+    ntp_server = ""
+    if os.path.isfile(args.configfile):
+        config = load_config_file(open(args.configfile, 'r', encoding="utf8"))
+        ntp_server = config.get("time", "ntp", fallback="").strip()
+
+    if not clock_synchronized():
+        if ntp_server != "":
+            log.info("Using NTP server {}".format(ntp_server))
+            configure_ntp(ntp_server)
+
+        enable_ntp()
+
+    # Clock synchronizes while partitioning. Packages are verified against it.
+    synchronized = []
+    clock_timeout = args.clock_timeout if args.clock_timeout is not None else CLOCK_SYNC_TIMEOUT
+
+    def wait_clock():
+        try:
+            synchronized.append(asyncio.run(wait_clock_sync(clock_timeout)))
+        except Exception as e:
+            # adjtimex, timerfd or inotify failed: same as not synchronized
+            log.error("Waiting for clock synchronization failed: {}".format(e))
+            synchronized.append(False)
+
+    clock = threading.Thread(target=wait_clock, daemon=True)
+    clock.start()
+
+    arguments = pipeline_arguments(args)
+
+    for command in PIPELINE:
+        log.info("Running {}".format(command))
+        returncode = run_command(command, arguments[command])
+
+        if returncode != 0:
+            log.error("{} failed ({})".format(command, returncode))
+            return returncode
+
+        if command == "part":
+            clock.join()
+            if not synchronized[0]:
+                log.error("System clock was not synchronized in {} seconds".format(clock_timeout))
+                return 1
+            log.info("System clock synchronized")
+
+    log.info("Done.")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__DESCRIPTION__,
+        epilog=__EPILOG__,
+        usage=os.linesep.join(__EXAMPLES__),
+    )
+
+    parser.add_argument('command', choices=list(COMMANDS) + ["all"],
+                        help='Stage to run, or all of them in one process.')
+
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+                        help='Arguments of the command. See: <command> --help.')
+
+    args = parser.parse_args()
+
+    if args.command == "all":
+        sys.exit(run_all(args.arguments))
+
+    sys.exit(run_command(args.command, args.arguments))
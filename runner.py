@@ -0,0 +1,259 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import re
+import time
+import select
+import collections
+import subprocess
+
+import tracing
+
+# Lines of output kept for the caller. Older lines are dropped so memory stays bounded.
+KEEP_LINES = 200
+# Longer lines are cut
+MAX_LINE = 64 * 1024
+READ_SIZE = 64 * 1024
+# Seconds between progress log lines of one command
+PROGRESS_LOG_INTERVAL = 5.0
+
+# Progress bars redraw with carriage return or backspaces
+SEGMENT_RE = re.compile(rb"[\r\b]+")
+
+# pacman without terminal: "Packages (150) ...", "downloading x...", "installing x..."
+PACMAN_TOTAL_RE = re.compile(r"^Packages \((\d+)\)")
+PACMAN_DOWNLOAD_RE = re.compile(r"^\s*downloading \S+\.\.\.\s*$")
+PACMAN_INSTALL_RE = re.compile(r"^\s*(installing|upgrading|reinstalling|downgrading) \S+\.\.\.\s*$")
+# pacman with terminal: "( 12/150) installing linux"
+PACMAN_COUNTER_RE = re.compile(r"^\(\s*(\d+)/(\d+)\) (.*?)\s*(?:\[.*)?$")
+PACMAN_PACKAGE_VERBS = ("installing", "upgrading", "reinstalling", "downgrading", "removing")
+# mke2fs: "Writing inode tables:  3/16" followed by backspaces and the next counter
+MKE2FS_PHASE_RE = re.compile(r"^\s*(Allocating group tables|Writing inode tables|Writing superblocks and filesystem "
+                             r"accounting information|Creating journal \(\d+ blocks\)):\s*(?:(\d+)/(\d+))?")
+MKE2FS_COUNTER_RE = re.compile(r"^\s*(\d+)/(\d+)\s*(?:done)?\s*$")
+
+
+class ProgressParser:
+    """
+    Turn output of known commands into progress events:
+
+        {"command": "pacstrap", "phase": "installing", "current": 42, "total": 150, "percent": 28.0, "eta": 65.2}
+
+    eta is seconds left in phase, estimated from its rate so far (None until known).
+    """
+
+    def __init__(self, command: str):
+        self.command = os.path.basename(command)
+        self.phase = None
+        self.phase_start = None
+        self.current = 0
+        self.total = None
+        self.packages = None
+
+        if self.command in ("pacman", "pacstrap"):
+            self._parse = self._pacman
+        elif self.command.startswith("mkfs.ext") or self.command == "mke2fs":
+            self._parse = self._mke2fs
+        else:
+            self._parse = None
+
+    def feed(self, text: str) -> dict:
+        if self._parse is None:
+            return None
+
+        if not self._parse(text) or self.phase is None:
+            return None
+
+        return self.event()
+
+    def event(self) -> dict:
+        percent = None
+        eta = None
+
+        if self.total:
+            percent = 100.0 * self.current / self.total
+            elapsed = time.monotonic() - self.phase_start
+            if self.current > 0:
+                eta = max(0.0, elapsed / self.current * (self.total - self.current))
+
+        return {"command": self.command, "phase": self.phase, "current": self.current, "total": self.total,
+                "percent": percent, "eta": eta}
+
+    def _set_phase(self, phase: str, total: int = None):
+        if phase != self.phase:
+            self.phase = phase
+            self.phase_start = time.monotonic()
+            self.current = 0
+        self.total = total
+
+    def _pacman(self, text: str) -> bool:
+        m = PACMAN_TOTAL_RE.match(text)
+        if m is not None:
+            self.packages = int(m.group(1))
+            return False
+
+        m = PACMAN_COUNTER_RE.match(text)
+        if m is not None:
+            phase = m.group(3)
+            # "installing linux" -> "installing"
+            if phase.split(" ", 1)[0] in PACMAN_PACKAGE_VERBS:
+                phase = phase.split(" ", 1)[0]
+            self._set_phase(phase, int(m.group(2)))
+            self.current = int(m.group(1))
+            return True
+
+        if PACMAN_DOWNLOAD_RE.match(text):
+            phase = "downloading"
+        elif PACMAN_INSTALL_RE.match(text):
+            phase = "installing"
+        else:
+            return False
+
+        self._set_phase(phase, self.packages)
+        self.current += 1
+        return True
+
+    def _mke2fs(self, text: str) -> bool:
+        m = MKE2FS_PHASE_RE.match(text)
+        if m is not None:
+            self._set_phase(m.group(1), int(m.group(3)) if m.group(3) else None)
+            self.current = int(m.group(2)) if m.group(2) else 0
+            return m.group(3) is not None
+
+        m = MKE2FS_COUNTER_RE.match(text)
+        if m is not None and self.phase is not None:
+            self.total = int(m.group(2))
+            self.current = int(m.group(1))
+            return True
+
+        return False
+
+
+def read_output(fd: int, deadline: float = None):
+    """
+    Yield (data, complete) from pipe fd as output arrives. complete is True for a whole line
+    (without newline) and False for a part of line ended by a carriage return or backspace.
+    Raises subprocess.TimeoutExpired when deadline (time.monotonic()) passes.
+    """
+    buf = bytearray()
+    # Bytes of buf already yielded as incomplete segments
+    done = 0
+
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or len(select.select([fd], [], [], remaining)[0]) == 0:
+                raise subprocess.TimeoutExpired("", 0)
+
+        chunk = os.read(fd, READ_SIZE)
+
+        if chunk == b"":
+            if len(buf) > 0:
+                yield bytes(buf), True
+            return
+
+        buf += chunk
+
+        while True:
+            newline = buf.find(b"\n")
+            if newline == -1:
+                break
+            yield bytes(buf[:newline]), True
+            del buf[:newline + 1]
+            done = 0
+
+        end = max(buf.rfind(b"\r"), buf.rfind(b"\b")) + 1
+        if end > done:
+            yield bytes(buf[done:end]), False
+            done = end
+
+        if len(buf) > MAX_LINE:
+            yield bytes(buf[:MAX_LINE]), True
+            buf.clear()
+            done = 0
+
+
+def stream_run(run: list, check: bool = False, timeout: float = None, progress=None, keep_lines: int = KEEP_LINES,
+               **kwargs) -> subprocess.CompletedProcess:
+    """
+    Run command and process its stdout line by line while it runs, like
+    subprocess.run(run, stdout=subprocess.PIPE). Progress of known commands is logged and
+    passed as events to progress(event). Only the last keep_lines lines of output
+    (all when None) are returned in stdout.
+    """
+    parser = ProgressParser(run[0])
+    lines = collections.deque(maxlen=keep_lines)
+    stdout_bytes = 0
+    last_log = None
+    last_phase = None
+    partial = b""
+
+    start = time.time()
+    begin = time.monotonic()
+    deadline = begin + timeout if timeout is not None else None
+
+    process = subprocess.Popen(run, stdout=subprocess.PIPE, **kwargs)
+
+    try:
+        for data, complete in read_output(process.stdout.fileno(), deadline):
+            if complete:
+                stdout_bytes += len(data) + 1
+
+            # Segments of a line already parsed while it was incomplete are not parsed again
+            segments = data[len(partial):] if complete and data.startswith(partial) else data
+            partial = b"" if complete else partial + data
+
+            if complete:
+                lines.append(data)
+
+            for segment in SEGMENT_RE.split(segments):
+                event = parser.feed(segment.decode('utf8', 'replace'))
+                if event is None:
+                    continue
+
+                if progress is not None:
+                    progress(event)
+
+                now = time.monotonic()
+                if (event['phase'] != last_phase or event['current'] == event['total'] or
+                        last_log is None or now - last_log >= PROGRESS_LOG_INTERVAL):
+                    log_progress(event)
+                    last_log = now
+                    last_phase = event['phase']
+
+        returncode = process.wait(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        tracing.record_command(run, start, time.monotonic() - begin, None, stdout_bytes)
+        raise subprocess.TimeoutExpired(run, timeout)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        process.stdout.close()
+
+    tracing.record_command(run, start, time.monotonic() - begin, returncode, stdout_bytes)
+
+    stdout = b"\n".join(lines)
+    if len(lines) > 0:
+        stdout += b"\n"
+
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, run, stdout)
+
+    return subprocess.CompletedProcess(run, returncode, stdout)
+
+
+def log_progress(event: dict):
+    if event['total']:
+        eta = ""
+        if event['eta'] is not None:
+            eta = ", ETA {}m{:02d}s".format(int(event['eta']) // 60, int(event['eta']) % 60)
+        log.info("  {} {}: {}/{} ({:.0f}%){}".format(
+            event['command'], event['phase'], event['current'], event['total'], event['percent'], eta))
+    else:
+        log.info("  {} {}: {}".format(event['command'], event['phase'], event['current']))
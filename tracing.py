@@ -0,0 +1,167 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import sys
+import json
+import time
+import atexit
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+# Set to file prefix to trace this process and every script it starts.
+# <prefix>.jsonl gets one event per line, <prefix>.trace.json is Chrome trace event format
+# (chrome://tracing, https://ui.perfetto.dev).
+TRACE_ENV = "PYARCHINSTALL_TRACE"
+
+enabled = False
+_path = None
+_lock = threading.Lock()
+_null_stage = contextlib.nullcontext()
+
+
+def enable(prefix: str):
+    """
+    Start tracing to prefix. Child processes inherit tracing through environment.
+    """
+    global enabled, _path
+
+    prefix = os.path.abspath(prefix)
+    os.environ[TRACE_ENV] = prefix
+    _path = prefix
+    enabled = True
+
+    start = time.time()
+    begin = time.perf_counter()
+    name = os.path.basename(sys.argv[0]) if len(sys.argv) > 0 and sys.argv[0] != "" else "python"
+
+    def finish():
+        _write({"type": "process", "name": name, "args": sys.argv[1:], "start": start,
+                "duration": time.perf_counter() - begin})
+        write_chrome_trace()
+
+    atexit.register(finish)
+
+
+def enable_from_environment():
+    prefix = os.environ.get(TRACE_ENV, "")
+
+    if prefix != "" and not enabled:
+        enable(prefix)
+
+
+def _write(event: dict):
+    event["pid"] = os.getpid()
+    event["tid"] = threading.get_ident()
+    line = json.dumps(event) + "\n"
+
+    with _lock:
+        # O_APPEND keeps lines of concurrent processes intact
+        with open(_path + ".jsonl", 'a', encoding="utf8") as f:
+            f.write(line)
+
+
+@contextlib.contextmanager
+def _stage(name: str):
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        _write({"type": "stage", "name": name, "start": start, "duration": time.perf_counter() - begin})
+
+
+def stage(name: str):
+    """
+    Context manager recording an installation stage. Does nothing when tracing is disabled.
+    """
+    if not enabled:
+        return _null_stage
+
+    return _stage(name)
+
+
+def record_command(run: list, start: float, duration: float, returncode, stdout_bytes: int):
+    if enabled:
+        _write({"type": "command", "name": os.path.basename(run[0]), "args": run[1:], "start": start,
+                "duration": duration, "returncode": returncode, "stdout_bytes": stdout_bytes})
+
+
+def traced_run(run: list, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run() which records start time, duration, exit code and stdout size when tracing.
+    """
+    if not enabled:
+        return subprocess.run(run, **kwargs)
+
+    start = time.time()
+    begin = time.perf_counter()
+
+    try:
+        result = subprocess.run(run, **kwargs)
+    except subprocess.CalledProcessError as e:
+        record_command(run, start, time.perf_counter() - begin, e.returncode, len(e.stdout or b""))
+        raise
+    except (OSError, subprocess.TimeoutExpired):
+        record_command(run, start, time.perf_counter() - begin, None, 0)
+        raise
+
+    record_command(run, start, time.perf_counter() - begin, result.returncode, len(result.stdout or b""))
+    return result
+
+
+def read_events(path: str) -> list:
+    events = []
+
+    with open(path, 'r', encoding="utf8") as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # Line of a process killed mid-write
+                continue
+
+    return events
+
+
+def chrome_trace(events: list) -> dict:
+    trace_events = []
+
+    for event in events:
+        args = {k: v for k, v in event.items() if k not in ("type", "name", "start", "duration", "pid", "tid")}
+        trace_events.append({
+            "name": event["name"],
+            "cat": event["type"],
+            "ph": "X",
+            "ts": int(event["start"] * 1000000),
+            "dur": int(event["duration"] * 1000000),
+            "pid": event["pid"],
+            "tid": event["tid"],
+            "args": args,
+        })
+
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace():
+    """
+    Convert all events of the trace so far into Chrome trace event format.
+    The last process to exit writes the complete timeline.
+    """
+    with _lock:
+        try:
+            events = read_events(_path + ".jsonl")
+        except FileNotFoundError:
+            return
+
+        directory = os.path.dirname(_path)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".trace.")
+        with os.fdopen(fd, 'w', encoding="utf8") as f:
+            json.dump(chrome_trace(events), f)
+        os.replace(tmp, _path + ".trace.json")
@@ -0,0 +1,100 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+import os
+import time
+import errno
+import fcntl
+import struct
+
+# <linux/fs.h>
+BLKGETSIZE64 = 0x80081272
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
+
+WIPE_AUTO = "auto"
+# Device zeroes the range itself (WRITE ZEROES / UNMAP). Reads return zeroes afterwards.
+WIPE_ZEROOUT = "zeroout"
+# Device forgets the range. Reads may return anything afterwards.
+WIPE_DISCARD = "discard"
+WIPE_SECDISCARD = "secdiscard"
+# Only filesystem and partition table signatures are erased (wipefs)
+WIPE_SIGNATURES = "signatures"
+
+WIPE_METHODS = [WIPE_AUTO, WIPE_ZEROOUT, WIPE_DISCARD, WIPE_SECDISCARD, WIPE_SIGNATURES]
+
+# Next method to try when device refuses one
+WIPE_FALLBACK = {
+    WIPE_SECDISCARD: WIPE_ZEROOUT,
+    WIPE_ZEROOUT: WIPE_DISCARD,
+    WIPE_DISCARD: WIPE_SIGNATURES,
+}
+
+WIPE_IOCTLS = {
+    WIPE_ZEROOUT: BLKZEROOUT,
+    WIPE_DISCARD: BLKDISCARD,
+    WIPE_SECDISCARD: BLKSECDISCARD,
+}
+
+
+def choose_wipe_method(block_device: dict) -> str:
+    """
+    Fastest method which leaves block device (model from get_block_device()) clean:
+    zeroout when the device can zero without writing data (SSD/NVMe with write zeroes
+    and discard), discard when it only supports discard, signatures otherwise.
+    """
+    discard = int(block_device.get('disc-max') or 0) > 0
+    write_zeroes = int(block_device.get('wzeroes') or 0) > 0
+
+    if discard and write_zeroes and not block_device.get('rota'):
+        return WIPE_ZEROOUT
+
+    if discard:
+        return WIPE_DISCARD
+
+    # Rotational disks would write every zero for real
+    return WIPE_SIGNATURES
+
+
+def wipe_device(device: str, method: str) -> str:
+    """
+    Wipe whole device with method. Falls back to the next slower method when the device
+    does not support it. Returns the method which was used.
+    """
+    start = time.monotonic()
+    used = method
+
+    while used in WIPE_IOCTLS:
+        try:
+            fd = os.open(device, os.O_WRONLY | os.O_CLOEXEC)
+            try:
+                size = struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+                fcntl.ioctl(fd, WIPE_IOCTLS[used], struct.pack("QQ", 0, size))
+            finally:
+                os.close(fd)
+            break
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                raise
+            log.warning("{} does not support {} ({}). Trying {}.".format(device, used, e, WIPE_FALLBACK[used]))
+            used = WIPE_FALLBACK[used]
+
+    log.info("Wiped {} with {} in {:.1f}s".format(device, used, time.monotonic() - start))
+
+    return used
+
+
+def mkfs_ext4_options(method: str) -> list:
+    """
+    mkfs.ext4 extended options (-E) for partition of a device wiped with method.
+    """
+    if method == WIPE_ZEROOUT:
+        # Nothing to discard and inode tables and journal are already zero
+        return ["nodiscard", "assume_storage_prezeroed=1"]
+
+    if method in (WIPE_DISCARD, WIPE_SECDISCARD):
+        return ["nodiscard"]
+
+    return []